@@ -0,0 +1,310 @@
+"""
+letter-analysis-function(同期版、非同期版)とapi-functionのコールドスタートを、クラウドにアクセスせずにローカルで計測する。
+pipeline_benchmarkと同じくスタブサーバー、fake_aws、ローカルのPostGISを使う。
+
+ハンドラーごと、STARTUP_PREINITのfalse/trueごとに新しいプロセスで次を計測し、中央値を出力する。
+  - init: app_clientとハンドラーのimport(STARTUP_PREINITがtrueの場合は初期化処理を含む)。Lambdaの初期化フェーズにあたる
+  - first invoke: 最初の呼び出し。api-functionは配達経路の計算、letter-analysis-functionは手紙の解析
+  - second invoke: 2回目の呼び出し。api-functionは保存済みの配達経路を返す
+  - 初期化処理(app_startup)ごとの処理時間
+  - モジュールごとのimport時間(python -X importtime)
+
+$ docker run -d --rm -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgis/postgis
+$ python benchmark/cold_start_benchmark.py [--runs 5] [--aws-latency 0.05] [--max-cold-start-ms 3000]
+
+NOTE 計測用のデータベースのテーブルは作り直す
+"""
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+RESOURCES_DIR = os.path.join(BENCHMARK_DIR, "..", "resources")
+LAYER_DIR = os.path.join(RESOURCES_DIR, "lambda", "layer")
+
+# {<名前>: (<関数のディレクトリ>, <ハンドラーのモジュール>)}
+FUNCTIONS = {
+    "api": (os.path.join(RESOURCES_DIR, "lambda", "api-function"), "lambda_function"),
+    "letter": (
+        os.path.join(RESOURCES_DIR, "lambda", "letter-analysis-function"),
+        "lambda_function",
+    ),
+    "letter-async": (
+        os.path.join(RESOURCES_DIR, "lambda", "letter-analysis-function"),
+        "async_lambda_function",
+    ),
+}
+
+S3_BUCKET = "benchmark-letter-bucket"
+
+
+def parse_importtime(stderr: str) -> dict[str, float]:
+    """
+    python -X importtimeの出力から、最上位のimportごとの累積時間(ms)を返す
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # 他のimportから読み込まれたものは名前が字下げされている
+        if not name.startswith("  "):
+            imports[name.strip()] = int(cumulative) / 1000
+    return imports
+
+
+def letter_event(s3, letter_dir: str, letter_ids: list[int]) -> dict:
+    """
+    letter_dirの手紙画像をS3に置き、SQSからのイベントを作る
+    """
+    records = []
+    for letter_id in letter_ids:
+        key = f"letters/{letter_id}.jpg"
+        with open(os.path.join(letter_dir, f"{letter_id}.jpg"), "rb") as f:
+            s3.put_object(Bucket=S3_BUCKET, Key=key, Body=f.read())
+        body = {
+            "Records": [{"s3": {"bucket": {"name": S3_BUCKET}, "object": {"key": key}}}]
+        }
+        records.append({"messageId": str(letter_id), "body": json.dumps(body)})
+    return {"Records": records}
+
+
+def child(args):
+    """
+    新しいプロセスでハンドラーを読み込み、2回呼び出して処理時間をJSONで出力する
+    """
+    import fake_aws
+
+    function_dir, module_name = FUNCTIONS[args.child]
+    sys.path[:0] = [LAYER_DIR, function_dir]
+    # 計測用のモジュールが読み込んだものはimport時間の集計から除く
+    preloaded = sorted(sys.modules)
+
+    start = time.perf_counter()
+    s3 = fake_aws.install(
+        json.loads(os.environ["BENCHMARK_POSTGRES"]), latency=args.aws_latency
+    )
+    module = importlib.import_module(module_name)
+    init_seconds = time.perf_counter() - start
+
+    if args.child == "api":
+        events = [{"queryStringParameters": {"apiKey": fake_aws.APP_API_KEY}}] * 2
+    else:
+        letter_ids = list(range(args.letters * 2))
+        events = [
+            letter_event(s3, args.letter_dir, letter_ids[: args.letters]),
+            letter_event(s3, args.letter_dir, letter_ids[args.letters :]),
+        ]
+
+    invoke_seconds = []
+    for event in events:
+        start = time.perf_counter()
+        module.lambda_handler(event, None)
+        invoke_seconds.append(time.perf_counter() - start)
+
+    print(
+        json.dumps(
+            {
+                "init": init_seconds * 1000,
+                "first_invoke": invoke_seconds[0] * 1000,
+                "second_invoke": invoke_seconds[1] * 1000,
+                "startup": {
+                    name: seconds * 1000
+                    for name, seconds in module.startup.timings().items()
+                },
+                "preloaded": preloaded,
+            }
+        )
+    )
+
+
+def run_child(function: str, preinit: bool, environ: dict, args) -> dict:
+    function_dir, module_name = FUNCTIONS[function]
+    res = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            os.path.abspath(__file__),
+            "--child",
+            function,
+            "--letters",
+            str(args.letters),
+            "--letter-dir",
+            args.letter_dir,
+            "--aws-latency",
+            str(args.aws_latency),
+        ],
+        env={
+            **os.environ,
+            **environ,
+            "STARTUP_PREINIT": str(preinit).lower(),
+            # Lambdaと同じく設定されたハンドラーを知らせる
+            "_HANDLER": f"{module_name}.lambda_handler",
+        },
+        capture_output=True,
+        text=True,
+    )
+    if res.returncode != 0:
+        raise RuntimeError(f"{function} failed:\n{res.stderr[-3000:]}")
+    result = json.loads(res.stdout.strip().splitlines()[-1])
+    preloaded = set(result.pop("preloaded"))
+    result["imports"] = {
+        name: ms
+        for name, ms in parse_importtime(res.stderr).items()
+        if name not in preloaded
+    }
+    return result
+
+
+def median(results: list[dict], key: str) -> float:
+    return statistics.median(result[key] for result in results)
+
+
+def print_report(results: dict[tuple[str, bool], list[dict]], args):
+    print(f"\n## cold start (median of {args.runs} runs, ms)\n")
+    print(
+        "| function | preinit | init | first invoke | init + first invoke | second invoke |"
+    )
+    print("|---|---|---:|---:|---:|---:|")
+    for (function, preinit), runs in results.items():
+        init = median(runs, "init")
+        first = median(runs, "first_invoke")
+        print(
+            f"| {function} | {str(preinit).lower()} | {init:.0f} | {first:.0f} | {init + first:.0f} | {median(runs, 'second_invoke'):.0f} |"
+        )
+
+    print("\n## startup tasks (median, ms)\n")
+    print("| function | preinit | task | ms |")
+    print("|---|---|---|---:|")
+    for (function, preinit), runs in results.items():
+        for name in runs[0]["startup"]:
+            ms = statistics.median(run["startup"].get(name, 0.0) for run in runs)
+            print(f"| {function} | {str(preinit).lower()} | {name} | {ms:.0f} |")
+
+    # STARTUP_PREINITがtrueの場合は初期化フェーズで読み込むモジュールも含まれる
+    print(f"\n## import time by module (median, ms, top {args.top})\n")
+    columns = list(results.keys())
+    imports: dict[str, list[float]] = {}
+    for column in columns:
+        for name in set().union(*(run["imports"] for run in results[column])):
+            imports.setdefault(name, [0.0] * len(columns))[columns.index(column)] = (
+                statistics.median(
+                    run["imports"].get(name, 0.0) for run in results[column]
+                )
+            )
+    print(
+        "| module | "
+        + " | ".join(f"{f} (preinit {str(p).lower()})" for f, p in columns)
+        + " |"
+    )
+    print("|---|" + "---:|" * len(columns))
+    for name, values in sorted(imports.items(), key=lambda item: -max(item[1]))[
+        : args.top
+    ]:
+        print(f"| {name} | " + " | ".join(f"{v:.0f}" for v in values) + " |")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--functions", nargs="+", choices=list(FUNCTIONS), default=list(FUNCTIONS)
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--presents", type=int, default=100)
+    parser.add_argument("--letters", type=int, default=10)
+    parser.add_argument(
+        "--aws-latency",
+        type=float,
+        default=0.05,
+        help="SSM、Secrets Managerの1回の呼び出しにかかる時間(秒)",
+    )
+    parser.add_argument("--http-latency", type=float, default=0.0)
+    parser.add_argument("--engine", choices=["here", "local"], default="local")
+    parser.add_argument("--local-tour-time-budget", type=float, default=1.0)
+    parser.add_argument("--postgres-host", default="localhost")
+    parser.add_argument("--postgres-port", type=int, default=5432)
+    parser.add_argument("--postgres-user", default="postgres")
+    parser.add_argument("--postgres-password", default="postgres")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--max-cold-start-ms",
+        type=float,
+        default=None,
+        help="init + first invokeの中央値がこれを超えるハンドラーがある場合は終了コード1で終わる",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    # 子プロセス用
+    parser.add_argument("--child", choices=list(FUNCTIONS), help=argparse.SUPPRESS)
+    parser.add_argument("--letter-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args)
+        return
+
+    import fake_aws
+    import pipeline_benchmark
+    from stub_server import StubServer
+
+    server = StubServer(latency=args.http_latency).start()
+    postgres = pipeline_benchmark.postgres_secret(args)
+    environ = {
+        **server.environ(),
+        "TOUR_ENGINE": args.engine,
+        "LOCAL_TOUR_TIME_BUDGET_SECONDS": str(args.local_tour_time_budget),
+        "BENCHMARK_POSTGRES": json.dumps(postgres),
+    }
+
+    # 計測用のデータベースはこのプロセスから準備する
+    sys.path.append(LAYER_DIR)
+    fake_aws.install(postgres)
+    from app_aurora import Aurora
+
+    aurora = Aurora(os.environ["AURORA_SECRET_NAME"])
+
+    results: dict[tuple[str, bool], list[dict]] = {}
+    with tempfile.TemporaryDirectory() as letter_dir:
+        args.letter_dir = letter_dir
+        for letter_id in range(args.letters * 2):
+            with open(os.path.join(letter_dir, f"{letter_id}.jpg"), "wb") as f:
+                f.write(fake_aws.create_letter_image(letter_id))
+
+        for function in args.functions:
+            for preinit in (False, True):
+                runs = []
+                for _ in range(args.runs):
+                    # 保存済みの配達経路と解析結果を使わないよう毎回作り直す
+                    pipeline_benchmark.reset_database(aurora)
+                    pipeline_benchmark.insert_random_presents(
+                        aurora, args.presents, args.seed
+                    )
+                    runs.append(run_child(function, preinit, environ, args))
+                results[(function, preinit)] = runs
+
+    server.shutdown()
+    print_report(results, args)
+
+    if args.max_cold_start_ms is not None:
+        slow = [
+            f"{function} (preinit {str(preinit).lower()})"
+            for (function, preinit), runs in results.items()
+            if median(runs, "init") + median(runs, "first_invoke")
+            > args.max_cold_start_ms
+        ]
+        if len(slow) > 0:
+            print(
+                f"\ncold start exceeded {args.max_cold_start_ms} ms: {', '.join(slow)}"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+ベンチマーク用のS3、Bedrock、SSM、Secrets Managerのクライアント。
+app_client.set_clientで差し替えて使う。
+"""
+
+import io
+import json
+import os
+import random
+import threading
+import time
+
+# 手紙画像に埋め込む手紙番号のビット数
+LETTER_ID_BITS = 20
+
+APP_API_KEY = "benchmark-api-key"
+REGION = "local"
+
+# ハンドラーが読み込み時に参照する環境変数
+ENVIRON = {
+    "AURORA_SECRET_NAME": "benchmark/aurora",
+    "S3_REGION": REGION,
+    "BEDROCK_MODEL_REGION": REGION,
+    "BEDROCK_MODEL_ID": "benchmark-model",
+    "APP_API_KEY_PARAMETER": "/benchmark/api-key",
+    "HERE_DEVELOPER_API_KEY_PARAMETER": "/benchmark/here-developer-api-key",
+    "HERE_PLATFORM_API_KEY_PARAMETER": "/benchmark/here-platform-api-key",
+}
+
+
+# {(<幅>, <高さ>, <seed>): <ノイズを加えた背景>}
+_backgrounds = {}
+
+
+def create_letter_image(
+    letter_id: int, width: int = 1600, height: int = 1200, seed: int = 0
+) -> bytes:
+    """
+    手紙番号を白黒のブロックとして埋め込んだJPEG画像を作る。
+    前処理で縮小、グレースケール化、再エンコードされてもFakeBedrockで手紙番号を読み取れる。
+    撮影した写真に近いサイズになるよう背景にノイズを加える。
+    """
+    import numpy as np
+    from PIL import Image
+
+    key = (width, height, seed)
+    if key not in _backgrounds:
+        rng = np.random.default_rng(seed)
+        _backgrounds[key] = rng.integers(
+            200, 256, size=(height, width, 3), dtype=np.uint8
+        )
+    pixels = _backgrounds[key].copy()
+    block = width // LETTER_ID_BITS
+    for bit in range(LETTER_ID_BITS):
+        if letter_id >> bit & 1:
+            pixels[: height // 4, bit * block : (bit + 1) * block] //= 5
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def read_letter_id(image: bytes) -> int:
+    """
+    create_letter_imageで埋め込んだ手紙番号を読み取る
+    """
+    from PIL import Image
+
+    letter = Image.open(io.BytesIO(image)).convert("L")
+    width, height = letter.size
+    block = width / LETTER_ID_BITS
+    letter_id = 0
+    for bit in range(LETTER_ID_BITS):
+        x = int((bit + 0.5) * block)
+        if letter.getpixel((x, height // 8)) < 128:
+            letter_id |= 1 << bit
+    return letter_id
+
+
+def letter_address(letter_id: int) -> str:
+    return f"宮城県仙台市青葉区ベンチマーク{letter_id // 100}丁目{letter_id % 100}番"
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects: dict[tuple[str, str], bytes] = {}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+class ThrottlingException(Exception):
+    def __init__(self):
+        super().__init__("ThrottlingException")
+        # botocore.exceptions.ClientErrorと同じ形
+        self.response = {"Error": {"Code": "ThrottlingException"}}
+
+
+class FakeBedrock:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_per_image: float = 0.0,
+        error_rate: float = 0.0,
+    ):
+        """
+        latency: 1回の呼び出しにかかる時間(秒)
+        latency_per_image: 画像1枚あたりに追加でかかる時間(秒)
+        error_rate: ThrottlingExceptionとする割合
+        """
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        self.error_rate = error_rate
+        self.calls = 0
+        self.images = 0
+        self.image_bytes = 0
+        self._lock = threading.Lock()
+
+    def converse(self, modelId: str, messages: list, system: list) -> dict:
+        images = [
+            content["image"]["source"]["bytes"]
+            for content in messages[0]["content"]
+            if "image" in content
+        ]
+        with self._lock:
+            self.calls += 1
+            self.images += len(images)
+            self.image_bytes += sum(len(image) for image in images)
+
+        time.sleep(self.latency + self.latency_per_image * len(images))
+        if random.random() < self.error_rate:
+            raise ThrottlingException()
+
+        letters = []
+        for index, image in enumerate(images):
+            letter_id = read_letter_id(image)
+            letters.append(
+                {
+                    "index": index,
+                    "present": f"プレゼント{letter_id}",
+                    "address": letter_address(letter_id),
+                }
+            )
+        output = (
+            letters
+            if len(images) > 1
+            else {k: letters[0][k] for k in letters[0] if k != "index"}
+        )
+        return {
+            "output": {
+                "message": {
+                    "role": "assistant",
+                    "content": [{"text": json.dumps(output, ensure_ascii=False)}],
+                }
+            },
+            "usage": {
+                "inputTokens": 1500 * len(images),
+                "outputTokens": 50 * len(images),
+            },
+        }
+
+
+class FakeSSM:
+    def __init__(self, parameters: dict[str, str], latency: float = 0.0):
+        """
+        latency: 1回の呼び出しにかかる時間(秒)
+        """
+        self.parameters = parameters
+        self.latency = latency
+
+    def get_parameters(self, Names: list[str], WithDecryption: bool = False) -> dict:
+        time.sleep(self.latency)
+        return {
+            "Parameters": [
+                {"Name": name, "Value": self.parameters[name]}
+                for name in Names
+                if name in self.parameters
+            ],
+            "InvalidParameters": [
+                name for name in Names if name not in self.parameters
+            ],
+        }
+
+
+class FakeSecretsManager:
+    def __init__(self, secrets: dict[str, dict], latency: float = 0.0):
+        """
+        latency: 1回の呼び出しにかかる時間(秒)
+        """
+        self.secrets = secrets
+        self.latency = latency
+
+    def get_secret_value(self, SecretId: str) -> dict:
+        time.sleep(self.latency)
+        return {"SecretString": json.dumps(self.secrets[SecretId])}
+
+
+def install(
+    postgres: dict, bedrock: FakeBedrock = None, latency: float = 0.0
+) -> FakeS3:
+    """
+    環境変数を設定し、app_clientが返すS3、Bedrock、SSM、Secrets Managerのクライアントを差し替える。
+    ハンドラーを読み込む前に呼び出す。
+
+    postgres: Auroraのシークレットとして返す{"host", "port", "username", "password"}
+    latency: SSM、Secrets Managerの1回の呼び出しにかかる時間(秒)
+    """
+    for key, value in ENVIRON.items():
+        os.environ.setdefault(key, value)
+
+    import app_client
+
+    s3 = FakeS3()
+    app_client.set_client("s3", s3, region_name=REGION)
+    app_client.set_client(
+        "bedrock-runtime", bedrock or FakeBedrock(), region_name=REGION
+    )
+    app_client.set_client(
+        "ssm",
+        FakeSSM(
+            {
+                os.environ["APP_API_KEY_PARAMETER"]: APP_API_KEY,
+                os.environ["HERE_DEVELOPER_API_KEY_PARAMETER"]: "benchmark",
+                os.environ["HERE_PLATFORM_API_KEY_PARAMETER"]: "benchmark",
+            },
+            latency,
+        ),
+    )
+    app_client.set_client(
+        "secretsmanager",
+        FakeSecretsManager({os.environ["AURORA_SECRET_NAME"]: postgres}, latency),
+    )
+    return s3
@@ -0,0 +1,81 @@
+"""
+local_tour.LocalTourSolverの品質と実行時間を合成データで計測する。
+
+$ python benchmark/local_tour_benchmark.py [--sizes 100 1000 10000] [--time-budget 10]
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), "..", "resources", "lambda", "layer")
+)
+
+from local_tour import (  # noqa: E402
+    DistanceOracle,
+    nearest_neighbor_tour,
+    solve_tour,
+    tour_length,
+)
+
+# 配達拠点(サンタさんの家)
+FACILITY = (38.260990, 140.881155)
+
+
+def create_points(size: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    配達拠点の周辺(仙台市付近)に一様乱数でsize個の配達先を作成する。
+    先頭は配達拠点。
+    """
+    rng = np.random.default_rng(seed)
+    latitudes = np.concatenate([[FACILITY[0]], rng.uniform(38.10, 38.40, size)])
+    longitudes = np.concatenate([[FACILITY[1]], rng.uniform(140.70, 141.00, size)])
+    return latitudes, longitudes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--time-budget", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(
+        "| stops | random (km) | nearest neighbor (km) | local (km) "
+        "| vs nearest neighbor | matrix (s) | neighbors + nearest neighbor (s) | total (s) |"
+    )
+    print("|---:|---:|---:|---:|---:|---:|---:|---:|")
+    for size in args.sizes:
+        latitudes, longitudes = create_points(size, args.seed)
+
+        start = time.perf_counter()
+        oracle = DistanceOracle(latitudes, longitudes)
+        matrix_seconds = time.perf_counter() - start
+
+        random_length = tour_length(oracle, list(range(size + 1)))
+
+        start = time.perf_counter()
+        nn_length = tour_length(
+            oracle, nearest_neighbor_tour(oracle, oracle.neighbors(10))
+        )
+        nn_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tour = solve_tour(oracle, args.time_budget)
+        solve_seconds = time.perf_counter() - start
+        assert sorted(tour) == list(range(size + 1))
+        length = tour_length(oracle, tour)
+
+        print(
+            f"| {size} | {random_length / 1000:.1f} | {nn_length / 1000:.1f} "
+            f"| {length / 1000:.1f} | {(length / nn_length - 1) * 100:+.1f}% "
+            f"| {matrix_seconds:.2f} | {nn_seconds:.2f} "
+            f"| {matrix_seconds + solve_seconds:.2f} |"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+letter-analysis-functionとapi-functionのlambda_handlerを、クラウドにアクセスせずにローカルで計測する。
+
+  - 国土地理院API、HEREのAPI: stub_server.StubServer
+  - S3、Bedrock、SSM、Secrets Manager: fake_aws (app_client.set_clientで差し替える)
+  - Aurora: ローカルのPostGIS
+
+プレゼント数ごとに、手紙の処理のレコード/秒と、段階ごとの処理時間のp50/p99、メモリ使用量を出力する。
+手紙として処理するのは--max-lettersまでで、残りのプレゼントはpresentテーブルに直接登録する。
+
+$ docker run -d --rm -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgis/postgis
+$ python benchmark/pipeline_benchmark.py [--sizes 10 1000 100000] [--engine local]
+
+NOTE 計測用のデータベースのテーブルは作り直す
+"""
+
+import argparse
+import functools
+import importlib.util
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+RESOURCES_DIR = os.path.join(BENCHMARK_DIR, "..", "resources")
+LAYER_DIR = os.path.join(RESOURCES_DIR, "lambda", "layer")
+LETTER_FUNCTION_DIR = os.path.join(RESOURCES_DIR, "lambda", "letter-analysis-function")
+API_FUNCTION_DIR = os.path.join(RESOURCES_DIR, "lambda", "api-function")
+
+sys.path.append(LAYER_DIR)
+sys.path.append(LETTER_FUNCTION_DIR)
+
+import fake_aws  # noqa: E402
+from fake_aws import APP_API_KEY  # noqa: E402
+from stub_server import LATITUDE_RANGE, LONGITUDE_RANGE, StubServer  # noqa: E402
+
+S3_BUCKET = "benchmark-letter-bucket"
+
+
+class StageTimer:
+    def __init__(self):
+        """
+        段階ごとの処理時間(秒)を記録する
+        """
+        self.durations: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, owner, name: str, stage: str = None):
+        """
+        owner(モジュールまたはクラス)の関数nameを、処理時間を記録する関数に差し替える
+        """
+        fn = getattr(owner, name)
+        stage = stage or name
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+
+    def reset(self):
+        with self._lock:
+            self.durations = {}
+
+    def summary(self) -> list[tuple[str, int, float, float]]:
+        """
+        return [(<段階>, <回数>, <p50(ms)>, <p99(ms)>)]
+        """
+        with self._lock:
+            return [
+                (
+                    stage,
+                    len(durations),
+                    float(np.percentile(durations, 50)) * 1000,
+                    float(np.percentile(durations, 99)) * 1000,
+                )
+                for stage, durations in self.durations.items()
+            ]
+
+
+def load_module(name: str, path: str):
+    """
+    同じファイル名(lambda_function.py)のハンドラーを別の名前で読み込む
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def setup_environment(args, server: StubServer) -> fake_aws.FakeS3:
+    """
+    ハンドラーを読み込む前に環境変数とAWSクライアントを差し替える
+    """
+    environ = {
+        **server.environ(),
+        "TOUR_ENGINE": args.engine,
+        "LOCAL_TOUR_TIME_BUDGET_SECONDS": str(args.local_tour_time_budget),
+    }
+    for key, value in environ.items():
+        os.environ.setdefault(key, value)
+
+    return fake_aws.install(
+        postgres_secret(args),
+        fake_aws.FakeBedrock(
+            args.bedrock_latency,
+            args.bedrock_latency_per_image,
+            args.bedrock_error_rate,
+        ),
+    )
+
+
+def postgres_secret(args) -> dict:
+    """
+    Auroraのシークレットとして返すローカルのPostgreSQLの接続先
+    """
+    return {
+        "host": args.postgres_host,
+        "port": args.postgres_port,
+        "username": args.postgres_user,
+        "password": args.postgres_password,
+    }
+
+
+def reset_database(aurora):
+    """
+    テーブルを作り直し、配達拠点を登録する
+    """
+    with open(os.path.join(RESOURCES_DIR, "sql", "create_tables.sql")) as f:
+        create_tables = f.read()
+    aurora.update_commit("CREATE EXTENSION IF NOT EXISTS postgis")
+    aurora.update_commit(
+        "DROP TABLE IF EXISTS present, delivery_route, facility, geocode_cache, letter_analysis, travel_cost CASCADE"
+    )
+    aurora.update_commit(create_tables)
+
+
+def insert_random_presents(aurora, size: int, seed: int):
+    """
+    手紙を経由せずにプレゼントを登録する
+    """
+    query = "INSERT INTO present (present_name, address, point) SELECT 'プレゼント' || i, 'ベンチマーク' || i, ST_MakePoint(%s + random() * %s, %s + random() * %s) FROM generate_series(1, %s) AS i"
+    aurora.update_commit("SELECT setseed(%s)", (seed / 2**31,))
+    aurora.update_commit(
+        query,
+        (
+            LATITUDE_RANGE[0],
+            LATITUDE_RANGE[1] - LATITUDE_RANGE[0],
+            LONGITUDE_RANGE[0],
+            LONGITUDE_RANGE[1] - LONGITUDE_RANGE[0],
+            size,
+        ),
+    )
+
+
+def create_letter_events(
+    s3: fake_aws.FakeS3, letters: int, batch_size: int, args
+) -> list[dict]:
+    """
+    手紙画像をS3に置き、SQSからのイベントをbatch_size件ずつ作る
+    """
+    records = []
+    for letter_id in range(letters):
+        key = f"letters/{letter_id}.jpg"
+        s3.put_object(
+            Bucket=S3_BUCKET,
+            Key=key,
+            Body=fake_aws.create_letter_image(
+                letter_id, args.letter_width, args.letter_height
+            ),
+        )
+        body = {
+            "Records": [{"s3": {"bucket": {"name": S3_BUCKET}, "object": {"key": key}}}]
+        }
+        records.append({"messageId": str(letter_id), "body": json.dumps(body)})
+    return [
+        {"Records": records[i : i + batch_size]}
+        for i in range(0, len(records), batch_size)
+    ]
+
+
+def max_rss_mb() -> float:
+    # Linuxではキロバイト
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Phase:
+    def __init__(self, name: str, use_tracemalloc: bool):
+        """
+        処理時間とメモリ使用量を計測する区間
+        """
+        self.name = name
+        self.use_tracemalloc = use_tracemalloc
+        self.seconds = 0.0
+        self.peak_mb: float = None
+
+    def __enter__(self):
+        if self.use_tracemalloc:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        if self.use_tracemalloc:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        else:
+            self.peak_mb = max_rss_mb()
+
+
+def print_report(size: int, phases: list[tuple[Phase, int]], timer: StageTimer, args):
+    memory = "python heap peak (MB)" if args.tracemalloc else "max rss (MB)"
+    print(f"\n## presents: {size}\n")
+    print(f"| phase | records | seconds | records/s | {memory} |")
+    print("|---|---:|---:|---:|---:|")
+    for phase, records in phases:
+        rate = records / phase.seconds if phase.seconds > 0 else 0
+        print(
+            f"| {phase.name} | {records} | {phase.seconds:.2f} | {rate:.1f} | {phase.peak_mb:.1f} |"
+        )
+    print("\n| stage | count | p50 (ms) | p99 (ms) |")
+    print("|---|---:|---:|---:|")
+    for stage, count, p50, p99 in timer.summary():
+        print(f"| {stage} | {count} | {p50:.1f} | {p99:.1f} |")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--max-letters", type=int, default=1000)
+    parser.add_argument("--sqs-batch-size", type=int, default=10)
+    parser.add_argument("--engine", choices=["here", "local"], default="local")
+    parser.add_argument("--local-tour-time-budget", type=float, default=10.0)
+    parser.add_argument("--letter-width", type=int, default=1600)
+    parser.add_argument("--letter-height", type=int, default=1200)
+    parser.add_argument("--http-latency", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--bedrock-latency", type=float, default=0.0)
+    parser.add_argument("--bedrock-latency-per-image", type=float, default=0.0)
+    parser.add_argument("--bedrock-error-rate", type=float, default=0.0)
+    parser.add_argument("--postgres-host", default="localhost")
+    parser.add_argument("--postgres-port", type=int, default=5432)
+    parser.add_argument("--postgres-user", default="postgres")
+    parser.add_argument("--postgres-password", default="postgres")
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="段階ごとのPythonのヒープの最大使用量を計測する(処理は遅くなる)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubServer(
+        latency=args.http_latency, error_rate=args.http_error_rate
+    ).start()
+    s3 = setup_environment(args, server)
+
+    # 環境変数を設定してから読み込む
+    letter_function = load_module(
+        "lambda_function", os.path.join(LETTER_FUNCTION_DIR, "lambda_function.py")
+    )
+    api_function = load_module(
+        "api_lambda_function", os.path.join(API_FUNCTION_DIR, "lambda_function.py")
+    )
+    import geocode_cache
+    import here_api
+    from app_aurora import Aurora
+
+    timer = StageTimer()
+    for module, name in (
+        (letter_function, "get_letter_image"),
+        (letter_function, "preprocess_letter_image"),
+        (letter_function, "analyze_letter_image"),
+        (letter_function, "analyze_letter_images"),
+        (geocode_cache.GeocodeCache, "address_search"),
+        (letter_function, "insert_presents"),
+        (api_function, "get_present_fingerprint"),
+        (api_function, "get_presents"),
+        (api_function, "get_delivery_route"),
+        (api_function, "get_delivery_ordered_present"),
+        (here_api.HereApi, "route"),
+        (api_function, "insert_delivery_route"),
+        (api_function, "simplify_route"),
+    ):
+        timer.wrap(module, name)
+
+    aurora = Aurora(os.environ["AURORA_SECRET_NAME"])
+    api_event = {"queryStringParameters": {"apiKey": APP_API_KEY}}
+    api_zoom_event = {"queryStringParameters": {"apiKey": APP_API_KEY, "zoom": "12"}}
+
+    for size in args.sizes:
+        reset_database(aurora)
+        # 前のサイズのキャッシュを使わないようにする
+        letter_function.geocode_cache = None
+        api_function.simplified_routes.clear()
+        timer.reset()
+
+        letters = min(size, args.max_letters)
+        events = create_letter_events(s3, letters, args.sqs_batch_size, args)
+        phases = []
+
+        with Phase("letter-analysis", args.tracemalloc) as phase:
+            failures = 0
+            for event in events:
+                start = time.perf_counter()
+                res = letter_function.lambda_handler(event, None)
+                timer.record("letter lambda_handler", time.perf_counter() - start)
+                failures += len(res["batchItemFailures"])
+        phases.append((phase, letters))
+        if failures > 0:
+            print(f"letter-analysis: {failures} records failed", file=sys.stderr)
+
+        insert_random_presents(aurora, size - letters, args.seed)
+
+        for name, event in (
+            ("api (route calculation)", api_event),
+            ("api (saved route)", api_event),
+            ("api (saved route, zoom 12)", api_zoom_event),
+        ):
+            with Phase(name, args.tracemalloc) as phase:
+                start = time.perf_counter()
+                api_function.lambda_handler(event, None)
+                timer.record(name, time.perf_counter() - start)
+            phases.append((phase, size))
+
+        print_report(size, phases, timer, args)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
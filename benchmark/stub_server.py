@@ -0,0 +1,225 @@
+"""
+国土地理院の住所検索API、HEREのrouter API、tourplanning API、matrix routing APIのスタブサーバー。
+応答までの遅延とエラー率を指定できる。
+
+$ python benchmark/stub_server.py [--port 8080] [--latency 0.05] [--error-rate 0.01]
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), "..", "resources", "lambda", "layer")
+)
+
+import flexible_polyline  # noqa: E402
+
+GSI_PATH = "/address-search/AddressSearch"
+HERE_ROUTE_PATH = "/v8/routes"
+HERE_TOUR_PATH = "/v3/problems"
+HERE_MATRIX_PATH = "/v8/matrix"
+
+# 道路距離を直線距離のこの倍数とする
+DETOUR_FACTOR = 1.3
+EARTH_RADIUS_METERS = 6371008.8
+
+# 住所から緯度経度を作る範囲(仙台市付近)
+LATITUDE_RANGE = (38.10, 38.40)
+LONGITUDE_RANGE = (140.70, 141.00)
+
+
+def address_to_point(address: str) -> tuple[float, float]:
+    """
+    同じ住所には同じ緯度経度を返すよう、住所のハッシュから緯度経度を作る
+    """
+    digest = hashlib.sha256(address.encode()).digest()
+    x = int.from_bytes(digest[:4], "big") / 2**32
+    y = int.from_bytes(digest[4:8], "big") / 2**32
+    latitude = LATITUDE_RANGE[0] + (LATITUDE_RANGE[1] - LATITUDE_RANGE[0]) * x
+    longitude = LONGITUDE_RANGE[0] + (LONGITUDE_RANGE[1] - LONGITUDE_RANGE[0]) * y
+    return latitude, longitude
+
+
+def road_distance(src: dict, dest: dict) -> int:
+    """
+    2地点間の大円距離をDETOUR_FACTOR倍した道路距離(m)
+    """
+    lat1, lat2 = math.radians(src["lat"]), math.radians(dest["lat"])
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1)
+        * math.cos(lat2)
+        * math.sin(math.radians(dest["lng"] - src["lng"]) / 2) ** 2
+    )
+    return round(
+        2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0))) * DETOUR_FACTOR
+    )
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # ThreadingHTTPServerに設定された値を使う
+    latency: float = 0.0
+    error_rate: float = 0.0
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay_or_fail(self) -> bool:
+        """
+        遅延させ、エラー率に従って429を返した場合はTrue
+        """
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self._send_json(429, {"error": "Too Many Requests"})
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if self._delay_or_fail():
+            return
+
+        if url.path == GSI_PATH:
+            address = query["q"][0]
+            latitude, longitude = address_to_point(address)
+            self._send_json(
+                200,
+                [
+                    {
+                        "geometry": {
+                            "coordinates": [longitude, latitude],
+                            "type": "Point",
+                        },
+                        "type": "Feature",
+                        "properties": {"addressCode": "", "title": address},
+                    }
+                ],
+            )
+        elif url.path == HERE_ROUTE_PATH:
+            points = (
+                [query["origin"][0]] + query.get("via", []) + [query["destination"][0]]
+            )
+            points = [tuple(float(v) for v in point.split(",")) for point in points]
+            sections = []
+            for src, dest in zip(points, points[1:]):
+                # 地点間を直線で結んだ10点のpolyline
+                coordinates = [
+                    (
+                        src[0] + (dest[0] - src[0]) * i / 9,
+                        src[1] + (dest[1] - src[1]) * i / 9,
+                    )
+                    for i in range(10)
+                ]
+                sections.append({"polyline": flexible_polyline.encode(coordinates)})
+            self._send_json(200, {"routes": [{"sections": sections}]})
+        else:
+            self._send_json(404, {"error": "Not Found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        if self._delay_or_fail():
+            return
+
+        if url.path == HERE_TOUR_PATH:
+            problem = json.loads(body)
+            start = problem["fleet"]["types"][0]["shifts"][0]["start"]["location"]
+            jobs = problem["plan"]["jobs"]
+
+            # 配達拠点から見た方角の順に巡回する
+            def angle(job):
+                location = job["tasks"]["deliveries"][0]["places"][0]["location"]
+                return math.atan2(
+                    location["lat"] - start["lat"], location["lng"] - start["lng"]
+                )
+
+            stops = [{"activities": [{"jobId": "departure", "type": "departure"}]}]
+            for job in sorted(jobs, key=angle):
+                stops.append({"activities": [{"jobId": job["id"], "type": "delivery"}]})
+            stops.append({"activities": [{"jobId": "arrival", "type": "arrival"}]})
+            self._send_json(200, {"tours": [{"stops": stops}]})
+        elif url.path == HERE_MATRIX_PATH:
+            request = json.loads(body)
+            origins, destinations = request["origins"], request["destinations"]
+            self._send_json(
+                200,
+                {
+                    "matrix": {
+                        "numOrigins": len(origins),
+                        "numDestinations": len(destinations),
+                        "distances": [
+                            road_distance(src, dest)
+                            for src in origins
+                            for dest in destinations
+                        ],
+                    }
+                },
+            )
+        else:
+            self._send_json(404, {"error": "Not Found"})
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def environ(self) -> dict:
+        """
+        gsi_api、here_apiをこのサーバーに向けるための環境変数
+        """
+        return {
+            "GSI_ADDRESS_SEARCH_URL": self.base_url + GSI_PATH,
+            "HERE_ROUTE_URL": self.base_url + HERE_ROUTE_PATH,
+            "HERE_TOUR_URL": self.base_url + HERE_TOUR_PATH,
+            "HERE_MATRIX_URL": self.base_url + HERE_MATRIX_PATH,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubServer(args.port, args.latency, args.error_rate)
+    for key, value in server.environ().items():
+        print(f"{key}={value}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
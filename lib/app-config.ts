@@ -3,6 +3,15 @@ export class SpConfig {
    * general
    */
   appName = "santa-present";
+  // trueの場合はLambdaの処理ごとの所要時間などをEmbedded Metric Formatのログとして出力し、
+  // CloudWatchメトリクスの名前空間metricsNamespaceに記録する
+  metricsEnabled = true;
+  metricsNamespace = this.appName;
+  // trueの場合はLambdaの初期化フェーズでシークレットとパラメーターの取得、Auroraへの接続を並列に行っておく
+  startupPreinit = true;
+  // APIのリクエストやレスポンスなどの大きなログの1項目あたりの最大バイト数と、出力する割合(0~1)
+  logPayloadMaxBytes = 8192;
+  logPayloadSampleRate = 0.1;
 
   /*
    * vpc
@@ -14,11 +23,50 @@ export class SpConfig {
    */
   modelId = "anthropic.claude-3-5-sonnet-20240620-v1:0";
 
+  /*
+   * letter-analysis-function
+   */
+  // 1回の呼び出しで並列に処理するSQSレコード数
+  // Note: Lambda関数1つあたりのAuroraへの接続数に影響
+  letterRecordConcurrency = 5;
+  // 1回のBedrock呼び出しでまとめて解析する手紙の数(最大20) 1の場合は1通ずつ解析する
+  letterAnalysisBatchSize = 5;
+  // trueの場合はS3、Bedrock、国土地理院API、Auroraへの待ち合わせを1つのイベントループで行う
+  letterAnalysisAsyncIo = false;
+  // letterAnalysisAsyncIoがtrueの場合に1回の呼び出しで同時に処理するSQSレコード数
+  letterAsyncRecordConcurrency = 100;
+  // 1回の呼び出しで受け取るSQSレコード数 Note: 10より大きい場合は最大5秒間レコードを溜めてから呼び出す
+  letterEventBatchSize = 10;
+
+  /*
+   * api-function
+   */
+  // 巡回順序の計算方法の既定値 here: hereのtourplanning API, local: Lambda内で計算
+  // APIのクエリパラメーターengineで切り替えられる
+  tourEngine = "here";
+  // localで巡回順序を改善する時間(秒)
+  localTourTimeBudgetSeconds = 10;
+  // 配達先がこの数より多い場合は配達拠点の周りを区画に分けて巡回順序を並列に計算する
+  hereTourPartitionMaxStops = 200;
+  localTourPartitionMaxStops = 5000;
+  tourPartitionMaxWorkers = 4;
+  // trueの場合は前回の配達経路に追加されたプレゼントだけを挿入し、変わった区間の経路だけを取得する
+  // 全体を計算してから挿入したプレゼント数がそのときの数のtourIncrementalMaxDriftの割合を超えたら全体を計算し直す
+  tourIncremental = true;
+  tourIncrementalMaxDrift = 0.2;
+  // localで使う地点間の移動コスト haversine: 大円距離, here: hereのmatrix routing APIで求めた道路距離
+  // hereの場合は求めた道路距離をAuroraに保存して使いまわし、新しい配達先の分だけ求める
+  // 配達先がtravelCostMaxPointsより多い区画では大円距離を使う
+  localTourTravelCost = "haversine";
+  travelCostMaxPoints = 200;
+
   /*
    * aurora
    */
   auroraUsername = "postgres";
   auroraSecretName = `${this.appName}/aurora`;
+  // この秒数以上使われていなかったコネクションは使う前に生きているか確かめ、切れていれば接続し直す
+  auroraPoolCheckIdleSeconds = 30;
 
   /*
    * ssm parameter name
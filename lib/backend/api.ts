@@ -54,8 +54,9 @@ export class SpApi extends Construct {
         }),
         new iam.PolicyStatement({
           effect: iam.Effect.ALLOW,
-          actions: ["ssm:GetParameter"],
+          actions: ["ssm:GetParameter", "ssm:GetParameters"],
           resources: [
+            `arn:aws:ssm:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:parameter${spConfig.appAPIKeyParameter}`,
             `arn:aws:ssm:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:parameter${spConfig.hereDeveloperAPIKeyParameter}`,
             `arn:aws:ssm:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:parameter${spConfig.herePlatformAPIKeyParameter}`,
           ],
@@ -87,8 +88,31 @@ export class SpApi extends Construct {
       environment: {
         APP_API_KEY_PARAMETER: spConfig.appAPIKeyParameter,
         AURORA_SECRET_NAME: spConfig.auroraSecretName,
+        AURORA_POOL_CHECK_IDLE_SECONDS: String(
+          spConfig.auroraPoolCheckIdleSeconds,
+        ),
         HERE_DEVELOPER_API_KEY_PARAMETER: spConfig.hereDeveloperAPIKeyParameter,
         HERE_PLATFORM_API_KEY_PARAMETER: spConfig.herePlatformAPIKeyParameter,
+        TOUR_ENGINE: spConfig.tourEngine,
+        LOCAL_TOUR_TIME_BUDGET_SECONDS: String(
+          spConfig.localTourTimeBudgetSeconds,
+        ),
+        HERE_TOUR_PARTITION_MAX_STOPS: String(
+          spConfig.hereTourPartitionMaxStops,
+        ),
+        LOCAL_TOUR_PARTITION_MAX_STOPS: String(
+          spConfig.localTourPartitionMaxStops,
+        ),
+        TOUR_PARTITION_MAX_WORKERS: String(spConfig.tourPartitionMaxWorkers),
+        TOUR_INCREMENTAL: String(spConfig.tourIncremental),
+        TOUR_INCREMENTAL_MAX_DRIFT: String(spConfig.tourIncrementalMaxDrift),
+        LOCAL_TOUR_TRAVEL_COST: spConfig.localTourTravelCost,
+        TRAVEL_COST_MAX_POINTS: String(spConfig.travelCostMaxPoints),
+        METRICS_ENABLED: String(spConfig.metricsEnabled),
+        METRICS_NAMESPACE: spConfig.metricsNamespace,
+        STARTUP_PREINIT: String(spConfig.startupPreinit),
+        LOG_PAYLOAD_MAX_BYTES: String(spConfig.logPayloadMaxBytes),
+        LOG_PAYLOAD_SAMPLE_RATE: String(spConfig.logPayloadSampleRate),
       },
     });
 
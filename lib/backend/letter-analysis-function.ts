@@ -48,8 +48,9 @@ export class SpLetterAnalysisFunction extends Construct {
 
     this.letterEventQueue = new sqs.Queue(this, "LetterEventQueue", {
       visibilityTimeout: cdk.Duration.minutes(15),
+      // Note: スロットリングされたレコードもSQSに返して処理し直すため、受信回数に余裕を持たせる
       deadLetterQueue: {
-        maxReceiveCount: 3,
+        maxReceiveCount: 10,
         queue: LetterEventDeadQueue,
       },
     });
@@ -113,7 +114,9 @@ export class SpLetterAnalysisFunction extends Construct {
 
     // Function
     this.function = new lambda.Function(this, "AnalyzeLetterFunction", {
-      handler: "lambda_function.lambda_handler",
+      handler: spConfig.letterAnalysisAsyncIo
+        ? "async_lambda_function.lambda_handler"
+        : "lambda_function.lambda_handler",
       runtime: lambda.Runtime.PYTHON_3_12,
       timeout: Duration.minutes(15),
       memorySize: 1024,
@@ -131,6 +134,17 @@ export class SpLetterAnalysisFunction extends Construct {
         BEDROCK_MODEL_REGION: cdk.Stack.of(this).region,
         BEDROCK_MODEL_ID: spConfig.modelId,
         AURORA_SECRET_NAME: spConfig.auroraSecretName,
+        AURORA_POOL_CHECK_IDLE_SECONDS: String(
+          spConfig.auroraPoolCheckIdleSeconds,
+        ),
+        RECORD_CONCURRENCY: String(spConfig.letterRecordConcurrency),
+        LETTER_ANALYSIS_BATCH_SIZE: String(spConfig.letterAnalysisBatchSize),
+        ASYNC_RECORD_CONCURRENCY: String(spConfig.letterAsyncRecordConcurrency),
+        METRICS_ENABLED: String(spConfig.metricsEnabled),
+        METRICS_NAMESPACE: spConfig.metricsNamespace,
+        STARTUP_PREINIT: String(spConfig.startupPreinit),
+        LOG_PAYLOAD_MAX_BYTES: String(spConfig.logPayloadMaxBytes),
+        LOG_PAYLOAD_SAMPLE_RATE: String(spConfig.logPayloadSampleRate),
       },
     });
 
@@ -138,6 +152,9 @@ export class SpLetterAnalysisFunction extends Construct {
     this.function.addEventSource(
       new lambdaEventSource.SqsEventSource(this.letterEventQueue, {
         reportBatchItemFailures: true,
+        batchSize: spConfig.letterEventBatchSize,
+        maxBatchingWindow:
+          spConfig.letterEventBatchSize > 10 ? Duration.seconds(5) : undefined,
       }),
     );
   }
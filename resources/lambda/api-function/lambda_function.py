@@ -1,11 +1,23 @@
 import boto3
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import TYPE_CHECKING
 import app_const
+import app_logging
+import app_metrics
+import app_parameter
+import app_startup
+import flexible_polyline
 from app_aurora import Aurora
-from app_type import Present, Facility
-from here_api import HereApi, TourStop
+from app_type import Facility, Point, PresentSet
+from here_api import ROUTE_MAX_VIAS, HereApi, TourStop
+
+# 巡回順序の計算はnumpyを使い、保存済みの配達経路を返す場合は使わないので、使うときに読み込む
+if TYPE_CHECKING:
+    from local_tour import LocalTourSolver
+    from partitioned_tour import PartitionedTourSolver
 
 # log
 logger = logging.getLogger(app_const.PROJECT_NAME)
@@ -20,27 +32,155 @@ APP_API_KEY_PARAMETER = os.environ["APP_API_KEY_PARAMETER"]
 AURORA_SECRET_NAME = os.environ["AURORA_SECRET_NAME"]
 HERE_DEV_API_KEY_PARAMETER = os.environ["HERE_DEVELOPER_API_KEY_PARAMETER"]
 HERE_PLAT_API_KEY_PARAMETER = os.environ["HERE_PLATFORM_API_KEY_PARAMETER"]
+# 巡回順序の計算方法 here: hereのtourplanning API, local: Lambda内で計算
+TOUR_ENGINE = os.environ.get("TOUR_ENGINE", "here")
+LOCAL_TOUR_TIME_BUDGET_SECONDS = float(
+    os.environ.get("LOCAL_TOUR_TIME_BUDGET_SECONDS", "10")
+)
+TOUR_ENGINES = ("here", "local")
+# 配達先がこの数より多い場合は区画に分けて巡回順序を並列に計算する
+HERE_TOUR_PARTITION_MAX_STOPS = int(
+    os.environ.get("HERE_TOUR_PARTITION_MAX_STOPS", "200")
+)
+LOCAL_TOUR_PARTITION_MAX_STOPS = int(
+    os.environ.get("LOCAL_TOUR_PARTITION_MAX_STOPS", "5000")
+)
+TOUR_PARTITION_MAX_WORKERS = int(os.environ.get("TOUR_PARTITION_MAX_WORKERS", "4"))
+# ズームレベルごとに間引いた配達経路を保持する数
+SIMPLIFIED_ROUTE_CACHE_SIZE = 32
+# 間引いても地図上で見分けがつかないとみなすピクセル数
+ROUTE_SIMPLIFY_PIXEL_TOLERANCE = 1.0
+# presentテーブルから1回に取得する行数
+PRESENT_ITERSIZE = int(os.environ.get("PRESENT_ITERSIZE", "2000"))
+# trueの場合は前回の配達経路に追加されたプレゼントだけを挿入し、巡回順序の計算と経路の取得を差分だけにする
+TOUR_INCREMENTAL = os.environ.get("TOUR_INCREMENTAL", "false").lower() == "true"
+# 全体を計算してから挿入したプレゼント数が、そのときのプレゼント数のこの割合を超えたら全体を計算し直す
+TOUR_INCREMENTAL_MAX_DRIFT = float(os.environ.get("TOUR_INCREMENTAL_MAX_DRIFT", "0.2"))
+# localで使う地点間の移動コスト haversine: 大円距離, here: hereのmatrix routing APIで求めた道路距離
+# hereの場合は求めた道路距離をAuroraに保存し、新しい地点の分だけ求める
+LOCAL_TOUR_TRAVEL_COST = os.environ.get("LOCAL_TOUR_TRAVEL_COST", "haversine")
+# 配達先がこの数より多い区画ではLOCAL_TOUR_TRAVEL_COSTによらず大円距離を使う
+TRAVEL_COST_MAX_POINTS = int(os.environ.get("TRAVEL_COST_MAX_POINTS", "200"))
 
 # Lambdaインスタンスがまだ生きているときに呼び出された場合に
 # DB接続等を使いまわすため大域変数として宣言
 aurora: Aurora = None
 here: HereApi = None
+local_tour_solver: "LocalTourSolver" = None
+# {(<present_fingerprint>, <engine>, <zoom>): [<flexible polyline>]}
+simplified_routes: dict[tuple[str, str, float], list[str]] = {}
+
+
+def prefetch_parameters():
+    """
+    パラメーターをまとめて取得しておく。取得できなかった場合は使うときに改めて取得する
+    """
+    try:
+        app_parameter.prefetch(
+            [
+                APP_API_KEY_PARAMETER,
+                HERE_DEV_API_KEY_PARAMETER,
+                HERE_PLAT_API_KEY_PARAMETER,
+            ]
+        )
+    except Exception as e:
+        logger.warning("prefetch", extra={"error": repr(e)})
+
+
+# コールドスタート時の初期化処理
+# パラメーターの取得と、シークレットの取得からAuroraへの接続までを並列に行う
+startup = app_startup.Startup(__name__)
+startup.add("parameters", prefetch_parameters)
+startup.add("aurora", lambda: Aurora(AURORA_SECRET_NAME))
+
+
+class PresentRegion:
+    def __init__(self, params: dict):
+        """
+        クエリパラメーターで指定された、配達先を絞り込む範囲を持つ。
+          - bbox: <南端の緯度>,<西端の経度>,<北端の緯度>,<東端の経度>
+          - center: <緯度>,<経度>, radius: <半径(m)>
+        どちらも指定されない場合は全ての配達先を対象とする。
+        """
+        self.bbox: list[float] = None
+        self.center: list[float] = None
+        self.radius: float = None
+
+        if params.get("bbox") is not None:
+            self.bbox = [float(v) for v in params["bbox"].split(",")]
+            if len(self.bbox) != 4 or not -90 <= self.bbox[0] <= self.bbox[2] <= 90:
+                raise ValueError(f"invalid bbox: {params['bbox']}")
+
+        if (params.get("center") is None) != (params.get("radius") is None):
+            raise ValueError("center and radius must be specified together")
+        if params.get("center") is not None:
+            self.center = [float(v) for v in params["center"].split(",")]
+            self.radius = float(params["radius"])
+            if (
+                len(self.center) != 2
+                or not -90 <= self.center[0] <= 90
+                or not self.radius > 0
+            ):
+                raise ValueError(
+                    f"invalid center, radius: {params['center']}, {params['radius']}"
+                )
+
+    def where(self) -> tuple[str, tuple]:
+        """
+        presentテーブルを絞り込むWHERE句とパラメーターを返す。
+        NOTE pointはx座標に緯度、y座標に経度を入れている
+        """
+        conditions = []
+        param = ()
+        if self.bbox is not None:
+            # GiSTインデックス(present_point_idx)を使う
+            conditions.append("point && ST_MakeEnvelope(%s, %s, %s, %s)")
+            param += tuple(self.bbox)
+        if self.center is not None:
+            # メートルで距離を測るため経度緯度の順のgeographyにする
+            # 式インデックス(present_geography_idx)を使う
+            conditions.append(
+                "ST_DWithin(ST_SetSRID(ST_FlipCoordinates(point), 4326)::geography, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)"
+            )
+            param += (self.center[1], self.center[0], self.radius)
+
+        if len(conditions) == 0:
+            return "", None
+        return " WHERE " + " AND ".join(conditions), param
+
+    def key(self) -> str:
+        """
+        範囲を表す文字列。配達経路を範囲ごとに保存するために使う。
+        """
+        if self.bbox is None and self.center is None:
+            return "all"
+        return f"bbox={self.bbox};center={self.center};radius={self.radius}"
 
 
 class EventParam:
     def __init__(self, event):
         params = event["queryStringParameters"]
         self.api_key = params["apiKey"]
-        logger.debug("EventParam", extra={"api_key": self.api_key})
+        self.engine = params.get("engine", TOUR_ENGINE)
+        if self.engine not in TOUR_ENGINES:
+            raise ValueError(f"invalid engine: {self.engine}")
+        # 地図のズームレベル。指定された場合は見分けがつかない程度に経路を間引いて返す
+        zoom = params.get("zoom")
+        self.zoom = float(zoom) if zoom is not None else None
+        # 配達先を絞り込む範囲
+        self.region = PresentRegion(params)
+        logger.debug(
+            "EventParam",
+            extra={"api_key": self.api_key, "engine": self.engine, "zoom": self.zoom},
+        )
 
 
 def is_invalid_api_key(param: EventParam) -> bool:
     """
     SSMパラメーターストアのAPIキーと一致しない場合はTrue
     """
-    ssm = boto3.client("ssm")
-    res = ssm.get_parameter(Name=APP_API_KEY_PARAMETER, WithDecryption=True)
-    api_key = res["Parameter"]["Value"]
+    # SSMにアクセスせずメモリに保持している値と比較する
+    api_key = app_parameter.get_parameter(APP_API_KEY_PARAMETER)
 
     if param.api_key == api_key:
         return False
@@ -49,6 +189,7 @@ def is_invalid_api_key(param: EventParam) -> bool:
     return True
 
 
+@app_metrics.timed()
 def get_facility(aurora: Aurora) -> Facility:
     # NOTE 今回は配達拠点(facility)は1つしか登録しない
     query = "SELECT facility_id, facility_name, address, ST_X(point) as latitude, ST_Y(point) as longitude FROM facility limit 1"
@@ -65,31 +206,69 @@ def get_facility(aurora: Aurora) -> Facility:
     )
 
 
-def get_presents(aurora: Aurora) -> list[Present]:
+@app_metrics.timed()
+def get_presents(aurora: Aurora, region: PresentRegion) -> PresentSet:
     """
-    return {<present_id>: <Present>}
+    regionの範囲にあるプレゼント情報を返す
+
+    return <PresentSet>
     """
-    query = "SELECT present_id, present_name, address, ST_X(point) as latitude, ST_Y(point) as longitude FROM present"
-    logger.info("get_presents", extra={"query": query})
-    presents = []
-    for record in aurora.select(query):
-        logger.debug("get_presents", extra={"record": record})
-        present = Present(
-            record["present_id"],
-            record["present_name"],
-            record["latitude"],
-            record["longitude"],
-            record["address"],
-        )
-        presents.append(present)
+    where, param = region.where()
+    query = (
+        "SELECT present_id, present_name, address, ST_X(point) as latitude, ST_Y(point) as longitude FROM present"
+        + where
+    )
+    logger.info("get_presents", extra={"query": query, "param": param})
+
+    # 全件をまとめて取得せずサーバーサイドカーソルで少しずつ取得してPresentSetに追加する
+    presents = PresentSet()
+    for rows in aurora.select_stream(query, param, itersize=PRESENT_ITERSIZE):
+        presents.extend(rows)
+        logger.debug("get_presents", extra={"rows": len(presents)})
+    app_metrics.put("get_presents_rows", len(presents))
     return presents
 
 
+def get_tour_solver(engine: str) -> "PartitionedTourSolver":
+    """
+    巡回順序を計算するインスタンスを返す。tour()で巡回順のidのリストを返す。
+    配達先が多い場合は区画に分けて計算する。
+    """
+    from local_tour import LocalTourSolver
+    from partitioned_tour import PartitionedTourSolver
+
+    if engine == "local":
+        global local_tour_solver
+        if local_tour_solver is None:
+            travel_cost = None
+            if LOCAL_TOUR_TRAVEL_COST == "here":
+                from travel_cost import TravelCostStore
+
+                travel_cost = TravelCostStore(aurora, here.matrix).matrix
+            local_tour_solver = LocalTourSolver(
+                LOCAL_TOUR_TIME_BUDGET_SECONDS,
+                travel_cost,
+                # 出発地を含めた地点数
+                TRAVEL_COST_MAX_POINTS + 1,
+            )
+        return PartitionedTourSolver(
+            local_tour_solver,
+            LOCAL_TOUR_PARTITION_MAX_STOPS,
+            TOUR_PARTITION_MAX_WORKERS,
+        )
+    return PartitionedTourSolver(
+        here, HERE_TOUR_PARTITION_MAX_STOPS, TOUR_PARTITION_MAX_WORKERS
+    )
+
+
+@app_metrics.timed()
 def get_delivery_ordered_present(
-    here: HereApi, facility: Facility, presents: list[Present]
-) -> list[Present]:
+    tour_solver: "PartitionedTourSolver",
+    facility: Facility,
+    presents: PresentSet,
+) -> PresentSet:
     """
-    return [<present_id>]
+    return 巡回順に並べ替えた<PresentSet>
     """
     # 次のクリスマスイブに配達するので日付を算出
     now = datetime.now()
@@ -111,46 +290,278 @@ def get_delivery_ordered_present(
     )
 
     # 配達先リストを作成
-    delivery_stops: list[TourStop] = []
-    for present in presents:
-        delivery_stops.append(TourStop(present.present_id, present.address.point))
+    delivery_stops: list[TourStop] = [
+        TourStop(present_id, Point(latitude, longitude))
+        for present_id, latitude, longitude in zip(
+            presents.present_ids, presents.latitudes, presents.longitudes
+        )
+    ]
 
     # 配達先を巡回する順序を取得
     # 巡回順にソートされたpresent_idのリストが返る
-    delivery_orderd_present_ids: list[int] = here.tour(
+    delivery_orderd_present_ids: list[int] = tour_solver.tour(
         facility.address.point, delivery_stops, delivery_start_time, delivery_end_time
     )
-    logger.debug(
+    app_logging.log_payloads(
+        logger,
+        logging.DEBUG,
         "get_delivery_ordered_present",
-        extra={"delivery_order": delivery_orderd_present_ids},
+        {"delivery_order": delivery_orderd_present_ids},
     )
 
-    # presentのpointをサーチするため辞書に変換
-    present_dict = {present.present_id: present for present in presents}
+    # 巡回順に並べ替える
+    return presents.reorder(delivery_orderd_present_ids)
+
+
+def solve_delivery_route(
+    tour_engine: str, facility: Facility, presents: PresentSet
+) -> tuple[PresentSet, list[str], int, int]:
+    """
+    全てのプレゼントの巡回順序を計算し、配達先間の配達経路を取得する
+
+    return (<巡回順に並べ替えたPresentSet>, [<flexible polyline>],
+            <全体を計算したときのプレゼント数>, <その後に挿入したプレゼント数>)
+    """
+    # 配達順序にソートされたプレゼント情報を取得
+    delivery_ordered_presents: PresentSet = get_delivery_ordered_present(
+        get_tour_solver(tour_engine), facility, presents
+    )
 
-    # 巡回順にソートしたPresentのリストを作成
-    presents: list[Present] = [
-        present_dict[present_id] for present_id in delivery_orderd_present_ids
+    # 配達先間の配達経路を取得
+    ordered_points = [
+        Point(latitude, longitude)
+        for latitude, longitude in zip(
+            delivery_ordered_presents.latitudes,
+            delivery_ordered_presents.longitudes,
+        )
     ]
+    route_flex_polylines: list[str] = here.route(
+        facility.address.point, facility.address.point, ordered_points
+    )
+    return delivery_ordered_presents, route_flex_polylines, len(presents), 0
 
-    return presents
 
+def get_present_fingerprint_prefix(facility: Facility, region: PresentRegion) -> str:
+    """
+    present_fingerprintのうち配達拠点と範囲を表す部分。同じ範囲の配達経路を探すために使う
+    NOTE 配達拠点が移動した場合は保存済みの配達経路を使わないよう位置も含める
+    """
+    point = facility.address.point
+    return f"{facility.facility_id}@{point.latitude},{point.longitude}:{region.key()}:"
+
+
+@app_metrics.timed()
+def get_present_fingerprint(
+    aurora: Aurora, facility: Facility, region: PresentRegion
+) -> str:
+    """
+    regionの範囲にあるpresentと配達拠点の状態を表す文字列を返す。
+    presentが追加、削除、移動されると値が変わる。
+    NOTE present_idはSERIALなので追加されると最大値が、削除されると件数が変わる
+         移動はpresent_idと位置のハッシュの合計で検出する。合計なので行の順序によらない
+    """
+    where, param = region.where()
+    query = (
+        "SELECT count(*) as present_count, coalesce(max(present_id), 0) as max_present_id, coalesce(sum(hashtext(present_id || ':' || ST_X(point) || ':' || ST_Y(point))), 0) as present_hash FROM present"
+        + where
+    )
+    # 呼び出しごとに実行するためプリペアドステートメントにする
+    record = aurora.select(query, param, prepare=True)[0]
+    fingerprint = f"{get_present_fingerprint_prefix(facility, region)}{record['present_count']}:{record['max_present_id']}:{record['present_hash']}"
+    logger.info("get_present_fingerprint", extra={"fingerprint": fingerprint})
+    return fingerprint
+
+
+@app_metrics.timed()
+def get_delivery_route(
+    aurora: Aurora, facility: Facility, present_fingerprint: str, tour_engine: str
+) -> tuple[list[int], list[str]]:
+    """
+    同じプレゼント情報から計算済みの配達経路がある場合はそれを返す。無い場合はNone
+
+    return (<巡回順のpresent_idのリスト>, [<flexible polyline>])
+    """
+    query = "SELECT delivery_ordered_present_ids, route_flex_polylines FROM delivery_route WHERE facility_id = %s AND present_fingerprint = %s AND tour_engine = %s ORDER BY id DESC LIMIT 1"
+    rows = aurora.select(
+        query, (facility.facility_id, present_fingerprint, tour_engine), prepare=True
+    )
+    if len(rows) == 0:
+        app_metrics.put("delivery_route_cache.miss", 1)
+        return None
+
+    record = rows[0]
+    app_metrics.put("delivery_route_cache.hit", 1)
+    logger.info("get_delivery_route", extra={"value": "cache hit"})
+    # flexpolylineはカンマで区切って保存している
+    route_flex_polylines = record["route_flex_polylines"].split(",")
+    return record["delivery_ordered_present_ids"], route_flex_polylines
+
+
+@app_metrics.timed()
+def get_latest_delivery_route(
+    aurora: Aurora, facility: Facility, region: PresentRegion, tour_engine: str
+) -> tuple[list[int], list[str], int, int]:
+    """
+    regionの範囲について最後に保存した配達経路を返す。無い場合はNone
 
+    return (<巡回順のpresent_idのリスト>, [<flexible polyline>],
+            <全体を計算したときのプレゼント数>, <その後に挿入したプレゼント数>)
+    """
+    query = "SELECT delivery_ordered_present_ids, route_flex_polylines, solved_present_count, inserted_present_count FROM delivery_route WHERE facility_id = %s AND tour_engine = %s AND starts_with(present_fingerprint, %s) ORDER BY id DESC LIMIT 1"
+    rows = aurora.select(
+        query,
+        (
+            facility.facility_id,
+            tour_engine,
+            get_present_fingerprint_prefix(facility, region),
+        ),
+        prepare=True,
+    )
+    # NOTE solved_present_countが無いものは差分の基にしない
+    if len(rows) == 0 or rows[0]["solved_present_count"] is None:
+        return None
+
+    record = rows[0]
+    return (
+        record["delivery_ordered_present_ids"],
+        record["route_flex_polylines"].split(","),
+        record["solved_present_count"],
+        record["inserted_present_count"] or 0,
+    )
+
+
+@app_metrics.timed()
+def update_delivery_route(
+    here: HereApi,
+    facility: Facility,
+    presents: PresentSet,
+    latest_delivery_route: tuple[list[int], list[str], int, int],
+) -> tuple[PresentSet, list[str], int, int]:
+    """
+    保存済みの配達経路に、その後に追加されたプレゼントを最も距離が増えない位置に挿入する。
+    削除されたプレゼントは巡回順から除く。
+    経路は巡回順が変わった区間だけ取得し直し、他は保存済みのものを使いまわす。
+
+    全体を計算してから挿入したプレゼント数が、そのときのプレゼント数のTOUR_INCREMENTAL_MAX_DRIFTの割合を超える場合は
+    巡回順序が悪くなっている可能性があるので、全体を計算し直すようNoneを返す。
+
+    NOTE 挿入する位置は大円距離で決める
+
+    return (<巡回順に並べ替えたPresentSet>, [<flexible polyline>],
+            <全体を計算したときのプレゼント数>, <その後に挿入したプレゼント数>)
+    """
+    from incremental_tour import insert_stops, reusable_legs
+
+    ordered_present_ids, route_flex_polylines, solved_count, inserted_count = (
+        latest_delivery_route
+    )
+    stored_present_ids = set(ordered_present_ids)
+    kept_present_ids = [
+        present_id for present_id in ordered_present_ids if present_id in presents
+    ]
+    new_present_ids = [
+        present_id
+        for present_id in presents.present_ids
+        if present_id not in stored_present_ids
+    ]
+    inserted_count += len(new_present_ids)
+    drift = inserted_count / max(solved_count, 1)
+    logger.info(
+        "update_delivery_route",
+        extra={
+            "kept": len(kept_present_ids),
+            "removed": len(ordered_present_ids) - len(kept_present_ids),
+            "new": len(new_present_ids),
+            "drift": drift,
+        },
+    )
+    if (
+        len(kept_present_ids) == 0
+        or drift > TOUR_INCREMENTAL_MAX_DRIFT
+        or len(route_flex_polylines) != len(ordered_present_ids) + 1
+    ):
+        return None
+
+    order = insert_stops(
+        facility.address.point,
+        [presents.point(presents.row(present_id)) for present_id in kept_present_ids],
+        [presents.point(presents.row(present_id)) for present_id in new_present_ids],
+    )
+    candidate_present_ids = kept_present_ids + new_present_ids
+    delivery_ordered_presents = presents.reorder(
+        [candidate_present_ids[index] for index in order]
+    )
+
+    # 巡回順が変わった区間が続く範囲ごとに経路を取得する
+    # NOTE 範囲の間が近い場合は、1回のリクエストで取得できる区間の数まで間の区間も含めてまとめる
+    legs, runs = reusable_legs(
+        ordered_present_ids,
+        route_flex_polylines,
+        delivery_ordered_presents.present_ids,
+        ROUTE_MAX_VIAS + 1,
+    )
+    points = (
+        [facility.address.point]
+        + [
+            delivery_ordered_presents.point(row)
+            for row in range(len(delivery_ordered_presents))
+        ]
+        + [facility.address.point]
+    )
+    app_metrics.put(
+        "update_delivery_route_legs", sum(last - first + 1 for first, last in runs)
+    )
+    if len(runs) > 0:
+        with ThreadPoolExecutor(
+            max_workers=min(TOUR_PARTITION_MAX_WORKERS, len(runs))
+        ) as executor:
+            results = executor.map(
+                lambda run: here.route(
+                    points[run[0]], points[run[1] + 1], points[run[0] + 1 : run[1] + 1]
+                ),
+                runs,
+            )
+            for (first, last), flex_polylines in zip(runs, results):
+                if len(flex_polylines) != last - first + 1:
+                    logger.warning(
+                        "update_delivery_route",
+                        extra={"value": "unexpected number of route sections"},
+                    )
+                    return None
+                legs[first : last + 1] = flex_polylines
+    return delivery_ordered_presents, legs, solved_count, inserted_count
+
+
+@app_metrics.timed()
 def insert_delivery_route(
     aurora: Aurora,
     facility: Facility,
-    delivery_ordered_presents: list[Present],
+    delivery_ordered_presents: PresentSet,
     route_flex_polylines: list[str],
+    present_fingerprint: str,
+    tour_engine: str,
+    solved_present_count: int,
+    inserted_present_count: int,
 ):
+    """
+    solved_present_count: 全体の巡回順序を計算したときのプレゼント数
+    inserted_present_count: その後に差分で挿入したプレゼント数
+    """
     # delivery_routeテーブルに配達順序を入れるためlinestringの文字列に変換
-    linestring_strs = []
-    for present in delivery_ordered_presents:
-        linestring_strs.append(
-            f"{present.address.point.latitude} {present.address.point.longitude}"
+    linestring_strs = [
+        f"{latitude} {longitude}"
+        for latitude, longitude in zip(
+            delivery_ordered_presents.latitudes, delivery_ordered_presents.longitudes
         )
+    ]
     delivery_linestring = f"LINESTRING ({', '.join(linestring_strs)})"
 
-    query = "INSERT INTO delivery_route (facility_id, delivery_ordered_point, route_flex_polylines) VALUES (%s, ST_GeomFromText(%s), %s)"
+    # 経路の形状をPostGISで扱えるようにgeometryとしても保存する
+    route_multilinestring = flexible_polyline.to_multilinestring_wkt(
+        route_flex_polylines
+    )
+
+    query = "INSERT INTO delivery_route (facility_id, delivery_ordered_point, route_flex_polylines, present_fingerprint, delivery_ordered_present_ids, tour_engine, route_geom, solved_present_count, inserted_present_count) VALUES (%s, ST_GeomFromText(%s), %s, %s, %s, %s, ST_GeomFromText(%s), %s, %s)"
 
     param = (
         facility.facility_id,
@@ -158,18 +569,82 @@ def insert_delivery_route(
         # flexpolylineはカンマ使われないのでカンマで区切って入れる
         # ref: https://github.com/heremaps/flexible-polyline
         ",".join(route_flex_polylines),
+        present_fingerprint,
+        delivery_ordered_presents.present_ids,
+        tour_engine,
+        route_multilinestring,
+        solved_present_count,
+        inserted_present_count,
     )
 
-    logger.info("insert_delivery_route", extra={"query": query, "param": param})
+    app_metrics.put(
+        "insert_delivery_route_bytes", len(param[1]) + len(param[2]), app_metrics.BYTES
+    )
+    app_logging.log_payloads(
+        logger,
+        logging.INFO,
+        "insert_delivery_route",
+        {"param": param},
+        extra={"query": query},
+    )
     aurora.update_commit(query, param)
 
 
+def simplify_route(
+    route_flex_polylines: list[str],
+    facility: Facility,
+    zoom: float,
+    cache_key: tuple[str, str],
+) -> list[str]:
+    """
+    ズームレベルzoomの地図上で見分けがつかない程度に配達経路の点を間引く。
+    同じ配達経路とズームレベルの結果はLambdaインスタンス内で使いまわす。
+    """
+    key = (*cache_key, zoom)
+    if key in simplified_routes:
+        app_metrics.put("simplified_route_cache.hit", 1)
+        return simplified_routes[key]
+    app_metrics.put("simplified_route_cache.miss", 1)
+
+    tolerance = flexible_polyline.zoom_tolerance_meters(
+        zoom, facility.address.point.latitude, ROUTE_SIMPLIFY_PIXEL_TOLERANCE
+    )
+    simplified = [
+        flexible_polyline.simplify_encoded(flex_polyline, tolerance)
+        for flex_polyline in route_flex_polylines
+    ]
+    logger.info(
+        "simplify_route",
+        extra={
+            "zoom": zoom,
+            "before": sum(len(p) for p in route_flex_polylines),
+            "after": sum(len(p) for p in simplified),
+        },
+    )
+
+    # 古いものから捨てる
+    if len(simplified_routes) >= SIMPLIFIED_ROUTE_CACHE_SIZE:
+        del simplified_routes[next(iter(simplified_routes))]
+    simplified_routes[key] = simplified
+    return simplified
+
+
+@app_metrics.handler
 def lambda_handler(event, context):
     logger.debug(event)
     logger.debug(context)
 
     # イベントから必要なパラメーターを取得
-    param: EventParam = EventParam(event)
+    # NOTE パラメーターの誤りはクライアントの誤りなので400を返す
+    try:
+        param: EventParam = EventParam(event)
+    except (ValueError, KeyError, AttributeError, TypeError) as e:
+        logger.info("EventParam", extra={"error": repr(e)})
+        return {"statusCode": 400, "body": {"message": f"invalid parameter: {e}"}}
+
+    # パラメーターの取得を待つ
+    # NOTE 初期化フェーズで済ませていない場合はAuroraへの接続もあわせて開始する
+    startup.get("parameters")
 
     # APIキーの検証
     if is_invalid_api_key(param):
@@ -178,35 +653,86 @@ def lambda_handler(event, context):
     # Aurora接続用インスタンスが無い場合は作成
     global aurora
     if aurora is None:
-        aurora = Aurora(AURORA_SECRET_NAME)
-
-    # Here API用インスタンスが無い場合は作成
-    global here
-    if here is None:
-        here = HereApi(HERE_DEV_API_KEY_PARAMETER, HERE_PLAT_API_KEY_PARAMETER)
+        aurora = startup.get("aurora")
 
     # 配達に出発する拠点を取得
     # NOTE 今回は拠点は1つだけの想定
     facility: Facility = get_facility(aurora)
 
+    # プレゼント情報が前回から変わったか判定するための値を取得
+    # NOTE プレゼント情報の取得より先に行い、取得中に追加されたものを見逃さないようにする
+    present_fingerprint = get_present_fingerprint(aurora, facility, param.region)
+
     # プレゼント情報を取得
-    presents: list[Present] = get_presents(aurora)
+    presents: PresentSet = get_presents(aurora, param.region)
 
-    # 配達順序にソートされたプレゼント情報を取得
-    delivery_ordered_presents: list[Present] = get_delivery_ordered_present(
-        here, facility, presents
+    delivery_route = get_delivery_route(
+        aurora, facility, present_fingerprint, param.engine
     )
+    if delivery_route is not None:
+        # プレゼント情報が変わっていない場合は保存済みの配達経路を返す
+        delivery_ordered_present_ids, route_flex_polylines = delivery_route
+        delivery_ordered_presents: PresentSet = presents.reorder(
+            [
+                present_id
+                for present_id in delivery_ordered_present_ids
+                if present_id in presents
+            ]
+        )
+    else:
+        # Here API用インスタンスが無い場合は作成
+        global here
+        if here is None:
+            here = HereApi(HERE_DEV_API_KEY_PARAMETER, HERE_PLAT_API_KEY_PARAMETER)
+
+        # 前回の配達経路がある場合は、追加されたプレゼントだけを挿入する
+        updated_delivery_route = None
+        if TOUR_INCREMENTAL:
+            latest_delivery_route = get_latest_delivery_route(
+                aurora, facility, param.region, param.engine
+            )
+            if latest_delivery_route is not None:
+                updated_delivery_route = update_delivery_route(
+                    here, facility, presents, latest_delivery_route
+                )
+
+        if updated_delivery_route is None:
+            # 差分で更新できない場合は全体を計算する
+            app_metrics.put("delivery_route_update.full", 1)
+            updated_delivery_route = solve_delivery_route(
+                param.engine, facility, presents
+            )
+        else:
+            app_metrics.put("delivery_route_update.incremental", 1)
+        (
+            delivery_ordered_presents,
+            route_flex_polylines,
+            solved_present_count,
+            inserted_present_count,
+        ) = updated_delivery_route
+
+        # 配達経路情報を保存
+        insert_delivery_route(
+            aurora,
+            facility,
+            delivery_ordered_presents,
+            route_flex_polylines,
+            present_fingerprint,
+            param.engine,
+            solved_present_count,
+            inserted_present_count,
+        )
 
-    # 配達先間の配達経路を取得
-    ordered_points = [present.address.point for present in delivery_ordered_presents]
-    route_flex_polylines: list[str] = here.route(
-        facility.address.point, facility.address.point, ordered_points
-    )
+    # ズームレベルが指定された場合は経路を間引いて返す
+    if param.zoom is not None:
+        route_flex_polylines = simplify_route(
+            route_flex_polylines,
+            facility,
+            param.zoom,
+            (present_fingerprint, param.engine),
+        )
 
-    # 配達経路情報を保存
-    insert_delivery_route(
-        aurora, facility, delivery_ordered_presents, route_flex_polylines
-    )
+    logger.info("aurora", extra=aurora.stats())
 
     # クライアントに情報を作成
     facility = {
@@ -220,11 +746,16 @@ def lambda_handler(event, context):
 
     presents = [
         {
-            "name": present.present_name,
-            "address": present.address.address,
-            "point": [present.address.point.latitude, present.address.point.longitude],
+            "name": present_name,
+            "address": address,
+            "point": [latitude, longitude],
         }
-        for present in delivery_ordered_presents
+        for present_name, address, latitude, longitude in zip(
+            delivery_ordered_presents.present_names,
+            delivery_ordered_presents.addresses,
+            delivery_ordered_presents.latitudes,
+            delivery_ordered_presents.longitudes,
+        )
     ]
 
     # クライアントに配達情報を返す
@@ -236,3 +767,8 @@ def lambda_handler(event, context):
             "route_flex_polylines": route_flex_polylines,
         },
     }
+
+
+# STARTUP_PREINITがtrueの場合は初期化フェーズで済ませておき、
+# 配達経路を計算する場合に使うモジュールも読み込んでおく
+startup.preinit(["partitioned_tour", "requests"])
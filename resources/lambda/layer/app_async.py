@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+import app_const
+
+# aiohttpは非同期版のハンドラーでしか使わないので、同期版のコールドスタートで読み込まない
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# 非同期版に対応していないライブラリ(boto3など)を呼び出すスレッド数
+# NOTE スレッドはネットワークの待ち合わせにしか使わないのでCPU数より大きくてよい
+ASYNC_BLOCKING_WORKERS = int(os.environ.get("ASYNC_BLOCKING_WORKERS", "64"))
+
+# 全ホスト合計とホストごとに同時に張るHTTPコネクション数
+ASYNC_HTTP_LIMIT = int(os.environ.get("ASYNC_HTTP_LIMIT", "100"))
+ASYNC_HTTP_LIMIT_PER_HOST = int(os.environ.get("ASYNC_HTTP_LIMIT_PER_HOST", "50"))
+
+# Lambdaインスタンスが生きている間はイベントループを使いまわす
+# NOTE asyncio.runは呼び出しごとにループを閉じるため、ループに紐づくHTTPセッションや
+#      DBのコネクションプールを次の呼び出しで使いまわせない
+_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop = None
+_executor: ThreadPoolExecutor = None
+_http_session: "aiohttp.ClientSession" = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(_loop)
+        return _loop
+
+
+def run(coro):
+    """
+    Lambdaインスタンスで共有するイベントループでコルーチンを完了まで実行する
+    """
+    return get_event_loop().run_until_complete(coro)
+
+
+async def to_thread(fn, *args, **kwargs):
+    """
+    ブロックする関数をスレッドで実行し、完了を待ち合わせる
+    asyncio.to_threadの既定のスレッド数(CPU数+4)では足りないため専用のスレッドプールを使う
+    """
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, lambda: fn(*args, **kwargs)
+    )
+
+
+def get_http_session() -> "aiohttp.ClientSession":
+    """
+    イベントループ内で共有するaiohttpのClientSessionを返す。
+    keep-aliveによりTCP接続とTLSハンドシェイクを使いまわす。
+    """
+    import aiohttp
+
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=ASYNC_HTTP_LIMIT,
+            limit_per_host=ASYNC_HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=300,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+        logger.debug("get_http_session", extra={"value": "create session"})
+    return _http_session
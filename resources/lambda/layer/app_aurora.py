@@ -1,21 +1,220 @@
+import hashlib
+import itertools
 import logging
+import os
+import re
 import app_const
-import boto3
-import json
-import psycopg2.pool
+import app_logging
+import app_parameter
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+import psycopg2.extensions
 from psycopg2.extras import DictCursor
 
 
 logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
 
+# サーバーサイドカーソルから1回に取得する行数の既定値
+DEFAULT_ITERSIZE = 2000
+# プールから取り出すときに、この秒数以上使われていなかったコネクションは生きているか確かめる
+# NOTE Auroraのフェイルオーバーやアイドルタイムアウトで切れたコネクションを使わないようにする
+AURORA_POOL_CHECK_IDLE_SECONDS = float(
+    os.environ.get("AURORA_POOL_CHECK_IDLE_SECONDS", "30")
+)
+
+
+class AuroraConnection(psycopg2.extensions.connection):
+    """
+    ConnectionPoolで管理するコネクション。最後に使った時刻と、このセッションで準備済みのステートメント名を持つ
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+        self.prepared: set[str] = set()
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        max_connections: int,
+        min_connections: int = 1,
+        check_idle_seconds: float = AURORA_POOL_CHECK_IDLE_SECONDS,
+        **conn_kwargs,
+    ):
+        """
+        複数スレッドから使えるコネクションプール。
+          - 空きが無い場合はコネクションが返されるまで待つ
+          - 返されたコネクションは数にかかわらず閉じずに使いまわす
+          - 取り出すときに切れているコネクションは捨てて接続し直す
+
+        conn_kwargs: psycopg2.connectの引数
+        """
+        self.max_connections = max_connections
+        self.check_idle_seconds = check_idle_seconds
+        self._conn_kwargs = conn_kwargs
+        self._cond = threading.Condition()
+        # 空いているコネクション。最後に返されたものから使う
+        self._idle: list[AuroraConnection] = []
+        # 作成済みのコネクション数(使用中と空きの合計)
+        self._size = 0
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "connects": 0,
+            "reconnects": 0,
+            "discards": 0,
+        }
+        for _ in range(min(min_connections, max_connections)):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self) -> AuroraConnection:
+        conn = psycopg2.connect(
+            connection_factory=AuroraConnection, **self._conn_kwargs
+        )
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _is_alive(self, conn: AuroraConnection) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.check_idle_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning("connection is not alive", extra={"error": repr(e)})
+            return False
+
+    def _close(self, conn: AuroraConnection):
+        try:
+            conn.close()
+        except psycopg2.Error as e:
+            logger.warning("close", extra={"error": repr(e)})
+
+    def getconn(self) -> AuroraConnection:
+        """
+        コネクションを取り出す。使い終わったら必ずputconnで返す
+        """
+        start = time.perf_counter()
+        with self._cond:
+            waited = False
+            while len(self._idle) == 0 and self._size >= self.max_connections:
+                waited = True
+                self._cond.wait()
+            if len(self._idle) > 0:
+                conn = self._idle.pop()
+            else:
+                # 空きが無く上限に達していない場合は新しく接続する
+                conn = None
+                self._size += 1
+            wait_seconds = time.perf_counter() - start
+            self._stats["checkouts"] += 1
+            self._stats["waits"] += int(waited)
+            self._stats["wait_seconds"] += wait_seconds
+            self._stats["max_wait_seconds"] = max(
+                self._stats["max_wait_seconds"], wait_seconds
+            )
+
+        try:
+            if conn is not None and not self._is_alive(conn):
+                self._close(conn)
+                with self._cond:
+                    self._stats["reconnects"] += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            # 確保した分を空けて待っているスレッドに知らせる
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn: AuroraConnection, close: bool = False):
+        """
+        コネクションを返す。切れている場合とcloseがTrueの場合は閉じて捨てる
+        """
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # トランザクションを終えていない場合は取り消してから返す
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        discard = close or bool(conn.closed)
+        if discard:
+            self._close(conn)
+        else:
+            conn.last_used = time.monotonic()
+        with self._cond:
+            if discard:
+                self._size -= 1
+                self._stats["discards"] += 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        """
+        コネクション数と、取り出した回数、空きを待った回数と時間(秒)、接続し直した回数など
+        """
+        with self._cond:
+            return {
+                "max_connections": self.max_connections,
+                "connections": self._size,
+                "in_use": self._size - len(self._idle),
+                **self._stats,
+                "wait_seconds": round(self._stats["wait_seconds"], 3),
+                "max_wait_seconds": round(self._stats["max_wait_seconds"], 3),
+            }
+
+
+def _statement_name(query: str) -> str:
+    """
+    クエリからプリペアドステートメントの名前を作る。同じクエリは同じ名前になる
+    """
+    return "stmt_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+
+
+def _to_positional(query: str) -> str:
+    """
+    %sのプレースホルダーをPREPAREで使う$1, $2, ...に置き換える
+    """
+    numbers = itertools.count(1)
+    return re.sub(r"%s", lambda _: f"${next(numbers)}", query)
+
 
 class Aurora:
-    def __init__(self, secret_name: str):
+    def __init__(
+        self,
+        secret_name: str,
+        max_connections: int = 1,
+        min_connections: int = 1,
+        check_idle_seconds: float = AURORA_POOL_CHECK_IDLE_SECONDS,
+    ):
+        """
+        max_connections: 同時に使うコネクション数。複数スレッドから使う場合はスレッド数に合わせる。
+        min_connections: 初期化時に接続しておくコネクション数
+        check_idle_seconds: この秒数以上使われていなかったコネクションは使う前に生きているか確かめる
+        """
         logger.debug("init Aurora")
         logger.debug("psycopg2.apilevel: " + psycopg2.apilevel)
-        secretsmanager = boto3.client("secretsmanager")
-        res = secretsmanager.get_secret_value(SecretId=secret_name)
-        aurora_secret = json.loads(res["SecretString"])
+        aurora_secret = app_parameter.get_secret(secret_name)
         logger.debug("aurora_secret", extra=aurora_secret)
         password = aurora_secret["password"]
         port = aurora_secret["port"]
@@ -23,9 +222,10 @@ class Aurora:
         username = aurora_secret["username"]
         database = "postgres"
 
-        self.conn_pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=1,
+        self.conn_pool = ConnectionPool(
+            max_connections,
+            min_connections,
+            check_idle_seconds,
             database=database,
             user=username,
             password=password,
@@ -33,39 +233,153 @@ class Aurora:
             port=port,
             connect_timeout=60,
         )
+        self._prepared_stats = {"prepares": 0, "prepared_executes": 0}
+        self._stats_lock = threading.Lock()
+
+    def _getconn(self) -> AuroraConnection:
+        return self.conn_pool.getconn()
+
+    def _putconn(self, conn: AuroraConnection):
+        self.conn_pool.putconn(conn)
+
+    def _execute(
+        self,
+        conn: AuroraConnection,
+        cur,
+        query: str,
+        param: tuple = None,
+        prepare: bool = False,
+    ):
+        """
+        prepareがTrueの場合はコネクションごとに1度だけPREPAREし、以降はEXECUTEで解析を省く。
+        NOTE %sは文字列リテラルの中では使えない。例: 'POINT(%s %s)'ではなくST_MakePoint(%s, %s)とする
+        """
+        if not prepare:
+            if param is None:
+                cur.execute(query)
+            else:
+                cur.execute(query, param)
+            return
+
+        name = _statement_name(query)
+        prepared = name in conn.prepared
+        if not prepared:
+            # NOTE PREPAREはトランザクションを取り消しても残る
+            cur.execute(f"PREPARE {name} AS {_to_positional(query)}")
+            conn.prepared.add(name)
+        if param is None or len(param) == 0:
+            cur.execute(f"EXECUTE {name}")
+        else:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(param))})", param)
+        with self._stats_lock:
+            self._prepared_stats["prepared_executes"] += 1
+            self._prepared_stats["prepares"] += int(not prepared)
+
+    def stats(self) -> dict:
+        """
+        コネクションプールとプリペアドステートメントの統計
+        """
+        with self._stats_lock:
+            prepared_stats = dict(self._prepared_stats)
+        return {**self.conn_pool.stats(), **prepared_stats}
 
     # insert, update, delete
-    def update_commit(self, query: str, param: tuple = None):
-        conn = self.conn_pool.getconn()
+    def update_commit(self, query: str, param: tuple = None, prepare: bool = False):
+        """
+        prepare: Trueの場合はプリペアドステートメントとして実行する。繰り返し実行するクエリに使う
+        """
+        conn = self._getconn()
         try:
             with conn.cursor() as cur:
-                if param is None:
-                    cur.execute(query)
-                else:
-                    cur.execute(query, param)
+                self._execute(conn, cur, query, param, prepare)
             conn.commit()
-            self.conn_pool.putconn(conn)
-            logger.debug("update_commit", extra={"query": query, "param": param})
+            app_logging.log_payloads(
+                logger,
+                logging.DEBUG,
+                "update_commit",
+                {"param": param},
+                extra={"query": query},
+            )
         except Exception as e:
-            self.conn_pool.putconn(conn)
             logger.error("update_commit", extra={"error": repr(e)})
+            self._rollback(conn)
             raise
+        finally:
+            self._putconn(conn)
 
     # select
-    def select(self, query: str, param: tuple = None) -> list[tuple]:
-        conn = self.conn_pool.getconn()
+    def select(
+        self, query: str, param: tuple = None, prepare: bool = False
+    ) -> list[tuple]:
+        """
+        prepare: update_commitと同じ
+        """
+        conn = self._getconn()
         try:
             rows = None
             with conn.cursor(cursor_factory=DictCursor) as cur:
+                self._execute(conn, cur, query, param, prepare)
+                rows = cur.fetchall()
+            app_logging.log_payloads(
+                logger,
+                logging.DEBUG,
+                "select",
+                {"param": param},
+                extra={"query": query},
+            )
+            return rows
+        except Exception as e:
+            logger.error("select", extra={"error": repr(e)})
+            self._rollback(conn)
+            raise
+        finally:
+            self._putconn(conn)
+
+    # 大きな結果を少しずつ取得するselect
+    def select_stream(
+        self, query: str, param: tuple = None, itersize: int = DEFAULT_ITERSIZE
+    ) -> Iterator[list[tuple]]:
+        """
+        サーバーサイドカーソルでitersize行ずつ取得し、tupleのリストとして順に返す。
+        全ての行をメモリに載せないため、使用するメモリはitersizeに比例する。
+
+        NOTE 全て取得し終わるか、ジェネレーターが閉じられるまでコネクションを専有する
+        NOTE サーバーサイドカーソルではEXECUTEを使えないためプリペアドステートメントには対応しない
+        """
+        conn = self._getconn()
+        try:
+            # 名前付きカーソルはサーバーサイドカーソルになる
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+                cur.itersize = itersize
                 if param is None:
                     cur.execute(query)
                 else:
                     cur.execute(query, param)
-                rows = cur.fetchall()
-            self.conn_pool.putconn(conn)
-            logger.debug("select", extra={"query": query, "param": param})
-            return rows
+                rows = 0
+                while True:
+                    batch = cur.fetchmany(itersize)
+                    if len(batch) == 0:
+                        break
+                    rows += len(batch)
+                    yield batch
+            # カーソルを閉じてトランザクションを終了する
+            conn.commit()
+            logger.debug("select_stream", extra={"query": query, "rows": rows})
+        except GeneratorExit:
+            self._rollback(conn)
+            raise
         except Exception as e:
-            self.conn_pool.putconn(conn)
-            logger.error("select", extra={"error": repr(e)})
+            logger.error("select_stream", extra={"error": repr(e)})
+            self._rollback(conn)
             raise
+        finally:
+            self._putconn(conn)
+
+    def _rollback(self, conn):
+        """
+        失敗したトランザクションを残したままプールに戻さないようにする
+        """
+        try:
+            conn.rollback()
+        except Exception as e:
+            logger.warning("rollback", extra={"error": repr(e)})
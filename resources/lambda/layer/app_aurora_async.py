@@ -0,0 +1,102 @@
+import logging
+import app_const
+import app_logging
+import app_parameter
+from psycopg import AsyncClientCursor
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+
+class AsyncAurora:
+    def __init__(self, secret_name: str, max_connections: int = 1):
+        """
+        app_aurora.Auroraの非同期版。同じクエリ(%sのプレースホルダー)をそのまま使える。
+        max_connections: 同時に使うコネクション数。コネクションが空くまではコルーチンが待つだけなので
+                         同時に処理するレコード数より小さくてよい。
+
+        NOTE プールはイベントループに紐づくため、作成したループでだけ使う。使う前にopenを呼ぶ。
+        """
+        logger.debug("init AsyncAurora")
+        aurora_secret = app_parameter.get_secret(secret_name)
+        conninfo = {
+            "dbname": "postgres",
+            "user": aurora_secret["username"],
+            "password": aurora_secret["password"],
+            "host": aurora_secret["host"],
+            "port": aurora_secret["port"],
+            "connect_timeout": 60,
+            # psycopg2と同じくクライアント側でパラメーターを埋め込む
+            # NOTE サーバー側のバインドでは'POINT(%s %s)'のような文字列内のプレースホルダーが使えない
+            "cursor_factory": AsyncClientCursor,
+            "row_factory": dict_row,
+        }
+        self.conn_pool = AsyncConnectionPool(
+            min_size=1,
+            max_size=max_connections,
+            kwargs=conninfo,
+            open=False,
+        )
+
+    async def open(self, timeout: float = 30.0):
+        """
+        timeout秒待っても接続できない場合はPoolTimeout。もう一度呼び出すと接続を待ち直す
+        """
+        await self.conn_pool.open(wait=True, timeout=timeout)
+
+    # insert, update, delete
+    async def update_commit(self, query: str, param: tuple = None):
+        # connection()はブロックを抜けるときにコミットし、例外の場合はロールバックする
+        try:
+            async with self.conn_pool.connection() as conn:
+                await conn.execute(query, param)
+            app_logging.log_payloads(
+                logger,
+                logging.DEBUG,
+                "update_commit",
+                {"param": param},
+                extra={"query": query},
+            )
+        except Exception as e:
+            logger.error("update_commit", extra={"error": repr(e)})
+            raise
+
+    # 複数行のinsertを1つのステートメント、1回のコミットで行う
+    async def insert_many(self, query: str, params: list[tuple], template: str = None):
+        """
+        query: VALUES句を`VALUES %s`とした文。
+        template: 1行分の値のテンプレート。例: `(%s, ST_GeomFromText('POINT(%s %s)'))`
+        """
+        if len(params) == 0:
+            return
+
+        if template is None:
+            template = "(" + ", ".join(["%s"] * len(params[0])) + ")"
+        values = ", ".join([template] * len(params))
+        flat_params = tuple(value for param in params for value in param)
+        try:
+            async with self.conn_pool.connection() as conn:
+                await conn.execute(query.replace("%s", values, 1), flat_params)
+            logger.debug("insert_many", extra={"query": query, "rows": len(params)})
+        except Exception as e:
+            logger.error("insert_many", extra={"error": repr(e)})
+            raise
+
+    # select
+    async def select(self, query: str, param: tuple = None) -> list[dict]:
+        try:
+            async with self.conn_pool.connection() as conn:
+                cur = await conn.execute(query, param)
+                rows = await cur.fetchall()
+            app_logging.log_payloads(
+                logger,
+                logging.DEBUG,
+                "select",
+                {"param": param},
+                extra={"query": query},
+            )
+            return rows
+        except Exception as e:
+            logger.error("select", extra={"error": repr(e)})
+            raise
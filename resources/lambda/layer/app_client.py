@@ -0,0 +1,132 @@
+import logging
+import threading
+from typing import TYPE_CHECKING
+import boto3
+from botocore.config import Config
+from urllib3.util.retry import Retry
+import app_const
+
+# requestsは外部APIを呼ぶときにしか使わないので、保存済みの結果を返すだけの呼び出しでは読み込まない
+# NOTE urllib3はboto3(botocore)が読み込むので読み込み時間は増えない
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# HTTPリクエストの(接続タイムアウト, 読み込みタイムアウト)秒
+HTTP_TIMEOUT = (5, 60)
+
+# ホストごとに保持するHTTPコネクション数
+# NOTE レコードの並列処理数より小さいとコネクションが使いまわされない
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 20
+
+# 接続エラーや一時的なサーバーエラーの場合のリトライ
+# NOTE 429はrate_limiterでレートを下げて呼び出し元に返すため、ここではリトライしない
+# NOTE POST(tourplanning、matrix)は読み込みタイムアウトが長くLambdaのタイムアウトを超え得るうえ、
+#      最適化をやり直すことになるのでリトライしない。送信前の接続エラーはメソッドに関わらずリトライされる
+HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# boto3クライアントの既定の設定
+AWS_CLIENT_CONFIG = Config(
+    connect_timeout=5,
+    read_timeout=60,
+    max_pool_connections=HTTP_POOL_MAXSIZE,
+    tcp_keepalive=True,
+    retries={"max_attempts": 5, "mode": "standard"},
+)
+
+# Lambdaインスタンスが生きている間はクライアントを使いまわす
+# NOTE boto3のクライアント作成はスレッドセーフではないのでロックを取って作成する
+#      作成済みのクライアントとSessionはスレッド間で共有できる
+_lock = threading.Lock()
+_aws_session: boto3.session.Session = None
+_aws_clients: dict = {}
+_http_session: "requests.Session" = None
+
+
+def get_client(service_name: str, region_name: str = None, config: Config = None):
+    """
+    boto3のクライアントを返す。
+    同じサービス名とリージョンの組み合わせでは最初に作成したクライアントを返す。
+
+    config: AWS_CLIENT_CONFIGに上書きする設定。最初の作成時のみ使われる。
+    """
+    key = (service_name, region_name)
+    client = _aws_clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _aws_clients.get(key)
+        if client is not None:
+            return client
+
+        global _aws_session
+        if _aws_session is None:
+            _aws_session = boto3.session.Session()
+
+        client_config = AWS_CLIENT_CONFIG
+        if config is not None:
+            client_config = client_config.merge(config)
+        client = _aws_session.client(
+            service_name, region_name=region_name, config=client_config
+        )
+        _aws_clients[key] = client
+        logger.debug(
+            "get_client", extra={"service_name": service_name, "region": region_name}
+        )
+        return client
+
+
+def set_client(service_name: str, client, region_name: str = None):
+    """
+    get_clientが返すクライアントを差し替える。
+    ベンチマークなどでAWSへアクセスせずに動かすために使う。
+    """
+    with _lock:
+        _aws_clients[(service_name, region_name)] = client
+
+
+def get_http_session() -> "requests.Session":
+    """
+    コネクションプールを持つrequestsのSessionを返す。
+    keep-aliveによりTCP接続とTLSハンドシェイクを使いまわす。
+    """
+    global _http_session
+    if _http_session is not None:
+        return _http_session
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                max_retries=HTTP_RETRY,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+            logger.debug("get_http_session", extra={"value": "create session"})
+        return _http_session
+
+
+def get_retry_count(res) -> int:
+    """
+    boto3の応答(dict)またはrequestsの応答から、成功するまでにリトライした回数を返す
+    """
+    if isinstance(res, dict):
+        return res.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    retries = getattr(getattr(res, "raw", None), "retries", None)
+    return len(retries.history) if retries is not None else 0
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+import os
+import random
+
+# ログの1つの項目に出力するJSONの最大バイト数。超えた分は切り詰める
+LOG_PAYLOAD_MAX_BYTES = int(os.environ.get("LOG_PAYLOAD_MAX_BYTES", "8192"))
+# リクエストやレスポンスなどの大きくなり得る値をログに出力する割合(0~1)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+TRUNCATED_MARKER = "...(truncated)"
+
+
+def to_payload(value, max_bytes: int = LOG_PAYLOAD_MAX_BYTES) -> dict:
+    """
+    値をJSONの文字列にする。max_bytesを超える場合は切り詰めて末尾にTRUNCATED_MARKERを付ける。
+    切り詰めた場合は元のバイト数とsha256も返し、同じ値かどうかを比べられるようにする。
+
+    return {"value": <JSON>} または {"value": <切り詰めたJSON>, "bytes": <元のバイト数>, "sha256": <ハッシュ>}
+    """
+    text = json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+    data = text.encode()
+    if len(data) <= max_bytes:
+        return {"value": text}
+    return {
+        # マルチバイト文字の途中で切れた場合はその文字を捨てる
+        "value": data[:max_bytes].decode(errors="ignore") + TRUNCATED_MARKER,
+        "bytes": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def log_payloads(
+    logger: logging.Logger,
+    level: int,
+    msg: str,
+    payloads: dict,
+    extra: dict = None,
+    sample_rate: float = LOG_PAYLOAD_SAMPLE_RATE,
+    max_bytes: int = LOG_PAYLOAD_MAX_BYTES,
+):
+    """
+    リクエストやレスポンスなどの大きくなり得る値payloads({<項目名>: <値>})をextraとあわせてログに出力する。
+      - levelのログを出力しない場合は何もしない。値のJSONへの変換も行わない
+      - sample_rateの割合でだけpayloadsを出力する。出力しない場合はextraだけを出力する
+      - 値のJSONがmax_bytesを超える場合は切り詰め、<項目名>_bytesと<項目名>_sha256を付ける
+    値が関数の場合は出力するときに呼び出して値を作る。
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    fields = dict(extra or {})
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        fields["sampled_out"] = list(payloads.keys())
+        logger.log(level, msg, extra=fields, stacklevel=2)
+        return
+
+    for name, value in payloads.items():
+        if callable(value):
+            value = value()
+        payload = to_payload(value, max_bytes)
+        fields[name] = payload["value"]
+        if "bytes" in payload:
+            fields[f"{name}_bytes"] = payload["bytes"]
+            fields[f"{name}_sha256"] = payload["sha256"]
+    logger.log(level, msg, extra=fields, stacklevel=2)
@@ -0,0 +1,186 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import app_const
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# falseの場合は計測も出力もしない
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", app_const.PROJECT_NAME)
+
+# Embedded Metric Formatの1つのメトリクスに含められる値の数の上限
+EMF_MAX_VALUES = 100
+
+MILLISECONDS = "Milliseconds"
+BYTES = "Bytes"
+COUNT = "Count"
+
+
+class Metrics:
+    def __init__(self):
+        """
+        1回の呼び出しの間のメトリクスを溜めておき、flushでまとめて出力する
+        """
+        # {<メトリクス名>: (<単位>, [<値>])}
+        self._values: dict[str, tuple[str, list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def put(self, name: str, value: float, unit: str = COUNT):
+        with self._lock:
+            entry = self._values.get(name)
+            if entry is None:
+                entry = self._values[name] = (unit, [])
+            entry[1].append(value)
+
+    def flush(self, dimensions: dict[str, str] = None):
+        """
+        溜めたメトリクスをCloudWatchのEmbedded Metric Format(EMF)のログとして出力して空にする。
+        LambdaのJSON形式のログではextraの値がログの最上位の項目になるため、そのままEMFとして扱われる。
+        """
+        with self._lock:
+            values = self._values
+            self._values = {}
+        if len(values) == 0:
+            return
+
+        dimensions = dimensions or {}
+        function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+        if function_name is not None:
+            dimensions = {"FunctionName": function_name, **dimensions}
+
+        # 1つのメトリクスの値がEMF_MAX_VALUESを超える場合は複数のログに分ける
+        chunk = 0
+        while True:
+            metrics = []
+            fields = {}
+            for name, (unit, metric_values) in values.items():
+                chunk_values = metric_values[
+                    chunk * EMF_MAX_VALUES : (chunk + 1) * EMF_MAX_VALUES
+                ]
+                if len(chunk_values) == 0:
+                    continue
+                metrics.append({"Name": name, "Unit": unit})
+                fields[name] = chunk_values
+            if len(metrics) == 0:
+                break
+
+            logger.info(
+                "metrics",
+                extra={
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": METRICS_NAMESPACE,
+                                "Dimensions": [list(dimensions.keys())],
+                                "Metrics": metrics,
+                            }
+                        ],
+                    },
+                    **dimensions,
+                    **fields,
+                },
+            )
+            chunk += 1
+
+
+# Lambdaインスタンス内で共有する
+metrics = Metrics()
+
+
+def put(name: str, value: float, unit: str = COUNT):
+    """
+    メトリクスを1つ記録する。ペイロードのサイズ、リトライ回数、キャッシュヒットなどに使う。
+    """
+    if METRICS_ENABLED:
+        metrics.put(name, value, unit)
+
+
+@contextmanager
+def timer(name: str):
+    """
+    ブロックの処理時間をミリ秒で記録する
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.put(name, (time.perf_counter() - start) * 1000, MILLISECONDS)
+
+
+def timed(name: str = None):
+    """
+    関数の処理時間をミリ秒で記録するデコレーター。コルーチン関数にも使える。
+    無効な場合は関数をそのまま返すので、呼び出しのオーバーヘッドは無い。
+    """
+
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+        metric_name = name or fn.__name__
+
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    metrics.put(
+                        metric_name, (time.perf_counter() - start) * 1000, MILLISECONDS
+                    )
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.put(
+                    metric_name, (time.perf_counter() - start) * 1000, MILLISECONDS
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def flush(dimensions: dict[str, str] = None):
+    """
+    Lambdaの呼び出しの最後に1回呼び出す
+    """
+    if METRICS_ENABLED:
+        metrics.flush(dimensions)
+
+
+def handler(fn):
+    """
+    lambda_handlerに付けるデコレーター。
+    呼び出し全体の処理時間を記録し、例外の場合も含めて呼び出しの終了時にflushする。
+    """
+    if not METRICS_ENABLED:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(event, context):
+        start = time.perf_counter()
+        try:
+            return fn(event, context)
+        finally:
+            metrics.put(
+                "lambda_handler", (time.perf_counter() - start) * 1000, MILLISECONDS
+            )
+            metrics.flush()
+
+    return wrapper
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import app_const
+import app_client
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# SSMパラメーターとシークレットをメモリに保持する期間(秒)
+# 期間を過ぎた値は返しつつバックグラウンドで取得し直す
+PARAMETER_CACHE_TTL_SECONDS = int(
+    os.environ.get("PARAMETER_CACHE_TTL_SECONDS", str(5 * 60))
+)
+
+# GetParametersで1回に取得できるパラメーター数の上限
+GET_PARAMETERS_MAX_NAMES = 10
+
+
+class ParameterCache:
+    def __init__(self, ttl_seconds: int = PARAMETER_CACHE_TTL_SECONDS):
+        """
+        SSMパラメーターストアのパラメーターとSecrets Managerのシークレットを
+        Lambdaインスタンスが生きている間メモリに保持する。
+        """
+        self.ttl_seconds = ttl_seconds
+
+        # {(<種類>, <名前>): (<取得時刻>, <値>)}
+        self._values: dict[tuple[str, str], tuple[float, object]] = {}
+        # バックグラウンドで取得し直している最中のキー
+        self._refreshing: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def _fetch_parameters(self, names: list[str]):
+        ssm = app_client.get_client("ssm")
+        for i in range(0, len(names), GET_PARAMETERS_MAX_NAMES):
+            chunk = names[i : i + GET_PARAMETERS_MAX_NAMES]
+            res = ssm.get_parameters(Names=chunk, WithDecryption=True)
+            if len(res["InvalidParameters"]) > 0:
+                raise KeyError(f"invalid parameters: {res['InvalidParameters']}")
+
+            now = time.monotonic()
+            with self._lock:
+                for parameter in res["Parameters"]:
+                    key = ("parameter", parameter["Name"])
+                    self._values[key] = (now, parameter["Value"])
+        logger.debug("fetch_parameters", extra={"names": names})
+
+    def _fetch_secret(self, name: str):
+        secretsmanager = app_client.get_client("secretsmanager")
+        res = secretsmanager.get_secret_value(SecretId=name)
+        value = json.loads(res["SecretString"])
+        with self._lock:
+            self._values[("secret", name)] = (time.monotonic(), value)
+        logger.debug("fetch_secret", extra={"secret_name": name})
+
+    def _fetch(self, key: tuple[str, str]):
+        kind, name = key
+        if kind == "parameter":
+            self._fetch_parameters([name])
+        else:
+            self._fetch_secret(name)
+
+    def _refresh(self, key: tuple[str, str]):
+        try:
+            self._fetch(key)
+        except Exception as e:
+            # 取得し直せなかった場合は古い値を使い続け、次回また取得を試みる
+            logger.warning(
+                "refresh", extra={"parameter_name": key[1], "error": repr(e)}
+            )
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _get(self, key: tuple[str, str]):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None:
+                fetched_at, value = entry
+                if (
+                    time.monotonic() - fetched_at > self.ttl_seconds
+                    and key not in self._refreshing
+                ):
+                    self._refreshing.add(key)
+                    threading.Thread(
+                        target=self._refresh, args=(key,), daemon=True
+                    ).start()
+                return value
+
+        # まだ取得していない場合はその場で取得する
+        self._fetch(key)
+        with self._lock:
+            return self._values[key][1]
+
+    def prefetch(self, parameter_names: list[str] = (), secret_names: list[str] = ()):
+        """
+        パラメーターはGetParametersでまとめて、シークレットはそれと並列に取得する。
+        コールドスタート時に呼び出しておくことでリクエストの処理中にSSMへアクセスしなくて済む。
+        """
+        with ThreadPoolExecutor(max_workers=1 + len(secret_names)) as executor:
+            futures = []
+            if len(parameter_names) > 0:
+                futures.append(
+                    executor.submit(self._fetch_parameters, list(parameter_names))
+                )
+            for secret_name in secret_names:
+                futures.append(executor.submit(self._fetch_secret, secret_name))
+            for future in futures:
+                future.result()
+
+    def get_parameter(self, name: str) -> str:
+        """
+        SSMパラメーターストアのパラメーターを復号して返す
+        """
+        return self._get(("parameter", name))
+
+    def get_secret(self, name: str) -> dict:
+        """
+        Secrets ManagerのシークレットをJSONとして返す
+        """
+        return self._get(("secret", name))
+
+
+# Lambdaインスタンス内で共有する
+parameter_cache = ParameterCache()
+
+
+def prefetch(parameter_names: list[str] = (), secret_names: list[str] = ()):
+    parameter_cache.prefetch(parameter_names, secret_names)
+
+
+def get_parameter(name: str) -> str:
+    return parameter_cache.get_parameter(name)
+
+
+def get_secret(name: str) -> dict:
+    return parameter_cache.get_secret(name)
@@ -0,0 +1,131 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import app_const
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# trueの場合はLambdaの初期化フェーズ(ハンドラーのimport時)に初期化処理を済ませておく
+# falseの場合は最初の呼び出しで初期化処理を並列に行う
+STARTUP_PREINIT = os.environ.get("STARTUP_PREINIT", "false").lower() == "true"
+# 初期化フェーズで初期化処理の完了を待つ最大時間(秒)
+# NOTE 初期化フェーズは10秒で打ち切られるため、それより短くする
+#      待ちきれなかった処理は最初の呼び出しで完了を待つ
+STARTUP_PREINIT_TIMEOUT_SECONDS = float(
+    os.environ.get("STARTUP_PREINIT_TIMEOUT_SECONDS", "8")
+)
+
+
+class Startup:
+    def __init__(self, module_name: str):
+        """
+        シークレットやパラメーターの取得、DBへの接続などのコールドスタート時の初期化処理を
+        並列に実行し、結果は使うときに完了を待って受け取る。
+        失敗した処理は次に使うときにやり直す。
+
+        module_name: ハンドラーのモジュール名(__name__)
+        """
+        self.module_name = module_name
+        self._tasks: dict[str, callable] = {}
+        self._futures: dict[str, Future] = {}
+        # {<処理名>: <処理時間(秒)>}
+        self._timings: dict[str, float] = {}
+        self._executor: ThreadPoolExecutor = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, fn: callable):
+        """
+        初期化処理を登録する。fnの返り値がget(name)の結果になる。
+        """
+        self._tasks[name] = fn
+
+    def _run(self, name: str):
+        start = time.perf_counter()
+        try:
+            return self._tasks[name]()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._timings[name] = elapsed
+
+    def start(self):
+        """
+        登録した初期化処理のうち、まだ開始していないものを全て並列に開始する
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(1, len(self._tasks)),
+                    thread_name_prefix="startup",
+                )
+            for name in self._tasks:
+                if name not in self._futures:
+                    self._futures[name] = self._executor.submit(self._run, name)
+
+    def get(self, name: str):
+        """
+        初期化処理の結果を返す。開始していない場合は他の初期化処理とあわせて開始し、完了を待つ。
+        失敗した場合は例外をそのまま投げ、次に呼ばれたときにやり直す。
+        """
+        self.start()
+        with self._lock:
+            future = self._futures[name]
+        try:
+            return future.result()
+        except Exception:
+            with self._lock:
+                if self._futures.get(name) is future:
+                    del self._futures[name]
+            raise
+
+    def preinit(self, modules: list[str] = ()) -> bool:
+        """
+        STARTUP_PREINITがtrueの場合、初期化フェーズで初期化処理を開始して完了を待つ。
+        待っている間に、最初の呼び出しで使う重いモジュールmodulesをimportしておく。
+        初期化処理を行った場合はTrue
+
+        NOTE 他のハンドラーのモジュールからimportされた場合(非同期版が同期版の関数を使う場合)は
+             使わない初期化処理を行わないよう何もしない
+        """
+        handler = os.environ.get("_HANDLER")
+        if not STARTUP_PREINIT or (
+            handler is not None and handler.rsplit(".", 1)[0] != self.module_name
+        ):
+            return False
+
+        start = time.perf_counter()
+        self.start()
+        for module in modules:
+            importlib.import_module(module)
+        import_seconds = time.perf_counter() - start
+
+        with self._lock:
+            futures = dict(self._futures)
+        done, not_done = wait(futures.values(), timeout=STARTUP_PREINIT_TIMEOUT_SECONDS)
+        # 失敗した処理は最初の呼び出しでやり直す
+        errors = {
+            name: repr(future.exception())
+            for name, future in futures.items()
+            if future in done and future.exception() is not None
+        }
+        logger.info(
+            "preinit",
+            extra={
+                "import_seconds": round(import_seconds, 3),
+                "elapsed_seconds": round(time.perf_counter() - start, 3),
+                "timings": self.timings(),
+                "not_done": len(not_done),
+                "errors": errors,
+            },
+        )
+        return True
+
+    def timings(self) -> dict[str, float]:
+        """
+        完了した初期化処理ごとの処理時間(秒)
+        """
+        with self._lock:
+            return {name: round(seconds, 3) for name, seconds in self._timings.items()}
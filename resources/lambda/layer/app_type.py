@@ -1,4 +1,9 @@
+from array import array
+
+
 class Point:
+    __slots__ = ("latitude", "longitude")
+
     def __init__(self, latitude: float, longitude: float):
         """
         緯度経度を持つ
@@ -8,6 +13,8 @@ class Point:
 
 
 class Address:
+    __slots__ = ("point", "address")
+
     def __init__(self, latitude: float, longitude: float, address: str):
         """
         住所を持つ
@@ -17,6 +24,8 @@ class Address:
 
 
 class Present:
+    __slots__ = ("present_id", "present_name", "address")
+
     def __init__(
         self,
         present_id: int,
@@ -34,6 +43,8 @@ class Present:
 
 
 class Facility:
+    __slots__ = ("facility_id", "facility_name", "address")
+
     def __init__(
         self,
         facility_id: int,
@@ -48,3 +59,81 @@ class Facility:
         self.facility_id: int = facility_id
         self.facility_name: str = facility_name
         self.address: Address = Address(latitude, longitude, address)
+
+
+class PresentSet:
+    __slots__ = (
+        "present_ids",
+        "present_names",
+        "addresses",
+        "latitudes",
+        "longitudes",
+        "_rows",
+    )
+
+    def __init__(self):
+        """
+        複数のプレゼント情報を列ごとに持つ。
+        Presentをプレゼントごとに作らないので、件数が多い場合にメモリと処理時間を抑えられる。
+        緯度経度は連続したdouble配列で持つ。
+        """
+        self.present_ids: list[int] = []
+        self.present_names: list[str] = []
+        self.addresses: list[str] = []
+        self.latitudes: array = array("d")
+        self.longitudes: array = array("d")
+
+        # {<present_id>: <行番号>}
+        self._rows: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.present_ids)
+
+    def __contains__(self, present_id: int) -> bool:
+        return present_id in self._rows
+
+    def extend(self, rows: list[tuple]):
+        """
+        rows: [(<present_id>, <present_name>, <address>, <latitude>, <longitude>)]
+        """
+        offset = len(self.present_ids)
+        for i, (present_id, present_name, address, latitude, longitude) in enumerate(
+            rows
+        ):
+            self._rows[present_id] = offset + i
+            self.present_ids.append(present_id)
+            self.present_names.append(present_name)
+            self.addresses.append(address)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+
+    def row(self, present_id: int) -> int:
+        return self._rows[present_id]
+
+    def point(self, row: int) -> Point:
+        return Point(self.latitudes[row], self.longitudes[row])
+
+    def reorder(self, present_ids: list[int]) -> "PresentSet":
+        """
+        present_idsの順に並べ替えたPresentSetを返す。
+        緯度経度はnumpyでまとめて並べ替える。
+        """
+        import numpy as np
+
+        rows = [self._rows[present_id] for present_id in present_ids]
+        row_index = np.array(rows, dtype=np.intp)
+
+        ordered = PresentSet()
+        ordered.present_ids = list(present_ids)
+        ordered.present_names = [self.present_names[row] for row in rows]
+        ordered.addresses = [self.addresses[row] for row in rows]
+        ordered.latitudes = array(
+            "d", np.frombuffer(self.latitudes, dtype=np.float64)[row_index].tobytes()
+        )
+        ordered.longitudes = array(
+            "d", np.frombuffer(self.longitudes, dtype=np.float64)[row_index].tobytes()
+        )
+        ordered._rows = {
+            present_id: row for row, present_id in enumerate(ordered.present_ids)
+        }
+        return ordered
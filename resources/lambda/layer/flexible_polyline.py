@@ -0,0 +1,229 @@
+import math
+
+# ref: https://github.com/heremaps/flexible-polyline
+ENCODING_TABLE = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+DECODING_TABLE = {c: i for i, c in enumerate(ENCODING_TABLE)}
+FORMAT_VERSION = 1
+
+# 3次元目の種類
+ABSENT = 0
+LEVEL = 1
+ALTITUDE = 2
+ELEVATION = 3
+CUSTOM1 = 6
+CUSTOM2 = 7
+
+# ズームレベル0で赤道上の1ピクセルあたりの距離(m)
+METERS_PER_PIXEL_AT_ZOOM_0 = 156543.03392
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def _encode_unsigned(value: int, appender):
+    while value > 0x1F:
+        appender(ENCODING_TABLE[(value & 0x1F) | 0x20])
+        value >>= 5
+    appender(ENCODING_TABLE[value])
+
+
+def _encode_signed(value: int, appender):
+    negative = value < 0
+    value <<= 1
+    if negative:
+        value = ~value
+    _encode_unsigned(value, appender)
+
+
+def _round(value: float) -> int:
+    # 0.5は0から遠い方へ丸める(参照実装と同じ)
+    return int(math.copysign(math.floor(abs(value) + 0.5), value))
+
+
+def encode(
+    coordinates: list[tuple],
+    precision: int = 5,
+    third_dim: int = ABSENT,
+    third_dim_precision: int = 0,
+) -> str:
+    """
+    [(<緯度>, <経度>)]または[(<緯度>, <経度>, <3次元目>)]をflexible polylineにする
+    """
+    res = []
+    appender = res.append
+    _encode_unsigned(FORMAT_VERSION, appender)
+    _encode_unsigned(
+        precision | (third_dim << 4) | (third_dim_precision << 7), appender
+    )
+
+    multiplier = 10**precision
+    multiplier_z = 10**third_dim_precision
+    last_lat = last_lng = last_z = 0
+    for coordinate in coordinates:
+        lat = _round(coordinate[0] * multiplier)
+        _encode_signed(lat - last_lat, appender)
+        last_lat = lat
+
+        lng = _round(coordinate[1] * multiplier)
+        _encode_signed(lng - last_lng, appender)
+        last_lng = lng
+
+        if third_dim != ABSENT:
+            z = _round(coordinate[2] * multiplier_z)
+            _encode_signed(z - last_z, appender)
+            last_z = z
+
+    return "".join(res)
+
+
+def _decode_unsigned_values(encoded: str):
+    result = 0
+    shift = 0
+    for c in encoded:
+        value = DECODING_TABLE[c]
+        result |= (value & 0x1F) << shift
+        if value & 0x20 == 0:
+            yield result
+            result = 0
+            shift = 0
+        else:
+            shift += 5
+    if shift > 0:
+        raise ValueError("invalid flexible polyline")
+
+
+def _to_signed(value: int) -> int:
+    if value & 1:
+        value = ~value
+    return value >> 1
+
+
+def decode_header(encoded: str) -> tuple[int, int, int]:
+    """
+    return (<precision>, <third_dim>, <third_dim_precision>)
+    """
+    values = _decode_unsigned_values(encoded)
+    version = next(values)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"invalid flexible polyline version: {version}")
+    header = next(values)
+    return header & 0x0F, (header >> 4) & 0x07, (header >> 7) & 0x0F
+
+
+def decode(encoded: str) -> list[tuple]:
+    """
+    flexible polylineを[(<緯度>, <経度>)]または[(<緯度>, <経度>, <3次元目>)]にする
+    """
+    values = _decode_unsigned_values(encoded)
+    version = next(values)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"invalid flexible polyline version: {version}")
+    header = next(values)
+    precision = header & 0x0F
+    third_dim = (header >> 4) & 0x07
+    third_dim_precision = (header >> 7) & 0x0F
+
+    divisor = 10**precision
+    divisor_z = 10**third_dim_precision
+    coordinates = []
+    lat = lng = z = 0
+    for value in values:
+        lat += _to_signed(value)
+        lng += _to_signed(next(values))
+        if third_dim != ABSENT:
+            z += _to_signed(next(values))
+            coordinates.append((lat / divisor, lng / divisor, z / divisor_z))
+        else:
+            coordinates.append((lat / divisor, lng / divisor))
+    return coordinates
+
+
+def zoom_tolerance_meters(
+    zoom: float, latitude: float, pixel_tolerance: float = 1.0
+) -> float:
+    """
+    Webメルカトルのズームレベルzoomで、pixel_toleranceピクセルに相当する距離(m)を返す。
+    この距離より小さい形状の違いは地図上で見分けられない。
+    """
+    return (
+        METERS_PER_PIXEL_AT_ZOOM_0
+        * math.cos(math.radians(latitude))
+        / (2**zoom)
+        * pixel_tolerance
+    )
+
+
+def simplify(coordinates: list[tuple], tolerance_meters: float) -> list[tuple]:
+    """
+    Douglas-Peucker法で、元の線からの距離がtolerance_meters以下となるように点を間引く。
+    始点と終点は必ず残す。
+    """
+    if len(coordinates) <= 2 or tolerance_meters <= 0:
+        return list(coordinates)
+
+    # numpyは経路を間引くときにしか使わないので、エンコードとデコードだけの場合は読み込まない
+    import numpy as np
+
+    # 正距円筒図法で平面(m)に投影する
+    points = np.array([(c[0], c[1]) for c in coordinates], dtype=np.float64)
+    scale = math.radians(1) * EARTH_RADIUS_METERS
+    y = points[:, 0] * scale
+    x = points[:, 1] * scale * math.cos(math.radians(float(np.mean(points[:, 0]))))
+
+    keep = np.zeros(len(coordinates), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coordinates) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        # 区間内の各点から始点と終点を結ぶ線分までの距離
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1 : end] - x[start], y[start + 1 : end] - y[start]
+        length2 = dx * dx + dy * dy
+        if length2 == 0:
+            distances = np.hypot(px, py)
+        else:
+            t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+            distances = np.hypot(px - t * dx, py - t * dy)
+
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance_meters:
+            split = start + 1 + index
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return [coordinates[i] for i in np.flatnonzero(keep)]
+
+
+def simplify_encoded(encoded: str, tolerance_meters: float) -> str:
+    """
+    flexible polylineを間引いて同じ精度でエンコードし直す
+    """
+    precision, third_dim, third_dim_precision = decode_header(encoded)
+    return encode(
+        simplify(decode(encoded), tolerance_meters),
+        precision,
+        third_dim,
+        third_dim_precision,
+    )
+
+
+def to_multilinestring_wkt(encoded_list: list[str]) -> str:
+    """
+    flexible polylineの配列をPostGISに保存するためのMULTILINESTRINGのWKTにする。
+    他のテーブルと合わせてx座標に緯度、y座標に経度を入れる。
+    LINESTRINGは2点以上必要なので、点の無い区間は除き、1点だけの区間はその点を重ねる。
+    """
+    linestrings = []
+    for encoded in encoded_list:
+        coordinates = decode(encoded)
+        if len(coordinates) == 0:
+            continue
+        if len(coordinates) == 1:
+            coordinates = coordinates * 2
+        linestrings.append("(" + ", ".join(f"{c[0]} {c[1]}" for c in coordinates) + ")")
+    if len(linestrings) == 0:
+        return "MULTILINESTRING EMPTY"
+    return f"MULTILINESTRING ({', '.join(linestrings)})"
@@ -0,0 +1,270 @@
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+import app_const
+import app_metrics
+import gsi_api
+from app_aurora import Aurora
+from app_type import Address
+
+# psycopgは非同期版のハンドラーでしか使わないので、同期版のコールドスタートで読み込まない
+if TYPE_CHECKING:
+    from app_aurora_async import AsyncAurora
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# プロセス内キャッシュの最大件数と有効期間(秒)
+LOCAL_CACHE_MAX_SIZE = 10000
+LOCAL_CACHE_TTL_SECONDS = 60 * 60
+
+# Auroraのgeocode_cacheテーブルのレコードの有効期間(日)
+SHARED_CACHE_TTL_DAYS = 30
+
+# Auroraのgeocode_cacheテーブルの参照と更新
+SELECT_SHARED_QUERY = "SELECT address, ST_X(point) as latitude, ST_Y(point) as longitude FROM geocode_cache WHERE address_key = %s AND updated_at > now() - make_interval(days => %s)"
+UPSERT_SHARED_QUERY = "INSERT INTO geocode_cache (address_key, address, point, updated_at) VALUES (%s, %s, ST_GeomFromText('POINT(%s %s)'), now()) ON CONFLICT (address_key) DO UPDATE SET address = EXCLUDED.address, point = EXCLUDED.point, updated_at = EXCLUDED.updated_at"
+
+# ハイフンとして扱う文字
+# NOTE 長音符「ー」は「センター」のような地名を壊さないよう、数字の間にある場合だけハイフンとして扱う
+HYPHEN_CHARS = "‐‑‒–—―−－"
+
+KANJI_DIGITS = {
+    "〇": 0,
+    "一": 1,
+    "二": 2,
+    "三": 3,
+    "四": 4,
+    "五": 5,
+    "六": 6,
+    "七": 7,
+    "八": 8,
+    "九": 9,
+}
+KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+
+
+def _kanji_to_int(kanji: str) -> int:
+    """
+    漢数字(千の位まで)を整数に変換する
+    """
+    total = 0
+    digit = 0
+    for c in kanji:
+        if c in KANJI_DIGITS:
+            digit = digit * 10 + KANJI_DIGITS[c]
+        else:
+            total += (digit if digit > 0 else 1) * KANJI_UNITS[c]
+            digit = 0
+    return total + digit
+
+
+def normalize_address(address: str) -> str:
+    """
+    表記揺れを吸収した住所のキャッシュキーを返す。
+    全角英数字は半角に、「1丁目2番3号」や「一丁目2番地3」は「1-2-3」に寄せる。
+    """
+    key = unicodedata.normalize("NFKC", address)
+    key = re.sub(r"\s+", "", key)
+    key = re.sub(f"[{HYPHEN_CHARS}]", "-", key)
+    key = re.sub(r"(?<=\d)ー(?=\d)", "-", key)
+
+    # 丁目の前の漢数字だけを算用数字にする
+    # NOTE 「一番町」のような地名を壊さないよう番・号の前の漢数字は変換しない
+    key = re.sub(
+        r"([〇一二三四五六七八九十百千]+)丁目",
+        lambda m: f"{_kanji_to_int(m.group(1))}丁目",
+        key,
+    )
+    # NOTE 「1番町」のような地名を壊さないよう、番は後ろに数字かハイフンが続くか末尾の場合だけ区切りとして扱う
+    key = re.sub(r"(\d+)(丁目|番地|番(?=[\d-]|$))", r"\1-", key)
+    key = re.sub(r"(\d+)号", r"\1", key)
+    key = re.sub(r"-+", "-", key)
+    return key.rstrip("-")
+
+
+class GeocodeCache:
+    def __init__(
+        self,
+        aurora: Aurora,
+        max_size: int = LOCAL_CACHE_MAX_SIZE,
+        ttl_seconds: int = LOCAL_CACHE_TTL_SECONDS,
+    ):
+        """
+        gsi_api.address_searchの結果をキャッシュする。
+        プロセス内のLRUキャッシュとAuroraのgeocode_cacheテーブルの2段構成。
+        Lambdaインスタンスが生きている間はプロセス内キャッシュが使いまわされる。
+        """
+        self.aurora = aurora
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+        # {<address_key>: (<有効期限>, <Address>)}
+        self._local: OrderedDict[str, tuple[float, Address]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.gsi_seconds = 0.0
+
+    def _get_local(self, key: str) -> Address:
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires_at, address = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return address
+
+    def _put_local(self, key: str, address: Address):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.ttl_seconds, address)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _get_shared(self, key: str) -> Address:
+        rows = self.aurora.select(SELECT_SHARED_QUERY, (key, SHARED_CACHE_TTL_DAYS))
+        return _to_shared_address(rows)
+
+    def _put_shared(self, key: str, address: Address):
+        self.aurora.update_commit(UPSERT_SHARED_QUERY, _to_shared_param(key, address))
+
+    def address_search(self, address: str) -> Address:
+        """
+        キャッシュを参照し、無ければ国土地理院の住所検索APIを叩く
+        """
+        key = normalize_address(address)
+
+        cached = self._get_local(key)
+        if cached is not None:
+            self._count_hit("local", key)
+            return cached
+
+        # 共有キャッシュが読めなくても住所検索は続ける
+        try:
+            cached = self._get_shared(key)
+        except Exception as e:
+            logger.warning("address_search", extra={"error": repr(e)})
+            cached = None
+        if cached is not None:
+            self._count_hit("shared", key)
+            self._put_local(key, cached)
+            return cached
+
+        start = time.perf_counter()
+        result = gsi_api.address_search(address)
+        self._count_miss(key, time.perf_counter() - start)
+
+        self._put_local(key, result)
+        try:
+            self._put_shared(key, result)
+        except Exception as e:
+            logger.warning("address_search", extra={"error": repr(e)})
+        return result
+
+    def _count_hit(self, cache: str, key: str):
+        with self._lock:
+            if cache == "local":
+                self.local_hits += 1
+            else:
+                self.shared_hits += 1
+        app_metrics.put(f"geocode_cache.{cache}_hit", 1)
+        logger.debug("address_search", extra={"cache": cache, "key": key})
+
+    def _count_miss(self, key: str, elapsed: float):
+        with self._lock:
+            self.misses += 1
+            self.gsi_seconds += elapsed
+        app_metrics.put("geocode_cache.miss", 1)
+        logger.debug("address_search", extra={"cache": "miss", "key": key})
+
+    def stats(self) -> dict:
+        """
+        ヒット数、ミス数と、ヒットにより削減できた国土地理院APIの推定時間を返す
+        """
+        with self._lock:
+            hits = self.local_hits + self.shared_hits
+            avg_gsi_seconds = self.gsi_seconds / self.misses if self.misses else 0.0
+            return {
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "local_size": len(self._local),
+                "gsi_seconds": round(self.gsi_seconds, 3),
+                "estimated_saved_seconds": round(hits * avg_gsi_seconds, 3),
+            }
+
+
+class AsyncGeocodeCache(GeocodeCache):
+    def __init__(
+        self,
+        aurora: "AsyncAurora",
+        max_size: int = LOCAL_CACHE_MAX_SIZE,
+        ttl_seconds: int = LOCAL_CACHE_TTL_SECONDS,
+    ):
+        """
+        GeocodeCacheの非同期版。共有キャッシュにはAsyncAuroraを、住所検索にはgsi_api.address_search_asyncを使う。
+        """
+        super().__init__(aurora, max_size, ttl_seconds)
+
+    async def address_search(self, address: str) -> Address:
+        """
+        キャッシュを参照し、無ければ国土地理院の住所検索APIを叩く
+        """
+        key = normalize_address(address)
+
+        cached = self._get_local(key)
+        if cached is not None:
+            self._count_hit("local", key)
+            return cached
+
+        # 共有キャッシュが読めなくても住所検索は続ける
+        try:
+            rows = await self.aurora.select(
+                SELECT_SHARED_QUERY, (key, SHARED_CACHE_TTL_DAYS)
+            )
+            cached = _to_shared_address(rows)
+        except Exception as e:
+            logger.warning("address_search", extra={"error": repr(e)})
+            cached = None
+        if cached is not None:
+            self._count_hit("shared", key)
+            self._put_local(key, cached)
+            return cached
+
+        start = time.perf_counter()
+        result = await gsi_api.address_search_async(address)
+        self._count_miss(key, time.perf_counter() - start)
+
+        self._put_local(key, result)
+        try:
+            await self.aurora.update_commit(
+                UPSERT_SHARED_QUERY, _to_shared_param(key, result)
+            )
+        except Exception as e:
+            logger.warning("address_search", extra={"error": repr(e)})
+        return result
+
+
+def _to_shared_address(rows: list) -> Address:
+    if len(rows) == 0:
+        return None
+    record = rows[0]
+    return Address(record["latitude"], record["longitude"], record["address"])
+
+
+def _to_shared_param(key: str, address: Address) -> tuple:
+    return (
+        key,
+        address.address,
+        address.point.latitude,
+        address.point.longitude,
+    )
@@ -1,24 +1,68 @@
 import logging
-import requests
+import os
 import app_const
+import app_async
+import app_client
+import app_metrics
+import rate_limiter
 from app_type import Address
 
-ADDRESS_SEARCH_REQUEST_URL = "https://msearch.gsi.go.jp/address-search/AddressSearch"
+# NOTE ベンチマークなどでスタブサーバーに向けるために環境変数で上書きできる
+ADDRESS_SEARCH_REQUEST_URL = os.environ.get(
+    "GSI_ADDRESS_SEARCH_URL", "https://msearch.gsi.go.jp/address-search/AddressSearch"
+)
+# (接続タイムアウト, 読み込みタイムアウト)秒
+REQUEST_TIMEOUT = (5, 30)
 
 logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
 
 
+@app_metrics.timed("gsi.address_search")
 def address_search(address: str) -> Address:
     """
     国土地理院の住所検索APIを叩く
     """
     param = {"q": address}
-    res = requests.get(ADDRESS_SEARCH_REQUEST_URL, param)
+    session = app_client.get_http_session()
+    with rate_limiter.get_rate_limiter("gsi").limit():
+        res = session.get(
+            ADDRESS_SEARCH_REQUEST_URL, params=param, timeout=REQUEST_TIMEOUT
+        )
+        res.raise_for_status()
+    app_metrics.put("gsi.address_search_retries", app_client.get_retry_count(res))
     res_json = res.json()
     logger.debug(
         "address_search", extra={"status": res.status_code, "response": res_json}
     )
+    return _to_address(res_json)
 
+
+@app_metrics.timed("gsi.address_search")
+async def address_search_async(address: str) -> Address:
+    """
+    address_searchの非同期版
+    """
+    # aiohttpは非同期版のハンドラーでしか使わないので、使うときに読み込む
+    import aiohttp
+
+    param = {"q": address}
+    session = app_async.get_http_session()
+    async with rate_limiter.get_rate_limiter("gsi").limit_async():
+        async with session.get(
+            ADDRESS_SEARCH_REQUEST_URL,
+            params=param,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1]
+            ),
+        ) as res:
+            res.raise_for_status()
+            res_json = await res.json(content_type=None)
+            status = res.status
+    logger.debug("address_search_async", extra={"status": status, "response": res_json})
+    return _to_address(res_json)
+
+
+def _to_address(res_json: list) -> Address:
     latitude: float = res_json[0]["geometry"]["coordinates"][1]
     longitude: float = res_json[0]["geometry"]["coordinates"][0]
     address: str = res_json[0]["properties"]["title"]
@@ -1,17 +1,46 @@
 import logging
-import requests
-import boto3
-import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 import app_const
+import app_client
+import app_logging
+import app_metrics
+import app_parameter
+import rate_limiter
 from app_type import Point
 
-ROUTE_REQUEST_URL = "https://router.hereapi.com/v8/routes"
-TOUR_REQUEST_TEMPLATE = "https://tourplanning.hereapi.com/v3/problems?apiKey={api_key}"
+# NOTE ベンチマークなどでスタブサーバーに向けるために環境変数で上書きできる
+ROUTE_REQUEST_URL = os.environ.get(
+    "HERE_ROUTE_URL", "https://router.hereapi.com/v8/routes"
+)
+TOUR_REQUEST_TEMPLATE = (
+    os.environ.get("HERE_TOUR_URL", "https://tourplanning.hereapi.com/v3/problems")
+    + "?apiKey={api_key}"
+)
+MATRIX_REQUEST_URL = os.environ.get(
+    "HERE_MATRIX_URL", "https://matrix.router.hereapi.com/v8/matrix"
+)
+# (接続タイムアウト, 読み込みタイムアウト)秒
+ROUTE_REQUEST_TIMEOUT = (5, 60)
+# NOTE tourplanningは同期的に最適化を行うため読み込みタイムアウトを長めにする
+TOUR_REQUEST_TIMEOUT = (5, 300)
+
+# router APIの1リクエストに含める経由地の最大数
+ROUTE_MAX_VIAS = 100
+# router APIを並列に叩く数
+ROUTE_MAX_WORKERS = 4
+
+# matrix routing APIの1回の同期リクエストに含める出発地と目的地の最大数
+MATRIX_MAX_ORIGINS = 15
+MATRIX_MAX_DESTINATIONS = 100
+MATRIX_REQUEST_TIMEOUT = (5, 60)
 
 logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
 
 
 class TourStop:
+    __slots__ = ("id", "point")
+
     def __init__(self, id: str, point: Point):
         self.id: str = id
         self.point: Point = point
@@ -21,15 +50,13 @@ class HereApi:
     def __init__(
         self, dev_api_key_parameter_name: str, platform_api_key_parameter_name: str
     ):
-        ssm = boto3.client("ssm")
-        res = ssm.get_parameter(
-            Name=platform_api_key_parameter_name, WithDecryption=True
+        # パラメーターはコールドスタート時にまとめて取得されたものを使う
+        self.platform_api_key = app_parameter.get_parameter(
+            platform_api_key_parameter_name
         )
-        self.platform_api_key = res["Parameter"]["Value"]
-
-        res = ssm.get_parameter(Name=dev_api_key_parameter_name, WithDecryption=True)
-        self.dev_api_key = res["Parameter"]["Value"]
+        self.dev_api_key = app_parameter.get_parameter(dev_api_key_parameter_name)
 
+    @app_metrics.timed("here.route")
     def route(
         self, src_point: Point, dest_point: Point, vias: list[Point] = None
     ) -> list[str]:
@@ -38,8 +65,40 @@ class HereApi:
         hereのrouter APIを叩く。
         巡回順序はvias配列に従う。
 
+        経由地がROUTE_MAX_VIASより多い場合は、端の地点を共有する区間に分けて並列にリクエストし、
+        区間ごとの結果を順番につなげる。地点間ごとに1つのpolylineとなるため結果は分けない場合と同じ形になる。
+
         return: [<flexible polyline>]
         """
+        if vias is None or len(vias) <= ROUTE_MAX_VIAS:
+            return self._route(src_point, dest_point, vias)
+
+        # 前の区間の終点を次の区間の始点にする
+        points = [src_point] + vias + [dest_point]
+        chunks = []
+        for start in range(0, len(points) - 1, ROUTE_MAX_VIAS + 1):
+            chunks.append(points[start : start + ROUTE_MAX_VIAS + 2])
+        logger.info(
+            "route", extra={"vias": len(vias), "chunks": [len(c) for c in chunks]}
+        )
+
+        with ThreadPoolExecutor(
+            max_workers=min(ROUTE_MAX_WORKERS, len(chunks))
+        ) as executor:
+            results = executor.map(
+                lambda chunk: self._route(chunk[0], chunk[-1], chunk[1:-1]), chunks
+            )
+            flex_polylines: list[str] = []
+            for result in results:
+                flex_polylines.extend(result)
+        return flex_polylines
+
+    def _route(
+        self, src_point: Point, dest_point: Point, vias: list[Point] = None
+    ) -> list[str]:
+        """
+        router APIを1回叩いてflexible polylineを配列で返す
+        """
         param = {
             "transportMode": "car",
             "origin": f"{src_point.latitude},{src_point.longitude}",
@@ -50,21 +109,34 @@ class HereApi:
 
         # 経由地がある場合はパラメーターに追加
         # NOTE 追加された順番に経由する
-        if vias is not None:
+        if vias is not None and len(vias) > 0:
             param_vias = []
             for via in vias:
                 param_vias.append(f"{via.latitude},{via.longitude}")
             param["via"] = param_vias
 
-        logger.info("route", extra={"request": json.dumps(param)})
+        app_logging.log_payloads(logger, logging.INFO, "route", {"request": param})
 
         # APIキーをログに出したくないのでここで追加する
         param["apikey"] = self.platform_api_key
 
-        res = requests.get(ROUTE_REQUEST_URL, param)
+        session = app_client.get_http_session()
+        with rate_limiter.get_rate_limiter("here").limit():
+            res = session.get(
+                ROUTE_REQUEST_URL, params=param, timeout=ROUTE_REQUEST_TIMEOUT
+            )
+            res.raise_for_status()
+        app_metrics.put("here.route_retries", app_client.get_retry_count(res))
+        app_metrics.put(
+            "here.route_response_bytes", len(res.content), app_metrics.BYTES
+        )
         res_json = res.json()
-        logger.info(
-            "route", extra={"status": res.status_code, "response": json.dumps(res_json)}
+        app_logging.log_payloads(
+            logger,
+            logging.INFO,
+            "route",
+            {"response": res_json},
+            extra={"status": res.status_code},
         )
 
         flex_polylines: list[str] = []
@@ -153,6 +225,7 @@ class HereApi:
             },
         }
 
+    @app_metrics.timed("here.tour")
     def tour(
         self,
         start_point: Point,
@@ -182,18 +255,29 @@ class HereApi:
         req: dict = self._create_tour_plan_dict(
             start_point, jobs, delivery_start_time, delivery_end_time
         )
-        logger.info("tour", extra={"request": json.dumps(req)})
+        app_logging.log_payloads(logger, logging.INFO, "tour", {"request": req})
 
         # APIリクエスト
         headers = {"Content-Type": "application/json"}
-        res = requests.post(
-            TOUR_REQUEST_TEMPLATE.format(api_key=self.dev_api_key),
-            headers=headers,
-            json=req,
-        )
+        session = app_client.get_http_session()
+        with rate_limiter.get_rate_limiter("here").limit():
+            res = session.post(
+                TOUR_REQUEST_TEMPLATE.format(api_key=self.dev_api_key),
+                headers=headers,
+                json=req,
+                timeout=TOUR_REQUEST_TIMEOUT,
+            )
+            res.raise_for_status()
+        app_metrics.put("here.tour_stops", len(stops))
+        app_metrics.put("here.tour_retries", app_client.get_retry_count(res))
+        app_metrics.put("here.tour_response_bytes", len(res.content), app_metrics.BYTES)
         res_json = res.json()
-        logger.info(
-            "tour", extra={"status": res.status_code, "response": json.dumps(res_json)}
+        app_logging.log_payloads(
+            logger,
+            logging.INFO,
+            "tour",
+            {"response": res_json},
+            extra={"status": res.status_code},
         )
 
         # 返り値用stop_idリスト作成
@@ -209,3 +293,90 @@ class HereApi:
                 stop_ids.append(int(job_id))
 
         return stop_ids
+
+    def matrix(self, origins: list[Point], destinations: list[Point]):
+        """
+        originsの各地点からdestinationsの各地点までの道路距離(m)を(len(origins), len(destinations))の行列で返す。
+        hereのmatrix routing APIを叩く。
+        MATRIX_MAX_ORIGINS x MATRIX_MAX_DESTINATIONSずつのブロックに分けて並列にリクエストする。
+        経路が見つからなかった組はnanとする。
+
+        return <numpy.ndarray>
+        """
+        # 巡回順序の計算でだけ使うので、使うときに読み込む
+        import numpy as np
+
+        result = np.full((len(origins), len(destinations)), np.nan)
+        blocks = [
+            (i, j)
+            for i in range(0, len(origins), MATRIX_MAX_ORIGINS)
+            for j in range(0, len(destinations), MATRIX_MAX_DESTINATIONS)
+        ]
+        if len(blocks) == 0:
+            return result
+        logger.info(
+            "matrix",
+            extra={
+                "origins": len(origins),
+                "destinations": len(destinations),
+                "requests": len(blocks),
+            },
+        )
+
+        def request(block: tuple[int, int]):
+            i, j = block
+            distances = self._matrix(
+                origins[i : i + MATRIX_MAX_ORIGINS],
+                destinations[j : j + MATRIX_MAX_DESTINATIONS],
+            )
+            result[i : i + distances.shape[0], j : j + distances.shape[1]] = distances
+
+        with ThreadPoolExecutor(
+            max_workers=min(ROUTE_MAX_WORKERS, len(blocks))
+        ) as executor:
+            # 例外があれば呼び出し元に投げる
+            list(executor.map(request, blocks))
+        return result
+
+    @app_metrics.timed("here.matrix")
+    def _matrix(self, origins: list[Point], destinations: list[Point]):
+        """
+        matrix routing APIを1回叩いて道路距離(m)の行列を返す
+        """
+        import numpy as np
+
+        req = {
+            "origins": [
+                {"lat": point.latitude, "lng": point.longitude} for point in origins
+            ],
+            "destinations": [
+                {"lat": point.latitude, "lng": point.longitude}
+                for point in destinations
+            ],
+            "regionDefinition": {"type": "autoCircle"},
+            "transportMode": "car",
+            "matrixAttributes": ["distances"],
+        }
+        app_logging.log_payloads(logger, logging.INFO, "matrix", {"request": req})
+
+        session = app_client.get_http_session()
+        with rate_limiter.get_rate_limiter("here").limit():
+            res = session.post(
+                MATRIX_REQUEST_URL,
+                params={"async": "false", "apiKey": self.platform_api_key},
+                json=req,
+                timeout=MATRIX_REQUEST_TIMEOUT,
+            )
+            res.raise_for_status()
+        app_metrics.put("here.matrix_retries", app_client.get_retry_count(res))
+        app_metrics.put(
+            "here.matrix_response_bytes", len(res.content), app_metrics.BYTES
+        )
+        matrix = res.json()["matrix"]
+
+        # 出発地ごとに目的地の数ずつ並んだ1次元の配列で返る
+        shape = (matrix["numOrigins"], matrix["numDestinations"])
+        distances = np.array(matrix["distances"], dtype=np.float64).reshape(shape)
+        if "errorCodes" in matrix:
+            distances[np.array(matrix["errorCodes"]).reshape(shape) != 0] = np.nan
+        return distances
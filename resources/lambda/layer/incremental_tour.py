@@ -0,0 +1,159 @@
+import logging
+import time
+import numpy as np
+import app_const
+from app_type import Point
+from local_tour import EPSILON, DistanceOracle, tour_length
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# 挿入した地点の前後この数の地点の範囲で2-optを行う
+# NOTE 反転する区間を範囲内に限ることで、経路を取得し直す区間も挿入した数に比例する
+IMPROVE_WINDOW = 8
+
+
+def cheapest_insertion(
+    oracle: DistanceOracle, tour: list[int], nodes: list[int]
+) -> list[int]:
+    """
+    巡回路tourの、距離の増える量が最も小さい辺にnodesを1つずつ挿入した巡回路を返す。
+    挿入する地点ごとに全ての辺との距離をnumpyでまとめて計算する。
+    """
+    order = np.array(tour, dtype=np.intp)
+    # edges[k]: 地点order[k]からorder[k + 1](末尾の場合は先頭)までの距離
+    edges = np.array(
+        [oracle.distance(order[k - 1], order[k]) for k in range(1, len(order))]
+        + [oracle.distance(order[-1], order[0])]
+    )
+    for node in nodes:
+        row = oracle.row(node)
+        from_dist = row[order]
+        to_dist = np.roll(from_dist, -1)
+        k = int(np.argmin(from_dist + to_dist - edges))
+        order = np.insert(order, k + 1, node)
+        edges[k] = from_dist[k]
+        edges = np.insert(edges, k + 1, to_dist[k])
+    return order.tolist()
+
+
+def improve_around(
+    oracle: DistanceOracle, tour: list[int], nodes: list[int], window: int
+) -> int:
+    """
+    nodesの前後window個の地点の範囲で、範囲の両端を動かさずに2-optで巡回路tourを改善する。
+    地点0(出発地)は動かさない。
+
+    return: 改善した回数
+    """
+    dist = oracle.distance
+    # 出発地に戻る辺も範囲に含めるため、末尾に出発地を付けた経路として扱う
+    path = tour + [tour[0]]
+    targets = set(nodes)
+    positions = [i for i, node in enumerate(path[:-1]) if node in targets]
+
+    moves = 0
+    for p in positions:
+        lo = max(0, p - window)
+        hi = min(len(path) - 1, p + window)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(lo, hi - 2):
+                a, b = path[i], path[i + 1]
+                d_ab = dist(a, b)
+                for j in range(i + 2, hi):
+                    c, d = path[j], path[j + 1]
+                    delta = dist(a, c) + dist(b, d) - d_ab - dist(c, d)
+                    if delta < -EPSILON:
+                        # 辺(a, b), (c, d)を(a, c), (b, d)につなぎ替える
+                        path[i + 1 : j + 1] = path[i + 1 : j + 1][::-1]
+                        moves += 1
+                        improved = True
+                        break
+                if improved:
+                    break
+    tour[:] = path[:-1]
+    return moves
+
+
+def insert_stops(
+    start_point: Point,
+    ordered_points: list[Point],
+    new_points: list[Point],
+    window: int = IMPROVE_WINDOW,
+) -> list[int]:
+    """
+    start_pointから出発してordered_pointsを順に巡回する巡回路に、new_pointsを挿入した巡回順を返す。
+    最も距離が増えない位置に挿入し、windowが0より大きい場合は挿入した位置の周りだけを2-optで改善する。
+    全体を計算し直さないため、処理時間は巡回路全体ではなく主にnew_pointsの数に比例する。
+
+    return: 巡回順に並べた地点のインデックス。ordered_pointsは0から、new_pointsはlen(ordered_points)からの連番
+    """
+    points = [start_point] + ordered_points + new_points
+    latitudes = np.array([point.latitude for point in points])
+    longitudes = np.array([point.longitude for point in points])
+
+    start = time.perf_counter()
+    # 全ての地点間の距離は使わないので距離行列は作らない
+    oracle = DistanceOracle(latitudes, longitudes, max_matrix_points=0)
+    nodes = list(range(len(ordered_points) + 1, len(points)))
+    tour = cheapest_insertion(oracle, list(range(len(ordered_points) + 1)), nodes)
+    moves = improve_around(oracle, tour, nodes, window) if window > 0 else 0
+    logger.info(
+        "insert_stops",
+        extra={
+            "stops": len(ordered_points),
+            "new_stops": len(new_points),
+            "moves": moves,
+            "length": tour_length(oracle, tour),
+            "seconds": time.perf_counter() - start,
+        },
+    )
+
+    # 出発地を除き、元の地点のインデックスに戻す
+    start_index = tour.index(0)
+    tour = tour[start_index + 1 :] + tour[:start_index]
+    return [index - 1 for index in tour]
+
+
+def reusable_legs(
+    old_ids: list, old_legs: list, new_ids: list, max_run_legs: int = None
+) -> tuple[list, list[tuple[int, int]]]:
+    """
+    出発地からold_idsを順に巡回して出発地に戻る区間ごとの値old_legsのうち、
+    new_idsを巡回する場合にも同じ向きで通る区間のものを使いまわす。
+
+    max_run_legs: 使いまわせない区間が続く範囲の間が近い場合は、間の区間も含めてこの数までの区間を1つの範囲にまとめる。
+                  1回のリクエストで取得できる区間の数を渡すと、リクエスト数を減らせる
+
+    return: (<new_idsの区間ごとの値。使いまわせない区間はNone>,
+             [(<使いまわせない区間が続く範囲の最初の区間>, <最後の区間>)])
+    """
+    # 出発地はNoneで表す
+    old_stops = [None] + list(old_ids) + [None]
+    reusable = {(old_stops[k], old_stops[k + 1]): leg for k, leg in enumerate(old_legs)}
+
+    new_stops = [None] + list(new_ids) + [None]
+    legs = [
+        reusable.get((new_stops[k], new_stops[k + 1]))
+        for k in range(len(new_stops) - 1)
+    ]
+
+    runs = []
+    k = 0
+    while k < len(legs):
+        if legs[k] is not None:
+            k += 1
+            continue
+        first = k
+        while k < len(legs) and legs[k] is None:
+            k += 1
+        if (
+            max_run_legs is not None
+            and len(runs) > 0
+            and k - runs[-1][0] <= max_run_legs
+        ):
+            runs[-1] = (runs[-1][0], k - 1)
+        else:
+            runs.append((first, k - 1))
+    return legs, runs
@@ -0,0 +1,130 @@
+import io
+import logging
+import os
+import app_const
+import app_metrics
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# 受け付ける手紙画像の最大サイズ(バイト)
+# これより大きい画像はデコードせずに拒否する
+LETTER_IMAGE_MAX_INPUT_BYTES = int(
+    os.environ.get("LETTER_IMAGE_MAX_INPUT_BYTES", str(20 * 1024 * 1024))
+)
+# 受け付ける手紙画像の最大画素数。展開すると巨大になる画像を拒否する
+LETTER_IMAGE_MAX_PIXELS = int(
+    os.environ.get("LETTER_IMAGE_MAX_PIXELS", str(50_000_000))
+)
+# 縮小後の長辺のピクセル数
+# NOTE Claudeは長辺1568ピクセルを超える画像を内部で縮小するため、それ以上は送っても意味がない
+LETTER_IMAGE_MAX_LONG_EDGE = int(os.environ.get("LETTER_IMAGE_MAX_LONG_EDGE", "1568"))
+# 再エンコード時のJPEG品質
+LETTER_IMAGE_JPEG_QUALITY = int(os.environ.get("LETTER_IMAGE_JPEG_QUALITY", "80"))
+
+# Pillowのフォーマット名とBedrockのConverse APIで指定する画像フォーマットの対応
+BEDROCK_IMAGE_FORMATS = {"PNG": "png", "JPEG": "jpeg", "GIF": "gif", "WEBP": "webp"}
+
+
+class InvalidLetterImageError(Exception):
+    """
+    手紙画像として扱えない入力。リトライしても成功しない。
+    """
+
+
+class LetterImage:
+    __slots__ = ("data", "format", "original_bytes", "original_size", "size")
+
+    def __init__(
+        self,
+        data: bytes,
+        format: str,
+        original_bytes: int,
+        original_size: tuple[int, int],
+        size: tuple[int, int],
+    ):
+        # Bedrockへ渡す画像
+        self.data = data
+        # Bedrockへ渡す画像フォーマット png | jpeg | gif | webp
+        self.format = format
+        # 前処理前のバイト数と(幅, 高さ)
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+        self.size = size
+
+
+@app_metrics.timed()
+def preprocess_letter_image(letter_image: bytes) -> LetterImage:
+    """
+    手紙画像の実際のフォーマットを判定し、長辺をLETTER_IMAGE_MAX_LONG_EDGEまで縮小、
+    グレースケールに変換してエンコードし直す。
+    再エンコードしても小さくならない場合は元の画像をそのまま使う。
+
+    読めない画像や大きすぎる画像はInvalidLetterImageErrorとする。
+    """
+    # Pillowは手紙の解析でしか使わないのでimport時間を他の関数に持ち込まない
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    original_bytes = len(letter_image)
+    if original_bytes == 0:
+        raise InvalidLetterImageError("empty letter image")
+    if original_bytes > LETTER_IMAGE_MAX_INPUT_BYTES:
+        raise InvalidLetterImageError(f"letter image too large: {original_bytes} bytes")
+
+    try:
+        # openはヘッダーだけを読むので、画素数の確認はデコード前にできる
+        image = Image.open(io.BytesIO(letter_image))
+        original_format = image.format
+        original_size = image.size
+        if original_size[0] * original_size[1] > LETTER_IMAGE_MAX_PIXELS:
+            raise InvalidLetterImageError(
+                f"letter image too many pixels: {original_size}"
+            )
+
+        # JPEGは縮小しながらデコードできるので先に指定しておく
+        image.draft("L", (LETTER_IMAGE_MAX_LONG_EDGE, LETTER_IMAGE_MAX_LONG_EDGE))
+
+        # スマートフォンで撮影した画像の向きを直す
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("L")
+        image.thumbnail(
+            (LETTER_IMAGE_MAX_LONG_EDGE, LETTER_IMAGE_MAX_LONG_EDGE),
+            Image.Resampling.LANCZOS,
+        )
+
+        # 写真にはJPEG、スキャンした画像のように色数が少ないものにはPNGが小さくなるため両方試す
+        candidates = []
+        for format, options in (
+            ("JPEG", {"quality": LETTER_IMAGE_JPEG_QUALITY, "optimize": True}),
+            ("PNG", {"optimize": True}),
+        ):
+            buffer = io.BytesIO()
+            image.save(buffer, format=format, **options)
+            candidates.append((buffer.getvalue(), format))
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidLetterImageError(f"unreadable letter image: {e!r}") from e
+
+    data, format = min(candidates, key=lambda candidate: len(candidate[0]))
+    size = image.size
+    if (
+        original_bytes <= len(data)
+        and original_format in BEDROCK_IMAGE_FORMATS
+        and max(original_size) <= LETTER_IMAGE_MAX_LONG_EDGE
+    ):
+        # 縮小の必要がなく元の画像の方が小さい場合はそのまま使う
+        data, format, size = letter_image, original_format, original_size
+
+    app_metrics.put("letter_image_bytes", len(data), app_metrics.BYTES)
+    logger.info(
+        "preprocess_letter_image",
+        extra={
+            "original_format": original_format,
+            "original_bytes": original_bytes,
+            "original_size": original_size,
+            "format": format,
+            "bytes": len(data),
+            "size": size,
+        },
+    )
+    return LetterImage(
+        data, BEDROCK_IMAGE_FORMATS[format], original_bytes, original_size, size
+    )
@@ -0,0 +1,490 @@
+import logging
+import math
+import time
+from collections import deque
+from collections.abc import Callable
+import numpy as np
+import app_const
+from app_type import Point
+from here_api import TourStop
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+EARTH_RADIUS_METERS = 6371008.8
+
+# 距離行列を作成する地点数の上限
+# これより多い場合はメモリに乗らないので必要な距離をその都度計算する
+MATRIX_MAX_POINTS = 2000
+
+# 改善で交換相手の候補とする近傍の地点数
+NEIGHBOR_COUNT = 10
+
+# 改善に使う時間の既定値(秒)
+DEFAULT_TIME_BUDGET_SECONDS = 10.0
+
+# Or-optで移動する区間の最大長
+OR_OPT_MAX_SEGMENT = 3
+
+# 浮動小数点の誤差で改善と判定しないための閾値(m)
+EPSILON = 1e-7
+
+
+def haversine(
+    latitude1: float, longitude1: float, latitude2: float, longitude2: float
+) -> float:
+    """
+    2地点間の大円距離(m)
+    """
+    lat1, lat2 = math.radians(latitude1), math.radians(latitude2)
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1)
+        * math.cos(lat2)
+        * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def haversine_matrix(
+    latitudes1: np.ndarray,
+    longitudes1: np.ndarray,
+    latitudes2: np.ndarray,
+    longitudes2: np.ndarray,
+) -> np.ndarray:
+    """
+    2つの地点の配列の間の大円距離(m)を(len(latitudes1), len(latitudes2))の行列で返す
+    """
+    lat1 = np.radians(latitudes1)[:, None]
+    lng1 = np.radians(longitudes1)[:, None]
+    lat2 = np.radians(latitudes2)[None, :]
+    lng2 = np.radians(longitudes2)[None, :]
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class DistanceOracle:
+    def __init__(
+        self,
+        latitudes: np.ndarray,
+        longitudes: np.ndarray,
+        matrix: np.ndarray = None,
+        max_matrix_points: int = MATRIX_MAX_POINTS,
+    ):
+        """
+        地点間の距離を返す。
+        地点数がmax_matrix_points以下の場合は距離行列を作成し、それより多い場合は都度計算する。
+
+        matrix: 計算済みの距離行列がある場合に渡す
+        max_matrix_points: 一部の地点間の距離しか使わない場合は0にして距離行列を作らない
+        """
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.size = len(latitudes)
+
+        if matrix is None and self.size <= max_matrix_points:
+            matrix = haversine_matrix(latitudes, longitudes, latitudes, longitudes)
+        self.matrix = matrix
+
+        # 都度計算する場合のための値
+        self._lat_rad = np.radians(latitudes).tolist()
+        self._lng_rad = np.radians(longitudes).tolist()
+        self._cos_lat = np.cos(np.radians(latitudes)).tolist()
+
+    def distance(self, i: int, j: int) -> float:
+        if self.matrix is not None:
+            return self.matrix.item(i, j)
+
+        a = (
+            math.sin((self._lat_rad[j] - self._lat_rad[i]) / 2) ** 2
+            + self._cos_lat[i]
+            * self._cos_lat[j]
+            * math.sin((self._lng_rad[j] - self._lng_rad[i]) / 2) ** 2
+        )
+        return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+    def row(self, i: int) -> np.ndarray:
+        """
+        地点iから全地点への距離
+        """
+        if self.matrix is not None:
+            return self.matrix[i].copy()
+        return haversine_matrix(
+            self.latitudes[i : i + 1],
+            self.longitudes[i : i + 1],
+            self.latitudes,
+            self.longitudes,
+        )[0]
+
+    def neighbors(self, count: int) -> list[list[int]]:
+        """
+        各地点から近い順にcount個の地点のリストを返す。
+        近傍の順位付けだけなので、三角関数を使わない正距円筒図法の平面距離で計算する。
+        """
+        count = min(count, self.size - 1)
+        if count <= 0:
+            return [[] for _ in range(self.size)]
+
+        y = np.asarray(self.latitudes, dtype=np.float64)
+        x = np.asarray(self.longitudes, dtype=np.float64) * math.cos(
+            math.radians(float(np.mean(y)))
+        )
+
+        result = []
+        # メモリに乗るよう行をまとめて計算する
+        chunk_size = max(1, 4_000_000 // self.size)
+        for start in range(0, self.size, chunk_size):
+            end = min(start + chunk_size, self.size)
+            block = (x[start:end, None] - x[None, :]) ** 2 + (
+                y[start:end, None] - y[None, :]
+            ) ** 2
+            block[np.arange(end - start), np.arange(start, end)] = np.inf
+            nearest = np.argpartition(block, count - 1, axis=1)[:, :count]
+            nearest_dist = np.take_along_axis(block, nearest, axis=1)
+            order = np.argsort(nearest_dist, axis=1)
+            result.extend(np.take_along_axis(nearest, order, axis=1).tolist())
+        return result
+
+
+def tour_length(oracle: DistanceOracle, tour: list[int]) -> float:
+    """
+    tourを巡回して始点に戻るまでの距離(m)
+    """
+    return sum(oracle.distance(tour[i - 1], tour[i]) for i in range(len(tour)))
+
+
+def nearest_neighbor_tour(
+    oracle: DistanceOracle, neighbors: list[list[int]] = None, start: int = 0
+) -> list[int]:
+    """
+    startから最も近い未訪問の地点を順にたどる巡回路を作成する。
+    neighborsを渡した場合は近傍から未訪問の地点を探し、全て訪問済みの場合だけ全地点から探す。
+    """
+    visited = np.zeros(oracle.size, dtype=bool)
+    tour = [start]
+    visited[start] = True
+    current = start
+    for _ in range(oracle.size - 1):
+        nxt = -1
+        if neighbors is not None:
+            for c in neighbors[current]:
+                if not visited[c]:
+                    nxt = c
+                    break
+        if nxt < 0:
+            row = oracle.row(current)
+            row[visited] = np.inf
+            nxt = int(np.argmin(row))
+        current = nxt
+        visited[current] = True
+        tour.append(current)
+    return tour
+
+
+def _reverse(tour: list[int], pos: list[int], lo: int, hi: int):
+    """
+    tour[lo..hi]を反転する。
+    巡回路なので反対側の区間を反転しても同じ巡回路になるため、短い方を反転する。
+    """
+    n = len(tour)
+    if (hi - lo + 1) * 2 <= n:
+        tour[lo : hi + 1] = tour[lo : hi + 1][::-1]
+        for k in range(lo, hi + 1):
+            pos[tour[k]] = k
+        return
+
+    # tour[hi+1..lo-1]を末尾から先頭へ折り返して反転する
+    i = hi + 1
+    j = lo - 1 + n
+    while i < j:
+        a, b = i % n, j % n
+        tour[a], tour[b] = tour[b], tour[a]
+        pos[tour[a]] = a
+        pos[tour[b]] = b
+        i += 1
+        j -= 1
+
+
+def two_opt(
+    oracle: DistanceOracle,
+    tour: list[int],
+    neighbors: list[list[int]],
+    deadline: float,
+) -> bool:
+    """
+    近傍リストとdon't look bitsを使った2-optで巡回路を改善する
+
+    return: 改善できた場合はTrue
+    """
+    n = len(tour)
+    if n < 4:
+        return False
+
+    dist = oracle.distance
+    pos = [0] * n
+    for i, node in enumerate(tour):
+        pos[node] = i
+
+    queue = deque(tour)
+    in_queue = [True] * n
+    improved_any = False
+    iteration = 0
+    while queue:
+        iteration += 1
+        if iteration % 256 == 0 and time.perf_counter() > deadline:
+            break
+
+        a = queue.popleft()
+        in_queue[a] = False
+
+        improved = False
+        for direction in (1, -1):
+            i = pos[a]
+            b = tour[(i + direction) % n]
+            d_ab = dist(a, b)
+            for c in neighbors[a]:
+                d_ac = dist(a, c)
+                if d_ac >= d_ab:
+                    # 近い順に並んでいるのでこれ以上は改善しない
+                    break
+                j = pos[c]
+                d = tour[(j + direction) % n]
+                if c == b or d == a:
+                    continue
+                delta = d_ac + dist(b, d) - d_ab - dist(c, d)
+                if delta < -EPSILON:
+                    # 辺(a, b), (c, d)を(a, c), (b, d)につなぎ替える
+                    if direction == 1:
+                        p, q = i, j
+                    else:
+                        p, q = (i - 1) % n, (j - 1) % n
+                    _reverse(tour, pos, min(p, q) + 1, max(p, q))
+                    for node in (a, b, c, d):
+                        if not in_queue[node]:
+                            queue.append(node)
+                            in_queue[node] = True
+                    improved = True
+                    improved_any = True
+                    break
+            if improved:
+                break
+    return improved_any
+
+
+def or_opt(
+    oracle: DistanceOracle,
+    tour: list[int],
+    neighbors: list[list[int]],
+    deadline: float,
+) -> bool:
+    """
+    長さOR_OPT_MAX_SEGMENTまでの区間を近傍の地点の隣に移動して巡回路を改善する
+
+    return: 改善できた場合はTrue
+    """
+    n = len(tour)
+    if n < 5:
+        return False
+
+    dist = oracle.distance
+    pos = [0] * n
+    for i, node in enumerate(tour):
+        pos[node] = i
+
+    improved_any = False
+    i = 0
+    while i < n:
+        if time.perf_counter() > deadline:
+            break
+
+        moved = False
+        for length in range(1, OR_OPT_MAX_SEGMENT + 1):
+            if i + length >= n:
+                break
+            segment = tour[i : i + length]
+            first, last = segment[0], segment[-1]
+            prev = tour[i - 1]
+            nxt = tour[(i + length) % n]
+            removal_gain = dist(prev, first) + dist(last, nxt) - dist(prev, nxt)
+            if removal_gain <= EPSILON:
+                continue
+
+            best = None
+            for end in (first, last):
+                for c in neighbors[end]:
+                    if dist(end, c) >= removal_gain:
+                        # 近い順に並んでいるのでこれ以上は改善が見込めない
+                        break
+                    if pos[c] >= i and pos[c] < i + length:
+                        continue
+                    for u, v in (
+                        (c, tour[(pos[c] + 1) % n]),
+                        (tour[(pos[c] - 1) % n], c),
+                    ):
+                        if (pos[v] >= i and pos[v] < i + length) or (
+                            pos[u] >= i and pos[u] < i + length
+                        ):
+                            continue
+                        d_uv = dist(u, v)
+                        forward = dist(u, first) + dist(last, v) - d_uv
+                        backward = dist(u, last) + dist(first, v) - d_uv
+                        add, reverse = (
+                            (forward, False)
+                            if forward <= backward
+                            else (backward, True)
+                        )
+                        if add < removal_gain - EPSILON and (
+                            best is None or add < best[0]
+                        ):
+                            best = (add, u, reverse)
+
+            if best is not None:
+                _, u, reverse = best
+                del tour[i : i + length]
+                insert_at = (pos[u] if pos[u] < i else pos[u] - length) + 1
+                tour[insert_at:insert_at] = segment[::-1] if reverse else segment
+                # 位置が変わった範囲だけ更新する
+                for k in range(min(i, insert_at), max(i, insert_at) + length):
+                    pos[tour[k]] = k
+                moved = True
+                improved_any = True
+                break
+
+        if not moved:
+            i += 1
+    return improved_any
+
+
+def solve_tour(
+    oracle: DistanceOracle,
+    time_budget_seconds: float = DEFAULT_TIME_BUDGET_SECONDS,
+) -> list[int]:
+    """
+    地点0から出発し全地点を巡回して地点0に戻る巡回路を返す。
+    最近傍法で初期解を作り、時間の許す限り2-optとOr-optで改善する。
+
+    return: 地点0から始まる地点のインデックスのリスト
+    """
+    deadline = time.perf_counter() + time_budget_seconds
+    neighbors = oracle.neighbors(NEIGHBOR_COUNT)
+    tour = nearest_neighbor_tour(oracle, neighbors)
+    if oracle.size < 4:
+        return tour
+
+    while time.perf_counter() < deadline:
+        improved = two_opt(oracle, tour, neighbors, deadline)
+        improved = or_opt(oracle, tour, neighbors, deadline) or improved
+        if not improved:
+            break
+
+    # 地点0が先頭になるように回転する
+    start = tour.index(0)
+    return tour[start:] + tour[:start]
+
+
+def stop_coordinates(
+    start_point: Point, stops: list[TourStop]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    start_pointを地点0、stopsを地点1からとした緯度と経度の配列
+    """
+    latitudes = np.empty(len(stops) + 1)
+    longitudes = np.empty(len(stops) + 1)
+    latitudes[0] = start_point.latitude
+    longitudes[0] = start_point.longitude
+    for i, stop in enumerate(stops, start=1):
+        latitudes[i] = stop.point.latitude
+        longitudes[i] = stop.point.longitude
+    return latitudes, longitudes
+
+
+def solve_coordinates(
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    matrix: np.ndarray,
+    time_budget_seconds: float,
+) -> list[int]:
+    """
+    地点0から出発する巡回路を返す。I/Oを行わずCPUだけを使う。
+    別のプロセスで実行できるよう、引数はpickleできる値だけにする。
+
+    matrix: 計算済みの距離行列。無い場合はNone
+    return: 地点0から始まる地点のインデックスのリスト
+    """
+    return solve_tour(
+        DistanceOracle(latitudes, longitudes, matrix), time_budget_seconds
+    )
+
+
+class LocalTourSolver:
+    def __init__(
+        self,
+        time_budget_seconds: float = DEFAULT_TIME_BUDGET_SECONDS,
+        travel_cost: Callable[[np.ndarray, np.ndarray], np.ndarray] = None,
+        travel_cost_max_points: int = MATRIX_MAX_POINTS,
+    ):
+        """
+        HereApi.tourの代わりにLambda内で巡回順序を計算する。
+        距離は大円距離で近似する。
+
+        travel_cost: (<緯度の配列>, <経度の配列>)から全ての地点間の移動コストの行列を返す関数。
+                     例: TravelCostStore.matrix 渡した場合は大円距離の代わりに使う
+        travel_cost_max_points: 地点数がこれより多い場合はtravel_costを使わない
+        """
+        self.time_budget_seconds = time_budget_seconds
+        self.travel_cost = travel_cost
+        self.travel_cost_max_points = travel_cost_max_points
+
+    def travel_cost_matrix(
+        self, latitudes: np.ndarray, longitudes: np.ndarray
+    ) -> np.ndarray:
+        """
+        travel_costで求めた距離行列。使わない場合と求められなかった場合はNone
+        """
+        if self.travel_cost is None or len(latitudes) > self.travel_cost_max_points:
+            return None
+        try:
+            costs = self.travel_cost(latitudes, longitudes)
+        except Exception as e:
+            # 大円距離で計算を続ける
+            logger.warning("travel_cost", extra={"error": repr(e)})
+            return None
+        # 2-optは往路と復路の距離が同じことを前提とするので平均する
+        return (costs + costs.T) / 2
+
+    def tour(
+        self,
+        start_point: Point,
+        stops: list[TourStop],
+        delivery_start_time: str,
+        delivery_end_time: str,
+    ) -> list:
+        """
+        start_pointから出発し、全てのstopsを巡回する順番を返す。
+        HereApi.tourと同じく返り値のリストにはstart_pointを含まず、stopsのidのみを含む。
+
+        NOTE 配達時間枠は考慮しない。引数はHereApi.tourと揃えるために受け取る。
+
+        return [<stop_id>]
+        """
+        if len(stops) == 0:
+            return []
+
+        start = time.perf_counter()
+        latitudes, longitudes = stop_coordinates(start_point, stops)
+        oracle = DistanceOracle(
+            latitudes, longitudes, self.travel_cost_matrix(latitudes, longitudes)
+        )
+        tour = solve_tour(oracle, self.time_budget_seconds)
+        logger.info(
+            "tour",
+            extra={
+                "stops": len(stops),
+                "length": tour_length(oracle, tour),
+                "seconds": time.perf_counter() - start,
+            },
+        )
+
+        return [int(stops[index - 1].id) for index in tour[1:]]
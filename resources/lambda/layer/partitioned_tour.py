@@ -0,0 +1,265 @@
+import logging
+import math
+import multiprocessing
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import app_const
+from app_type import Point
+from here_api import HereApi, TourStop
+from local_tour import (
+    DistanceOracle,
+    LocalTourSolver,
+    haversine,
+    solve_coordinates,
+    stop_coordinates,
+    tour_length,
+)
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# 1つの区画に含める配達先の数の既定値
+DEFAULT_MAX_STOPS_PER_PARTITION = 200
+
+# 区画ごとの巡回順序を並列に計算する数の既定値
+DEFAULT_MAX_WORKERS = 4
+
+# 子プロセスはforkserverから作る
+# NOTE スレッド(パラメーターの更新、コネクションプールなど)が動いているプロセスをforkすると、
+#      fork時に他のスレッドが持っていたロックを子プロセスで待ち続けることがあるため、
+#      スレッドの無いforkserverのプロセスからforkする。numpyとlocal_tourは読み込んでおく
+_process_context = multiprocessing.get_context("forkserver")
+_process_context.set_forkserver_preload(["numpy", "local_tour"])
+
+
+def partition_stops(
+    start_point: Point, stops: list[TourStop], max_stops: int
+) -> list[list[TourStop]]:
+    """
+    配達拠点から見た方角で配達先を並べ、max_stops以下の同じ数ずつの区画に分ける。
+    区画は方角の順(反時計回り)に並ぶ。
+    """
+    partition_count = math.ceil(len(stops) / max_stops)
+    if partition_count <= 1:
+        return [stops]
+
+    latitudes = np.array([stop.point.latitude for stop in stops])
+    longitudes = np.array([stop.point.longitude for stop in stops])
+    x = (longitudes - start_point.longitude) * math.cos(
+        math.radians(start_point.latitude)
+    )
+    y = latitudes - start_point.latitude
+    angles = np.arctan2(y, x)
+
+    # 配達先の無い方角が最も大きく開いている所から走査を始め、まとまった地域を分断しにくくする
+    order = np.argsort(angles)
+    sorted_angles = angles[order]
+    gaps = np.diff(np.concatenate([sorted_angles, sorted_angles[:1] + 2 * math.pi]))
+    start = (int(np.argmax(gaps)) + 1) % len(stops)
+    order = np.roll(order, -start)
+
+    return [
+        [stops[i] for i in chunk]
+        for chunk in np.array_split(order, partition_count)
+        if len(chunk) > 0
+    ]
+
+
+def _run_in_child(conn, function: Callable, args: tuple):
+    """
+    子プロセスでfunction(*args)を実行し、(<成功したか>, <結果または例外の文字列>)をconnに送る
+    """
+    try:
+        conn.send((True, function(*args)))
+    except BaseException as e:
+        conn.send((False, repr(e)))
+    finally:
+        conn.close()
+
+
+def run_in_processes(function: Callable, args_list: list[tuple]) -> list:
+    """
+    function(*args)をargs_listの要素ごとに別のプロセスで並列に実行し、結果をargs_listの順に返す。
+    functionと引数は子プロセスに送るのでpickleできるものにする。
+    NOTE LambdaにはPoolやQueueが使う共有メモリ(/dev/shm)が無いため、ProcessとPipeを使う
+    """
+    context = _process_context
+    jobs = []
+    try:
+        for args in args_list:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_run_in_child, args=(sender, function, args), daemon=True
+            )
+            process.start()
+            # 子プロセスが異常終了した場合にrecvがEOFErrorになるよう、親プロセス側の送信口を閉じる
+            sender.close()
+            jobs.append((process, receiver))
+
+        results = []
+        for process, receiver in jobs:
+            try:
+                ok, value = receiver.recv()
+            except EOFError:
+                process.join()
+                raise RuntimeError(f"child process exited with code {process.exitcode}")
+            if not ok:
+                raise RuntimeError(value)
+            results.append(value)
+        return results
+    finally:
+        for process, receiver in jobs:
+            receiver.close()
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+class PartitionedTourSolver:
+    def __init__(
+        self,
+        tour_solver: HereApi | LocalTourSolver,
+        max_stops_per_partition: int = DEFAULT_MAX_STOPS_PER_PARTITION,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+    ):
+        """
+        配達先が多い場合に、配達拠点の周りを方角で区画に分け、
+        区画ごとの巡回順序をtour_solverで並列に計算してつなぎ合わせる。
+          - HereApi: 待ち時間がほとんどなのでスレッドで並列にリクエストする
+          - LocalTourSolver: CPUで計算するため、GILの影響を受けないよう区画ごとにforkserverの子プロセスで計算する。
+                             同時に計算する区画の数はCPU数までとし、
+                             全体の計算時間が変わらないよう区画あたりの改善時間を計算の回数で割る
+        NOTE LambdaのCPU数はメモリサイズに比例するため、複数コアを使うにはメモリサイズを大きくする
+        """
+        self.tour_solver = tour_solver
+        self.max_stops_per_partition = max_stops_per_partition
+        self.max_workers = max_workers
+
+    def tour(
+        self,
+        start_point: Point,
+        stops: list[TourStop],
+        delivery_start_time: str,
+        delivery_end_time: str,
+    ) -> list:
+        """
+        tour_solver.tourと同じくstopsのidを巡回順に並べたリストを返す。
+
+        return [<stop_id>]
+        """
+        partitions = partition_stops(start_point, stops, self.max_stops_per_partition)
+        if len(partitions) <= 1:
+            return self.tour_solver.tour(
+                start_point, stops, delivery_start_time, delivery_end_time
+            )
+
+        logger.info(
+            "tour",
+            extra={
+                "stops": len(stops),
+                "partitions": [len(partition) for partition in partitions],
+            },
+        )
+
+        # 区画ごとの巡回順序を並列に計算する
+        if isinstance(self.tour_solver, LocalTourSolver):
+            sub_tours = self._local_tours(start_point, partitions)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(partitions))
+            ) as executor:
+                sub_tours = list(
+                    executor.map(
+                        lambda partition: self.tour_solver.tour(
+                            start_point,
+                            partition,
+                            delivery_start_time,
+                            delivery_end_time,
+                        ),
+                        partitions,
+                    )
+                )
+
+        # 区画を方角順につなぐ
+        # 各区画の巡回路は配達拠点を始点・終点とするので、前の区画の最後の配達先に近い方の端から巡回する
+        stop_dict = {int(stop.id): stop.point for stop in stops}
+        stop_ids = []
+        last_point = start_point
+        for sub_tour in sub_tours:
+            if len(sub_tour) == 0:
+                continue
+            head = stop_dict[sub_tour[0]]
+            tail = stop_dict[sub_tour[-1]]
+            if haversine(
+                last_point.latitude, last_point.longitude, tail.latitude, tail.longitude
+            ) < haversine(
+                last_point.latitude, last_point.longitude, head.latitude, head.longitude
+            ):
+                sub_tour = sub_tour[::-1]
+            stop_ids.extend(sub_tour)
+            last_point = stop_dict[sub_tour[-1]]
+
+        return stop_ids
+
+    def _local_tours(
+        self, start_point: Point, partitions: list[list[TourStop]]
+    ) -> list[list]:
+        """
+        LocalTourSolverで区画ごとの巡回順序を子プロセスで並列に計算する
+
+        return [[<stop_id>]]
+        """
+        solver: LocalTourSolver = self.tour_solver
+        start = time.perf_counter()
+
+        # 移動コストの取得はI/Oを伴うので親プロセスのスレッドで行い、子プロセスには座標と距離行列だけを渡す
+        coordinates = [
+            stop_coordinates(start_point, partition) for partition in partitions
+        ]
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(partitions))
+        ) as executor:
+            matrices = list(
+                executor.map(
+                    lambda coordinate: solver.travel_cost_matrix(*coordinate),
+                    coordinates,
+                )
+            )
+
+        processes = min(self.max_workers, len(partitions), os.cpu_count() or 1)
+        rounds = math.ceil(len(partitions) / processes)
+        time_budget_seconds = solver.time_budget_seconds / rounds
+        args_list = [
+            (latitudes, longitudes, matrix, time_budget_seconds)
+            for (latitudes, longitudes), matrix in zip(coordinates, matrices)
+        ]
+        if processes <= 1:
+            tours = [solve_coordinates(*args) for args in args_list]
+        else:
+            tours = []
+            for i in range(0, len(args_list), processes):
+                tours.extend(
+                    run_in_processes(solve_coordinates, args_list[i : i + processes])
+                )
+
+        oracles = [
+            DistanceOracle(latitudes, longitudes, matrix, max_matrix_points=0)
+            for (latitudes, longitudes), matrix in zip(coordinates, matrices)
+        ]
+        logger.info(
+            "local_tours",
+            extra={
+                "processes": processes,
+                "time_budget_seconds": time_budget_seconds,
+                "length": sum(
+                    tour_length(oracle, tour) for oracle, tour in zip(oracles, tours)
+                ),
+                "seconds": time.perf_counter() - start,
+            },
+        )
+        return [
+            [int(partition[index - 1].id) for index in tour[1:]]
+            for partition, tour in zip(partitions, tours)
+        ]
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+import app_const
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# スロットリングとして扱うHTTPステータスとAWSのエラーコード
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+THROTTLE_ERROR_CODES = frozenset(
+    [
+        "ThrottlingException",
+        "TooManyRequestsException",
+        "ServiceUnavailableException",
+        "ServiceQuotaExceededException",
+    ]
+)
+
+# サービスごとの既定値
+# (<初期レート>, <最小レート>, <最大レート>, <バースト>, <最大待ち時間(秒)>)
+# レートは1秒あたりのリクエスト数
+# NOTE Lambdaインスタンスごとの値。全体ではLambdaの同時実行数倍になる
+DEFAULT_LIMITS = {
+    "bedrock": (2.0, 0.2, 10.0, 5, 5.0),
+    "gsi": (10.0, 1.0, 20.0, 10, 5.0),
+    "here": (5.0, 0.5, 10.0, 5, 10.0),
+}
+
+# 成功するごとにレートに足す値と、スロットリングされたときにレートに掛ける値
+ADDITIVE_INCREASE = 0.1
+MULTIPLICATIVE_DECREASE = 0.5
+
+
+class RateLimitExceededError(Exception):
+    """
+    レートの上限に達した、またはスロットリングされた。時間を置けば成功する。
+    """
+
+
+def is_throttle(e: Exception) -> bool:
+    """
+    例外が呼び出し先のスロットリングによるものか判定する
+    """
+    # requests.HTTPError
+    response = getattr(e, "response", None)
+    if getattr(response, "status_code", None) in THROTTLE_STATUS_CODES:
+        return True
+    # botocore.exceptions.ClientError
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+    # aiohttp.ClientResponseError
+    return getattr(e, "status", None) in THROTTLE_STATUS_CODES
+
+
+class AdaptiveRateLimiter:
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        burst: int,
+        max_wait_seconds: float,
+    ):
+        """
+        トークンバケットで呼び出しのレートを制限し、レートはAIMDで調整する。
+        成功するごとにレートを少しずつ上げ、スロットリングされると半分にする。
+
+        トークンが無い場合はmax_wait_secondsまでは待つが、それ以上待つ必要がある場合は
+        Lambdaの実行時間を待ち合わせに使わないよう、待たずにRateLimitExceededErrorとする。
+        """
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.max_wait_seconds = max_wait_seconds
+
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.throttles = 0
+        self.rejects = 0
+
+    def _reserve(self) -> float:
+        """
+        トークンを1つ予約し、使えるようになるまでの待ち時間(秒)を返す
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > self.max_wait_seconds:
+                self.rejects += 1
+                raise RateLimitExceededError(
+                    f"{self.name}: rate limit exceeded (rate={self.rate:.2f}/s)"
+                )
+            # 予約した分はトークンを前借りする
+            self._tokens -= 1
+            return wait
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * MULTIPLICATIVE_DECREASE)
+            self._tokens = min(self._tokens, 0.0)
+            self.throttles += 1
+        logger.warning("on_throttle", extra={"limiter": self.name, "rate": self.rate})
+
+    def _on_error(self, e: Exception):
+        if is_throttle(e):
+            self.on_throttle()
+            raise RateLimitExceededError(f"{self.name}: throttled") from e
+
+    @contextmanager
+    def limit(self):
+        """
+        ブロック内の呼び出しをレート制限する。
+        HTTPの場合はブロック内でraise_for_statusを呼び、スロットリングを例外にする。
+        """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            yield
+        except Exception as e:
+            self._on_error(e)
+            raise
+        self.on_success()
+
+    @asynccontextmanager
+    async def limit_async(self):
+        """
+        limitの非同期版
+        """
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            yield
+        except Exception as e:
+            self._on_error(e)
+            raise
+        self.on_success()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "rate": round(self.rate, 3),
+                "throttles": self.throttles,
+                "rejects": self.rejects,
+            }
+
+
+# Lambdaインスタンス内で共有する
+_lock = threading.Lock()
+_limiters: dict[str, AdaptiveRateLimiter] = {}
+
+
+def get_rate_limiter(name: str) -> AdaptiveRateLimiter:
+    """
+    サービスごとのレート制限を返す。
+    既定値は環境変数RATE_LIMIT_<NAME>_RPS、RATE_LIMIT_<NAME>_MAX_RPSで上書きできる。
+    """
+    with _lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            rate, min_rate, max_rate, burst, max_wait_seconds = DEFAULT_LIMITS[name]
+            prefix = f"RATE_LIMIT_{name.upper()}"
+            rate = float(os.environ.get(f"{prefix}_RPS", rate))
+            max_rate = max(rate, float(os.environ.get(f"{prefix}_MAX_RPS", max_rate)))
+            limiter = AdaptiveRateLimiter(
+                name, rate, min_rate, max_rate, burst, max_wait_seconds
+            )
+            _limiters[name] = limiter
+        return limiter
+
+
+def stats() -> list[dict]:
+    with _lock:
+        limiters = list(_limiters.values())
+    return [limiter.stats() for limiter in limiters]
@@ -0,0 +1,191 @@
+import logging
+import time
+from collections.abc import Callable
+import numpy as np
+import app_const
+from app_aurora import Aurora
+from app_type import Point
+from local_tour import haversine_matrix
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# 地点のキーにする緯度経度の小数点以下の桁数。5桁で約1m
+POINT_KEY_DECIMALS = 5
+
+# Auroraのtravel_costテーブルのレコードの有効期間(日)。道路の変化を反映するため古いものは求め直す
+TRAVEL_COST_TTL_DAYS = 90
+# 経路が見つからなかった組(costがNULL)の有効期間(日)。道路が開通することがあるので短くする
+TRAVEL_COST_UNREACHABLE_TTL_DAYS = 7
+
+# 1つのINSERT文で保存する組の数
+INSERT_BATCH_SIZE = 10000
+
+# Auroraのtravel_costテーブルの参照と更新
+SELECT_QUERY = "SELECT origin_key, destination_key, cost FROM travel_cost WHERE origin_key = ANY(%s) AND destination_key = ANY(%s) AND updated_at > now() - make_interval(days => CASE WHEN cost IS NULL THEN %s ELSE %s END)"
+UPSERT_QUERY = "INSERT INTO travel_cost (origin_key, destination_key, cost, updated_at) SELECT origin_key, destination_key, cost, now() FROM unnest(%s::text[], %s::text[], %s::real[]) AS t(origin_key, destination_key, cost) ON CONFLICT (origin_key, destination_key) DO UPDATE SET cost = EXCLUDED.cost, updated_at = EXCLUDED.updated_at"
+
+
+def point_keys(latitudes: np.ndarray, longitudes: np.ndarray) -> list[str]:
+    """
+    緯度経度をPOINT_KEY_DECIMALS桁に丸めた地点のキー
+    """
+    return [
+        f"{latitude:.{POINT_KEY_DECIMALS}f},{longitude:.{POINT_KEY_DECIMALS}f}"
+        for latitude, longitude in zip(
+            np.asarray(latitudes).tolist(), np.asarray(longitudes).tolist()
+        )
+    ]
+
+
+class TravelCostStore:
+    def __init__(
+        self,
+        aurora: Aurora,
+        cost_function: Callable[[list[Point], list[Point]], np.ndarray],
+    ):
+        """
+        地点間の移動コストをAuroraのtravel_costテーブルに保存し、巡回順序の計算ごとに使いまわす。
+        地点は緯度経度を丸めたキーで表すため、同じ住所の配達先は同じ地点として扱う。
+
+        cost_function: (<出発地のリスト>, <目的地のリスト>)から移動コストの行列を返す関数。例: HereApi.matrix
+        """
+        self.aurora = aurora
+        self.cost_function = cost_function
+
+    def matrix(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        """
+        全ての地点間の移動コストを(地点数, 地点数)の行列で返す。
+        保存済みの組はまとめて読み込み、保存されていない組がある地点(新しい地点)についてだけ
+        他の全ての地点との移動コストをcost_functionで求めて保存する。
+        経路が見つからない組は見つからなかったことを保存し、大円距離で代用する。
+        """
+        start = time.perf_counter()
+        keys = point_keys(latitudes, longitudes)
+        # {<キー>: <そのキーの最初の地点の番号>}
+        first_rows: dict[str, int] = {}
+        for row, key in enumerate(keys):
+            first_rows.setdefault(key, row)
+        unique_keys = list(first_rows)
+        index = {key: i for i, key in enumerate(unique_keys)}
+        size = len(unique_keys)
+
+        costs = np.full((size, size), np.nan)
+        np.fill_diagonal(costs, 0.0)
+        for rows in self.aurora.select_stream(
+            SELECT_QUERY,
+            (
+                unique_keys,
+                unique_keys,
+                TRAVEL_COST_UNREACHABLE_TTL_DAYS,
+                TRAVEL_COST_TTL_DAYS,
+            ),
+        ):
+            origins = np.fromiter(
+                (index[row[0]] for row in rows), dtype=np.intp, count=len(rows)
+            )
+            destinations = np.fromiter(
+                (index[row[1]] for row in rows), dtype=np.intp, count=len(rows)
+            )
+            # 経路が見つからなかった組(NULL)はinfにして、保存されていない組(nan)と区別する
+            costs[origins, destinations] = np.fromiter(
+                (np.inf if row[2] is None else row[2] for row in rows),
+                dtype=np.float64,
+                count=len(rows),
+            )
+
+        missing = np.isnan(costs)
+        stored_pairs = size * size - size - int(missing.sum())
+        # 他のどの地点との組も保存されていない地点を新しい地点とする
+        # それ以外の地点どうしで保存されていない組がある場合(有効期間切れなど)はその出発地も新しい地点とする
+        new_mask = missing.sum(axis=1) == size - 1
+        new_mask |= (missing & ~new_mask[:, None] & ~new_mask[None, :]).any(axis=1)
+        new = np.flatnonzero(new_mask) if size > 1 else np.array([], dtype=np.intp)
+        rows = np.array(list(first_rows.values()), dtype=np.intp)
+        unique_latitudes = np.asarray(latitudes)[rows]
+        unique_longitudes = np.asarray(longitudes)[rows]
+        filled_pairs = 0
+        if len(new) > 0:
+            filled_pairs = self._fill(
+                costs, unique_keys, unique_latitudes, unique_longitudes, new
+            )
+
+        # 経路が見つからない組は大円距離で代用する
+        # NOTE 代用した値は道路距離ではないので保存しない
+        unreachable = np.isinf(costs)
+        if unreachable.any():
+            costs[unreachable] = haversine_matrix(
+                unique_latitudes, unique_longitudes, unique_latitudes, unique_longitudes
+            )[unreachable]
+
+        logger.info(
+            "travel_cost",
+            extra={
+                "points": size,
+                "new_points": len(new),
+                "stored_pairs": stored_pairs,
+                "filled_pairs": filled_pairs,
+                "unreachable_pairs": int(unreachable.sum()),
+                "seconds": time.perf_counter() - start,
+            },
+        )
+
+        rows = np.array([index[key] for key in keys], dtype=np.intp)
+        return costs[np.ix_(rows, rows)]
+
+    def _fill(
+        self,
+        costs: np.ndarray,
+        keys: list[str],
+        latitudes: np.ndarray,
+        longitudes: np.ndarray,
+        new: np.ndarray,
+    ) -> int:
+        """
+        新しい地点newから全ての地点へ、それ以外の地点からnewへの移動コストを求めてcostsに書き込み、保存する。
+        経路が見つからなかった組はcostsにinfを書き込み、costをNULLとして保存する。
+
+        return: 求めて保存した組の数
+        """
+        points = [
+            Point(latitude, longitude)
+            for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist())
+        ]
+        old = np.setdiff1d(np.arange(len(keys)), new)
+        costs[new, :] = self.cost_function([points[i] for i in new], points)
+        if len(old) > 0:
+            costs[np.ix_(old, new)] = self.cost_function(
+                [points[i] for i in old], [points[i] for i in new]
+            )
+        np.fill_diagonal(costs, 0.0)
+
+        filled = np.zeros(costs.shape, dtype=bool)
+        filled[new, :] = True
+        filled[:, new] = True
+        np.fill_diagonal(filled, False)
+
+        unreachable = np.isnan(costs)
+        if unreachable.any():
+            logger.warning(
+                "travel_cost", extra={"unreachable_pairs": int(unreachable.sum())}
+            )
+            costs[unreachable] = np.inf
+        origins, destinations = np.nonzero(filled)
+        key_array = np.array(keys, dtype=object)
+        values = costs[origins, destinations]
+        values = np.where(np.isinf(values), None, values)
+        try:
+            for start in range(0, len(origins), INSERT_BATCH_SIZE):
+                batch = slice(start, start + INSERT_BATCH_SIZE)
+                self.aurora.update_commit(
+                    UPSERT_QUERY,
+                    (
+                        key_array[origins[batch]].tolist(),
+                        key_array[destinations[batch]].tolist(),
+                        values[batch].tolist(),
+                    ),
+                    prepare=True,
+                )
+        except Exception as e:
+            # 保存できなくても求めた移動コストで巡回順序の計算は続ける
+            logger.warning("travel_cost", extra={"error": repr(e)})
+        return len(origins)
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import app_async
+import app_const
+import app_logging
+import app_metrics
+import app_startup
+from app_aurora_async import AsyncAurora
+from geocode_cache import AsyncGeocodeCache
+from letter_image import InvalidLetterImageError, preprocess_letter_image
+import rate_limiter
+from rate_limiter import RateLimitExceededError
+from lambda_function import (
+    AURORA_SECRET_NAME,
+    LETTER_ANALYSIS_BATCH_SIZE,
+    RECORD_CONCURRENCY,
+    EventParam,
+    LetterInfo,
+    LetterRecord,
+    analyze_letter_image,
+    analyze_letter_images,
+    get_letter_hash,
+    get_letter_image,
+)
+
+# lambda_function.lambda_handlerを非同期I/Oで処理する版
+# S3、Bedrock、国土地理院API、Auroraの待ち時間を1つのイベントループ上で重ね合わせる
+# NOTE boto3には非同期版が無いためスレッドで実行し、イベントループから待ち合わせる
+
+logger = logging.getLogger(app_const.PROJECT_NAME).getChild(__name__)
+
+# 1回の呼び出しで同時に処理するSQSレコード数
+# NOTE スレッドで処理する場合と違い、待ち時間の間はCPUもDBコネクションも使わないので大きくできる
+#      Auroraへの接続数はRECORD_CONCURRENCYまでに抑える
+ASYNC_RECORD_CONCURRENCY = int(os.environ.get("ASYNC_RECORD_CONCURRENCY", "100"))
+
+# Lambdaインスタンスがまだ生きているときに呼び出された場合に
+# DB接続等を使いまわすため大域変数として宣言
+# NOTE app_asyncのイベントループに紐づく
+aurora: AsyncAurora = None
+geocode_cache: AsyncGeocodeCache = None
+
+# コールドスタート時の初期化処理
+# シークレットを取得してAsyncAuroraを作成する。接続はイベントループ上で行う
+startup = app_startup.Startup(__name__)
+startup.add(
+    "aurora",
+    lambda: AsyncAurora(AURORA_SECRET_NAME, max_connections=RECORD_CONCURRENCY),
+)
+
+
+async def open_aurora(timeout: float = 30.0):
+    """
+    Aurora接続用インスタンスが無い場合は作成して接続する
+    """
+    global aurora
+    if aurora is None:
+        new_aurora: AsyncAurora = await app_async.to_thread(startup.get, "aurora")
+        await new_aurora.open(timeout)
+        aurora = new_aurora
+
+
+async def select_letter_info(letter_hash: str) -> LetterInfo:
+    """
+    同じ手紙画像を解析済みの場合はその結果を返す。無い場合はNone
+    """
+    query = "SELECT present_name, address FROM letter_analysis WHERE letter_hash = %s"
+    try:
+        rows = await aurora.select(query, (letter_hash,))
+    except Exception as e:
+        # キャッシュが読めない場合は解析し直す
+        logger.warning("select_letter_info", extra={"error": repr(e)})
+        return None
+
+    if len(rows) == 0:
+        app_metrics.put("letter_analysis_cache.miss", 1)
+        return None
+    app_metrics.put("letter_analysis_cache.hit", 1)
+    logger.info("select_letter_info", extra={"letter_hash": letter_hash})
+    return LetterInfo(rows[0]["present_name"], rows[0]["address"])
+
+
+async def insert_letter_info(letter_hash: str, letter_info: LetterInfo):
+    """
+    SQSからの再配信時にBedrockを呼ばずに済むよう解析結果を保存する
+    """
+    query = "INSERT INTO letter_analysis (letter_hash, present_name, address) VALUES (%s, %s, %s) ON CONFLICT (letter_hash) DO NOTHING"
+    param = (letter_hash, letter_info.present_name, letter_info.address)
+    try:
+        await aurora.update_commit(query, param)
+    except Exception as e:
+        # 保存できなくても後続の処理は続ける
+        logger.warning("insert_letter_info", extra={"error": repr(e)})
+
+
+@app_metrics.timed()
+async def insert_presents(letter_records: list[LetterRecord]):
+    """
+    複数のプレゼントを1つのINSERT文、1回のコミットでpresentテーブルに保存する
+    """
+    query = "INSERT INTO present (present_name, address, point) VALUES %s"
+    template = "(%s, %s, ST_GeomFromText('POINT(%s %s)'))"
+    params = [
+        (
+            letter_record.letter_info.present_name,
+            letter_record.address.address,
+            letter_record.address.point.latitude,
+            letter_record.address.point.longitude,
+        )
+        for letter_record in letter_records
+    ]
+    app_logging.log_payloads(
+        logger,
+        logging.INFO,
+        "insert_presents",
+        {"params": params},
+        extra={"query": query},
+    )
+    app_metrics.put("insert_presents_rows", len(params))
+    await aurora.insert_many(query, params, template)
+
+
+async def prepare_record(letter_record: LetterRecord):
+    """
+    lambda_function.prepare_recordの非同期版
+    """
+    # イベントから必要なパラメーターを取得
+    param: EventParam = EventParam(letter_record.event_record)
+
+    # S3から手紙画像を取得
+    letter_image: bytes = await app_async.to_thread(get_letter_image, param)
+
+    # 再配信などで解析済みの画像の場合はBedrockを呼ばずに保存済みの結果を使う
+    letter_record.letter_hash = get_letter_hash(letter_image)
+    letter_record.letter_info = await select_letter_info(letter_record.letter_hash)
+    if letter_record.letter_info is not None:
+        return
+
+    # Bedrockへ渡す前に画像を縮小する
+    # NOTE 縮小はCPUを使うのでイベントループを止めないようスレッドで行う
+    try:
+        letter_record.letter_image = await app_async.to_thread(
+            preprocess_letter_image, letter_image
+        )
+    except InvalidLetterImageError as e:
+        # 何度処理しても失敗するので再配信させない
+        logger.error("prepare_record", extra={"s3_key": param.s3_key, "error": repr(e)})
+        letter_record.rejected = True
+
+
+async def analyze_record(letter_record: LetterRecord):
+    letter_record.letter_info = await app_async.to_thread(
+        analyze_letter_image, letter_record.letter_image
+    )
+    await insert_letter_info(letter_record.letter_hash, letter_record.letter_info)
+
+
+async def analyze_records(letter_records: list[LetterRecord]):
+    """
+    lambda_function.analyze_recordsの非同期版
+    """
+    if len(letter_records) > 1:
+        try:
+            letter_infos = await app_async.to_thread(
+                analyze_letter_images,
+                [letter_record.letter_image for letter_record in letter_records],
+            )
+            for letter_record, letter_info in zip(letter_records, letter_infos):
+                letter_record.letter_info = letter_info
+            await asyncio.gather(
+                *[
+                    insert_letter_info(letter_record.letter_hash, letter_info)
+                    for letter_record, letter_info in zip(letter_records, letter_infos)
+                ]
+            )
+            return
+        except RateLimitExceededError as e:
+            # 1通ずつ解析し直すとさらにスロットリングされるので、全てSQSに返す
+            logger.warning(
+                "analyze_records",
+                extra={"letters": len(letter_records), "error": repr(e)},
+            )
+            for letter_record in letter_records:
+                letter_record.error = e
+            return
+        except Exception as e:
+            logger.warning(
+                "analyze_records",
+                extra={"letters": len(letter_records), "error": repr(e)},
+            )
+
+    await run_records(analyze_record, letter_records)
+
+
+async def search_address(letter_record: LetterRecord):
+    letter_record.address = await geocode_cache.address_search(
+        letter_record.letter_info.address
+    )
+
+
+async def run_records(fn, letter_records: list[LetterRecord], semaphore=None):
+    """
+    レコードごとにfnを同時に実行し、失敗したレコードには例外を記録する
+    """
+
+    async def run(letter_record: LetterRecord):
+        try:
+            if semaphore is None:
+                await fn(letter_record)
+            else:
+                async with semaphore:
+                    await fn(letter_record)
+        except Exception as e:
+            letter_record.error = e
+
+    await asyncio.gather(*[run(letter_record) for letter_record in letter_records])
+
+
+async def handle(event) -> dict:
+    # Aurora接続用インスタンスが無い場合は作成
+    await open_aurora()
+
+    # 住所検索結果のキャッシュが無い場合は作成
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = AsyncGeocodeCache(aurora)
+
+    # SQSに失敗したメッセージIDを知らせるためのリスト
+    batch_item_failures = []
+
+    # レコードごとに同時に処理し、失敗したレコードだけをSQSに返す
+    letter_records = [LetterRecord(event_record) for event_record in event["Records"]]
+    semaphore = asyncio.Semaphore(ASYNC_RECORD_CONCURRENCY)
+
+    # S3から手紙画像を取得して前処理する
+    await run_records(prepare_record, letter_records, semaphore)
+
+    # 解析済みでない手紙をLETTER_ANALYSIS_BATCH_SIZE通ずつまとめてBedrockで解析する
+    unanalyzed_records = [
+        letter_record
+        for letter_record in letter_records
+        if letter_record.is_pending() and letter_record.letter_info is None
+    ]
+    batches = [
+        unanalyzed_records[i : i + LETTER_ANALYSIS_BATCH_SIZE]
+        for i in range(0, len(unanalyzed_records), LETTER_ANALYSIS_BATCH_SIZE)
+    ]
+    await asyncio.gather(*[analyze_records(batch) for batch in batches])
+
+    # 住所から緯度経度を取得
+    await run_records(
+        search_address,
+        [
+            letter_record
+            for letter_record in letter_records
+            if letter_record.is_pending()
+        ],
+        semaphore,
+    )
+
+    # presentテーブルにまとめて保存
+    # まとめて保存できない場合は失敗したレコードを特定するため1件ずつ保存する
+    analyzed_records = [
+        letter_record for letter_record in letter_records if letter_record.is_pending()
+    ]
+    try:
+        await insert_presents(analyzed_records)
+    except Exception as e:
+        logger.warning("handle", extra={"error": repr(e)})
+
+        async def insert_present(letter_record: LetterRecord):
+            await insert_presents([letter_record])
+
+        await run_records(insert_present, analyzed_records)
+
+    for letter_record in letter_records:
+        if letter_record.error is not None:
+            logger.error("handle", extra={"error": repr(letter_record.error)})
+            batch_item_failures.append(
+                {"itemIdentifier": letter_record.event_record["messageId"]}
+            )
+
+    logger.info("geocode_cache", extra=geocode_cache.stats())
+    logger.info("rate_limiter", extra={"limiters": rate_limiter.stats()})
+    return {"batchItemFailures": batch_item_failures}
+
+
+@app_metrics.handler
+def lambda_handler(event, context):
+    logger.debug(event)
+    logger.debug(context)
+
+    # Lambdaインスタンスで共有するイベントループで処理する
+    return app_async.run(handle(event))
+
+
+# STARTUP_PREINITがtrueの場合は初期化フェーズで済ませておき、
+# 手紙画像の前処理と住所検索で使うモジュールも読み込んでおく
+if startup.preinit(["PIL.Image", "aiohttp"]):
+    # DBへの接続はイベントループ上で行う
+    try:
+        app_async.run(open_aurora(app_startup.STARTUP_PREINIT_TIMEOUT_SECONDS))
+    except Exception as e:
+        # 最初の呼び出しでやり直す
+        logger.warning("preinit", extra={"error": repr(e)})
@@ -2,11 +2,21 @@ import boto3
 from botocore.config import Config
 import logging
 import app_const
+import app_client
+import app_logging
+import app_metrics
+import app_startup
+import rate_limiter
+from rate_limiter import RateLimitExceededError
 from app_type import Address
-import gsi_api
 from app_aurora import Aurora
+from geocode_cache import GeocodeCache
+from letter_image import LetterImage, InvalidLetterImageError, preprocess_letter_image
 import os
 import json
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(app_const.PROJECT_NAME)
 logger.setLevel(logging.DEBUG)
@@ -19,6 +29,20 @@ AURORA_SECRET_NAME = os.environ["AURORA_SECRET_NAME"]
 S3_REGION = os.environ["S3_REGION"]
 MODEL_REGION = os.environ["BEDROCK_MODEL_REGION"]
 MODEL_ID = os.environ["BEDROCK_MODEL_ID"]
+# 1回の呼び出しで並列に処理するSQSレコード数
+RECORD_CONCURRENCY = int(os.environ.get("RECORD_CONCURRENCY", "1"))
+# 1回のBedrock呼び出しでまとめて解析する手紙の数。1の場合は1通ずつ解析する
+# NOTE Converse APIで1リクエストに含められる画像は20枚まで
+LETTER_ANALYSIS_BATCH_SIZE = max(
+    1, min(int(os.environ.get("LETTER_ANALYSIS_BATCH_SIZE", "1")), 20)
+)
+
+# スロットリングはrate_limiterでレートを下げ、レコードをSQSに返して後で処理し直す
+# Lambdaの実行時間をリトライの待ち時間に使わないようリトライ回数は少なくする
+# 画像の解析には時間がかかるので読み込みタイムアウトは長めにする
+BEDROCK_CLIENT_CONFIG = Config(
+    read_timeout=300, retries={"max_attempts": 2, "mode": "standard"}
+)
 
 # Bedrockへ渡す手紙画像から情報抽出するためのシステムプロンプト
 SYSTEM_PROMPT = """
@@ -43,9 +67,52 @@ JSON以外を絶対に出力してはいけません。
 </example>
 """
 
+# 複数の手紙画像をまとめて解析するためのシステムプロンプト
+BATCH_SYSTEM_PROMPT = """
+あなたはサンタクロース宛ての手紙から情報を取得するエージェントです。
+複数の手紙の画像が、それぞれ直前に<letter index="番号">というテキストを付けて渡されます。
+手紙ごとに欲しいプレゼントと住所を抜き出し、JSONの配列の形で出力します。
+次の<rule>を必ず守ってください。
+
+<rule>
+JSON以外を絶対に出力してはいけません。
+手紙からはプレゼント名と住所だけを抽出し、他の情報は絶対に抽出してはいけません。
+住所は必ず漢字で出力します。
+渡された全ての手紙について、手紙の番号をindexとして1つずつ出力します。
+別々の手紙の内容を混ぜてはいけません。
+出力のJSONフォーマットを必ず守る必要があります。
+</rule>
+
+手紙が2通の場合の出力の例は<example>の様になります。
+
+<example>
+[
+  {
+    "index": 0,
+    "present": "ポケモンカード",
+    "address": "宮城県仙台市青葉区緑の丘0-0-00"
+  },
+  {
+    "index": 1,
+    "present": "自転車",
+    "address": "宮城県仙台市宮城野区榴岡0-0-0"
+  }
+]
+</example>
+"""
+
 # Lambdaインスタンスがまだ生きているときに呼び出された場合に
 # DB接続等を使いまわすため大域変数として宣言
 aurora: Aurora = None
+geocode_cache: GeocodeCache = None
+
+# コールドスタート時の初期化処理
+# シークレットの取得からAuroraへの接続までを、モジュールの読み込みと並列に行う
+# レコードを並列に処理するため並列数分のコネクションを持つ
+startup = app_startup.Startup(__name__)
+startup.add(
+    "aurora", lambda: Aurora(AURORA_SECRET_NAME, max_connections=RECORD_CONCURRENCY)
+)
 
 
 class EventParam:
@@ -68,46 +135,335 @@ class LetterInfo:
         self.address = address
 
 
+# SQSレコード1件分の処理状況を持つ
+class LetterRecord:
+    def __init__(self, event_record):
+        self.event_record = event_record
+        self.letter_hash: str = None
+        # Bedrockへ渡す画像。解析済みの場合はNone
+        self.letter_image: LetterImage = None
+        self.letter_info: LetterInfo = None
+        self.address: Address = None
+        # 手紙画像として扱えず、再配信させない場合はTrue
+        self.rejected = False
+        # 処理に失敗し、SQSに返す場合は例外
+        self.error: Exception = None
+
+    def is_pending(self) -> bool:
+        return not self.rejected and self.error is None
+
+
+@app_metrics.timed()
 def get_letter_image(param: EventParam) -> bytes:
-    s3 = boto3.client("s3", region_name=S3_REGION)
+    s3 = app_client.get_client("s3", region_name=S3_REGION)
     res = s3.get_object(Bucket=param.s3_bucket, Key=param.s3_key)
     data = res["Body"].read()
+    app_metrics.put("get_letter_image_bytes", len(data), app_metrics.BYTES)
     logger.info("get_letter_image", extra={"value": "get_object success"})
     return data
 
 
-def analyze_letter_image(letter_image: bytes) -> LetterInfo:
+@app_metrics.timed()
+def analyze_letter_image(letter_image: LetterImage) -> LetterInfo:
     message = {
         "role": "user",
-        "content": [{"image": {"format": "png", "source": {"bytes": letter_image}}}],
+        "content": [
+            {
+                "image": {
+                    "format": letter_image.format,
+                    "source": {"bytes": letter_image.data},
+                }
+            }
+        ],
     }
 
-    # デフォルトはstandardモードで5回リトライするがThrottlingするのでadaptiveモードでリトライ回数を上げる
-    config = Config(retries={"max_attempts": 10, "mode": "adaptive"})
-    bedrock = boto3.client("bedrock-runtime", region_name=MODEL_REGION, config=config)
-    res = bedrock.converse(
-        modelId=MODEL_ID, messages=[message], system=[{"text": SYSTEM_PROMPT}]
+    bedrock = app_client.get_client(
+        "bedrock-runtime", region_name=MODEL_REGION, config=BEDROCK_CLIENT_CONFIG
     )
+    start = time.perf_counter()
+    with rate_limiter.get_rate_limiter("bedrock").limit():
+        res = bedrock.converse(
+            modelId=MODEL_ID, messages=[message], system=[{"text": SYSTEM_PROMPT}]
+        )
+    elapsed = time.perf_counter() - start
+    put_bedrock_metrics(res)
     res_json = json.loads(res["output"]["message"]["content"][0]["text"])
-    logger.info("analyze_letter_image", extra={"bedrock response": res_json})
+    # 前処理による画像サイズの削減が解析時間にどう効いたかを追えるようにする
+    logger.info(
+        "analyze_letter_image",
+        extra={
+            "bedrock response": res_json,
+            "original_bytes": letter_image.original_bytes,
+            "bytes": len(letter_image.data),
+            "elapsed_seconds": round(elapsed, 3),
+            "usage": res.get("usage"),
+        },
+    )
 
     present_name = res_json["present"]
     address = res_json["address"]
     return LetterInfo(present_name, address)
 
 
+@app_metrics.timed()
+def analyze_letter_images(letter_images: list[LetterImage]) -> list[LetterInfo]:
+    """
+    複数の手紙画像を1回のBedrock呼び出しで解析し、letter_imagesと同じ順序で結果を返す。
+    応答が全ての手紙の結果を含むJSONの配列になっていない場合はValueError
+    """
+    content = []
+    for index, letter_image in enumerate(letter_images):
+        content.append({"text": f'<letter index="{index}">'})
+        content.append(
+            {
+                "image": {
+                    "format": letter_image.format,
+                    "source": {"bytes": letter_image.data},
+                }
+            }
+        )
+    message = {"role": "user", "content": content}
+
+    bedrock = app_client.get_client(
+        "bedrock-runtime", region_name=MODEL_REGION, config=BEDROCK_CLIENT_CONFIG
+    )
+    start = time.perf_counter()
+    with rate_limiter.get_rate_limiter("bedrock").limit():
+        res = bedrock.converse(
+            modelId=MODEL_ID, messages=[message], system=[{"text": BATCH_SYSTEM_PROMPT}]
+        )
+    elapsed = time.perf_counter() - start
+    put_bedrock_metrics(res)
+    app_metrics.put("analyze_letter_images_letters", len(letter_images))
+    res_json = json.loads(res["output"]["message"]["content"][0]["text"])
+    app_logging.log_payloads(
+        logger,
+        logging.INFO,
+        "analyze_letter_images",
+        {"bedrock response": res_json},
+        extra={
+            "letters": len(letter_images),
+            "bytes": sum(len(letter_image.data) for letter_image in letter_images),
+            "elapsed_seconds": round(elapsed, 3),
+            "usage": res.get("usage"),
+        },
+    )
+
+    # 手紙の番号で結果を対応付ける。番号の抜けや重複がある場合は信用しない
+    if not isinstance(res_json, list):
+        raise ValueError("bedrock response is not a list")
+    letter_infos: dict[int, LetterInfo] = {}
+    for item in res_json:
+        index = item.get("index") if isinstance(item, dict) else None
+        if (
+            not isinstance(index, int)
+            or not 0 <= index < len(letter_images)
+            or index in letter_infos
+            or not isinstance(item.get("present"), str)
+            or not isinstance(item.get("address"), str)
+        ):
+            raise ValueError(f"invalid item in bedrock response: {item}")
+        letter_infos[index] = LetterInfo(item["present"], item["address"])
+    if len(letter_infos) != len(letter_images):
+        raise ValueError(
+            f"bedrock response has {len(letter_infos)} of {len(letter_images)} letters"
+        )
+
+    return [letter_infos[index] for index in range(len(letter_images))]
+
+
+def put_bedrock_metrics(res: dict):
+    """
+    Bedrockの応答からリトライ回数とトークン数をメトリクスとして記録する
+    """
+    app_metrics.put("bedrock_retries", app_client.get_retry_count(res))
+    usage = res.get("usage") or {}
+    app_metrics.put("bedrock_input_tokens", usage.get("inputTokens", 0))
+    app_metrics.put("bedrock_output_tokens", usage.get("outputTokens", 0))
+
+
+def get_letter_hash(letter_image: bytes) -> str:
+    """
+    手紙画像の内容から解析結果のキャッシュキーを作成する
+    """
+    return hashlib.sha256(letter_image).hexdigest()
+
+
+def select_letter_info(aurora: Aurora, letter_hash: str) -> LetterInfo:
+    """
+    同じ手紙画像を解析済みの場合はその結果を返す。無い場合はNone
+    """
+    query = "SELECT present_name, address FROM letter_analysis WHERE letter_hash = %s"
+    try:
+        rows = aurora.select(query, (letter_hash,))
+    except Exception as e:
+        # キャッシュが読めない場合は解析し直す
+        logger.warning("select_letter_info", extra={"error": repr(e)})
+        return None
+
+    if len(rows) == 0:
+        app_metrics.put("letter_analysis_cache.miss", 1)
+        return None
+    app_metrics.put("letter_analysis_cache.hit", 1)
+    logger.info("select_letter_info", extra={"letter_hash": letter_hash})
+    return LetterInfo(rows[0]["present_name"], rows[0]["address"])
+
+
+def insert_letter_info(aurora: Aurora, letter_hash: str, letter_info: LetterInfo):
+    """
+    SQSからの再配信時にBedrockを呼ばずに済むよう解析結果を保存する
+    """
+    query = "INSERT INTO letter_analysis (letter_hash, present_name, address) VALUES (%s, %s, %s) ON CONFLICT (letter_hash) DO NOTHING"
+    param = (letter_hash, letter_info.present_name, letter_info.address)
+    try:
+        aurora.update_commit(query, param)
+    except Exception as e:
+        # 保存できなくても後続の処理は続ける
+        logger.warning("insert_letter_info", extra={"error": repr(e)})
+
+
+@app_metrics.timed()
 def insert_present(aurora: Aurora, letter_info: LetterInfo, address: Address):
-    query = "INSERT INTO present (present_name, address, point) VALUES (%s, %s, ST_GeomFromText('POINT(%s %s)'))"
+    query = "INSERT INTO present (present_name, address, point) VALUES (%s, %s, ST_MakePoint(%s, %s))"
     param = (
         letter_info.present_name,
         address.address,
         address.point.latitude,
         address.point.longitude,
     )
-    logger.info("insert_present", extra={"query": query, "param": param})
-    aurora.update_commit(query, param)
+    app_logging.log_payloads(
+        logger, logging.INFO, "insert_present", {"param": param}, extra={"query": query}
+    )
+    aurora.update_commit(query, param, prepare=True)
+
+
+@app_metrics.timed()
+def insert_presents(aurora: Aurora, presents: list[tuple[LetterInfo, Address]]):
+    """
+    複数のプレゼントを1つのINSERT文、1回のコミットでpresentテーブルに保存する
+    件数によらず同じ文になるよう列ごとの配列で渡し、プリペアドステートメントとして実行する
+    """
+    query = "INSERT INTO present (present_name, address, point) SELECT present_name, address, ST_MakePoint(latitude, longitude) FROM unnest(%s::text[], %s::text[], %s::float8[], %s::float8[]) AS t(present_name, address, latitude, longitude)"
+    params = [
+        (
+            letter_info.present_name,
+            address.address,
+            address.point.latitude,
+            address.point.longitude,
+        )
+        for letter_info, address in presents
+    ]
+    app_logging.log_payloads(
+        logger,
+        logging.INFO,
+        "insert_presents",
+        {"params": params},
+        extra={"query": query},
+    )
+    app_metrics.put("insert_presents_rows", len(params))
+    if len(params) == 0:
+        return
+    aurora.update_commit(
+        query, tuple(list(column) for column in zip(*params)), prepare=True
+    )
+
 
+def prepare_record(letter_record: LetterRecord):
+    """
+    SQSレコード1件分の手紙画像を取得し、Bedrockへ渡せる形にする
+    解析済みの画像の場合は保存済みの結果をletter_infoに設定する
+    """
+    # イベントから必要なパラメーターを取得
+    param: EventParam = EventParam(letter_record.event_record)
 
+    # S3から手紙画像を取得
+    letter_image: bytes = get_letter_image(param)
+
+    # 再配信などで解析済みの画像の場合はBedrockを呼ばずに保存済みの結果を使う
+    # NOTE キャッシュキーは前処理の設定に左右されないよう元の画像から作成する
+    letter_record.letter_hash = get_letter_hash(letter_image)
+    letter_record.letter_info = select_letter_info(aurora, letter_record.letter_hash)
+    if letter_record.letter_info is not None:
+        return
+
+    # Bedrockへ渡す前に画像を縮小する
+    try:
+        letter_record.letter_image = preprocess_letter_image(letter_image)
+    except InvalidLetterImageError as e:
+        # 何度処理しても失敗するので再配信させない
+        logger.error("prepare_record", extra={"s3_key": param.s3_key, "error": repr(e)})
+        letter_record.rejected = True
+
+
+def analyze_record(letter_record: LetterRecord):
+    """
+    手紙画像を1通だけでBedrockに解析させる
+    """
+    letter_record.letter_info = analyze_letter_image(letter_record.letter_image)
+    insert_letter_info(aurora, letter_record.letter_hash, letter_record.letter_info)
+
+
+def analyze_records(letter_records: list[LetterRecord]):
+    """
+    複数の手紙画像をまとめてBedrockに解析させる
+    まとめた応答が壊れている場合は1通ずつ解析し直し、失敗したレコードだけを失敗とする
+    """
+    if len(letter_records) > 1:
+        try:
+            letter_infos = analyze_letter_images(
+                [letter_record.letter_image for letter_record in letter_records]
+            )
+            for letter_record, letter_info in zip(letter_records, letter_infos):
+                letter_record.letter_info = letter_info
+                insert_letter_info(aurora, letter_record.letter_hash, letter_info)
+            return
+        except RateLimitExceededError as e:
+            # 1通ずつ解析し直すとさらにスロットリングされるので、全てSQSに返す
+            logger.warning(
+                "analyze_records",
+                extra={"letters": len(letter_records), "error": repr(e)},
+            )
+            for letter_record in letter_records:
+                letter_record.error = e
+            return
+        except Exception as e:
+            logger.warning(
+                "analyze_records",
+                extra={"letters": len(letter_records), "error": repr(e)},
+            )
+
+    for letter_record in letter_records:
+        try:
+            analyze_record(letter_record)
+        except Exception as e:
+            letter_record.error = e
+
+
+def search_address(letter_record: LetterRecord):
+    """
+    手紙の住所から緯度経度を取得する
+    """
+    letter_record.address = geocode_cache.address_search(
+        letter_record.letter_info.address
+    )
+
+
+def run_records(executor: ThreadPoolExecutor, fn, letter_records: list[LetterRecord]):
+    """
+    レコードごとにfnを並列に実行し、失敗したレコードには例外を記録する
+    """
+    futures = [
+        (letter_record, executor.submit(fn, letter_record))
+        for letter_record in letter_records
+    ]
+    for letter_record, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            letter_record.error = e
+
+
+@app_metrics.handler
 def lambda_handler(event, context):
     logger.debug(event)
     logger.debug(context)
@@ -115,28 +471,85 @@ def lambda_handler(event, context):
     # Aurora接続用インスタンスが無い場合は作成
     global aurora
     if aurora is None:
-        aurora = Aurora(AURORA_SECRET_NAME)
+        aurora = startup.get("aurora")
+
+    # 住所検索結果のキャッシュが無い場合は作成
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = GeocodeCache(aurora)
 
     # SQSに失敗したメッセージIDを知らせるためのリスト
     batch_item_failures = []
 
-    for event_record in event["Records"]:
-        try:
-            # イベントから必要なパラメーターを取得
-            param: EventParam = EventParam(event_record)
+    # レコードごとに並列に処理し、失敗したレコードだけをSQSに返す
+    letter_records = [LetterRecord(event_record) for event_record in event["Records"]]
+    max_workers = max(1, min(RECORD_CONCURRENCY, len(letter_records)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # S3から手紙画像を取得して前処理する
+        run_records(executor, prepare_record, letter_records)
 
-            # S3から手紙画像を取得
-            letter_image: bytes = get_letter_image(param)
+        # 解析済みでない手紙をLETTER_ANALYSIS_BATCH_SIZE通ずつまとめてBedrockで解析する
+        unanalyzed_records = [
+            letter_record
+            for letter_record in letter_records
+            if letter_record.is_pending() and letter_record.letter_info is None
+        ]
+        batches = [
+            unanalyzed_records[i : i + LETTER_ANALYSIS_BATCH_SIZE]
+            for i in range(0, len(unanalyzed_records), LETTER_ANALYSIS_BATCH_SIZE)
+        ]
+        for future in [executor.submit(analyze_records, batch) for batch in batches]:
+            future.result()
 
-            # 手紙画像からプレゼント名と住所を取得
-            letter_info: LetterInfo = analyze_letter_image(letter_image)
+        # 住所から緯度経度を取得
+        run_records(
+            executor,
+            search_address,
+            [
+                letter_record
+                for letter_record in letter_records
+                if letter_record.is_pending()
+            ],
+        )
 
-            # 住所から緯度経度を取得
-            address: Address = gsi_api.address_search(letter_info.address)
+    for letter_record in letter_records:
+        if letter_record.error is not None:
+            logger.error("lambda_handler", extra={"error": repr(letter_record.error)})
+            batch_item_failures.append(
+                {"itemIdentifier": letter_record.event_record["messageId"]}
+            )
 
-            # presentテーブルに保存
-            insert_present(aurora, letter_info, address)
-        except Exception as e:
-            logger.error("lambda_handler", extra={"error": repr(e)})
-            batch_item_failures.append({"itemIdentifier": event_record["messageId"]})
+    # 解析に成功したレコードとその結果
+    analyzed_records: list[tuple[dict, LetterInfo, Address]] = [
+        (letter_record.event_record, letter_record.letter_info, letter_record.address)
+        for letter_record in letter_records
+        if letter_record.is_pending()
+    ]
+
+    # presentテーブルにまとめて保存
+    # まとめて保存できない場合は失敗したレコードを特定するため1件ずつ保存する
+    try:
+        insert_presents(
+            aurora,
+            [(letter_info, address) for _, letter_info, address in analyzed_records],
+        )
+    except Exception as e:
+        logger.warning("lambda_handler", extra={"error": repr(e)})
+        for event_record, letter_info, address in analyzed_records:
+            try:
+                insert_present(aurora, letter_info, address)
+            except Exception as e:
+                logger.error("lambda_handler", extra={"error": repr(e)})
+                batch_item_failures.append(
+                    {"itemIdentifier": event_record["messageId"]}
+                )
+
+    logger.info("geocode_cache", extra=geocode_cache.stats())
+    logger.info("rate_limiter", extra={"limiters": rate_limiter.stats()})
+    logger.info("aurora", extra=aurora.stats())
     return {"batchItemFailures": batch_item_failures}
+
+
+# STARTUP_PREINITがtrueの場合は初期化フェーズで済ませておき、
+# 手紙画像の前処理と住所検索で使うモジュールも読み込んでおく
+startup.preinit(["PIL.Image", "requests"])
@@ -5,13 +5,28 @@ CREATE TABLE present (
     point GEOMETRY(POINT)
 );
 
+-- 範囲を指定した配達先の検索に使う空間インデックス
+-- NOTE pointはx座標に緯度、y座標に経度を入れているため、距離(m)での検索には経度緯度の順にしたgeographyの式インデックスを使う
+CREATE INDEX present_point_idx ON present USING GIST (point);
+CREATE INDEX present_geography_idx ON present USING GIST ((ST_SetSRID(ST_FlipCoordinates(point), 4326)::geography));
+
 CREATE TABLE delivery_route (
     id SERIAL PRIMARY KEY,
     facility_id INT,
     delivery_ordered_point GEOMETRY(LINESTRING),
-    route_flex_polylines TEXT
+    route_flex_polylines TEXT,
+    present_fingerprint TEXT,
+    delivery_ordered_present_ids INT[],
+    tour_engine VARCHAR(16),
+    route_geom GEOMETRY(MULTILINESTRING),
+    -- 全体の巡回順序を計算したときのプレゼント数と、その後に差分で挿入したプレゼント数
+    solved_present_count INT,
+    inserted_present_count INT DEFAULT 0,
+    created_at TIMESTAMP DEFAULT now()
 );
 
+CREATE INDEX delivery_route_fingerprint_idx ON delivery_route (facility_id, present_fingerprint);
+
 CREATE TABLE facility (
     facility_id SERIAL PRIMARY KEY,
     facility_name VARCHAR(255),
@@ -19,6 +34,32 @@ CREATE TABLE facility (
     point GEOMETRY(POINT)
 );
 
+CREATE INDEX facility_point_idx ON facility USING GIST (point);
+
+CREATE TABLE geocode_cache (
+    address_key TEXT PRIMARY KEY,
+    address VARCHAR(255),
+    point GEOMETRY(POINT),
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+-- 地点間の移動コスト(道路距離(m))。地点は緯度経度を小数点以下5桁に丸めた"<緯度>,<経度>"で表す
+-- 経路が見つからなかった組はcostをNULLにする
+CREATE TABLE travel_cost (
+    origin_key TEXT,
+    destination_key TEXT,
+    cost REAL,
+    updated_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (origin_key, destination_key)
+);
+
+CREATE TABLE letter_analysis (
+    letter_hash CHAR(64) PRIMARY KEY,
+    present_name VARCHAR(255),
+    address VARCHAR(255),
+    created_at TIMESTAMP DEFAULT now()
+);
+
 SELECT * FROM information_schema.tables WHERE table_schema = 'public';
 
 INSERT INTO facility (facility_name, address, point) VALUES ('サンタさんの家', '宮城県仙台市青葉区中央１丁目１−１', ST_GeomFromText('POINT(38.260990 140.881155)'));
@@ -0,0 +1,68 @@
+"""
+resources/lambda以下のPythonのテスト。AWSにはアクセスせず、benchmark/fake_awsのクライアントを使う。
+
+$ python -m pytest test/lambda
+
+PostGISを使うテストは、環境変数TEST_POSTGRESに接続先を{"host", "port", "username", "password"}のJSONで
+指定した場合だけ実行する。
+$ docker run -d --rm -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgis/postgis
+$ TEST_POSTGRES='{"host": "localhost", "port": 5432, "username": "postgres", "password": "postgres"}' python -m pytest test/lambda
+
+NOTE 接続先のデータベースのテーブルはテストごとに作り直す
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+LAYER_DIR = os.path.join(ROOT_DIR, "resources", "lambda", "layer")
+API_FUNCTION_DIR = os.path.join(ROOT_DIR, "resources", "lambda", "api-function")
+BENCHMARK_DIR = os.path.join(ROOT_DIR, "benchmark")
+
+sys.path.append(LAYER_DIR)
+sys.path.append(BENCHMARK_DIR)
+
+import fake_aws  # noqa: E402
+
+TEST_POSTGRES = os.environ.get("TEST_POSTGRES")
+
+# ハンドラーを読み込む前に環境変数を設定し、AWSのクライアントを差し替える
+fake_aws.install(
+    json.loads(TEST_POSTGRES)
+    if TEST_POSTGRES
+    else {"host": "localhost", "port": 5432, "username": "", "password": ""}
+)
+
+
+@pytest.fixture(scope="session")
+def api_function():
+    """
+    api-functionのlambda_function。letter-analysis-functionと同じファイル名なので別の名前で読み込む
+    """
+    name = "api_lambda_function"
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(API_FUNCTION_DIR, "lambda_function.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def aurora():
+    """
+    テーブルを作り直したPostGISのAurora。TEST_POSTGRESが無い場合はテストを飛ばす
+    """
+    if not TEST_POSTGRES:
+        pytest.skip("TEST_POSTGRES is not set")
+
+    import pipeline_benchmark
+    from app_aurora import Aurora
+
+    aurora = Aurora(os.environ["AURORA_SECRET_NAME"])
+    pipeline_benchmark.reset_database(aurora)
+    return aurora
@@ -0,0 +1,63 @@
+import logging
+import threading
+import numpy as np
+from app_type import Point
+from here_api import TourStop
+from local_tour import LocalTourSolver
+import partitioned_tour
+from partitioned_tour import PartitionedTourSolver
+
+
+def random_stops(size: int) -> list[TourStop]:
+    rng = np.random.default_rng(0)
+    return [
+        TourStop(i, Point(float(latitude), float(longitude)))
+        for i, (latitude, longitude) in enumerate(
+            zip(rng.uniform(38.1, 38.4, size), rng.uniform(140.7, 141.0, size)),
+            start=1,
+        )
+    ]
+
+
+def test_local_tours_while_another_thread_holds_logging_lock(monkeypatch, recwarn):
+    # CPUが1つの環境でも子プロセスで計算させる
+    monkeypatch.setattr(partitioned_tour.os, "cpu_count", lambda: 4)
+    stops = random_stops(200)
+    solver = PartitionedTourSolver(LocalTourSolver(0.2), 50, 4)
+
+    # 他のスレッドがloggingのロックを持ったまま、巡回順序の計算が終わるまで離さない
+    # NOTE ログを出力しないレベルであることをキャッシュさせ、このスレッドのloggerはロックを使わないようにする
+    partitioned_tour.logger.isEnabledFor(logging.INFO)
+    locks = [logging._lock] + [
+        handler.lock for handler in logging.getLogger().handlers if handler.lock
+    ]
+    acquired = threading.Event()
+    finished = threading.Event()
+
+    def hold_locks():
+        for lock in locks:
+            lock.acquire()
+        acquired.set()
+        finished.wait()
+        for lock in reversed(locks):
+            lock.release()
+
+    holder = threading.Thread(target=hold_locks, daemon=True)
+    holder.start()
+    acquired.wait()
+
+    result = {}
+    worker = threading.Thread(
+        target=lambda: result.update(
+            ids=solver.tour(Point(38.260990, 140.881155), stops, "", "")
+        ),
+        daemon=True,
+    )
+    worker.start()
+    worker.join(timeout=60)
+    finished.set()
+    holder.join()
+
+    assert not worker.is_alive()
+    assert sorted(result["ids"]) == [stop.id for stop in stops]
+    assert not [w for w in recwarn if "fork" in str(w.message)]
@@ -0,0 +1,52 @@
+def insert_present(aurora, name: str, latitude: float, longitude: float):
+    aurora.update_commit(
+        "INSERT INTO present (present_name, address, point) VALUES (%s, %s, ST_MakePoint(%s, %s))",
+        (name, name, latitude, longitude),
+    )
+
+
+def fingerprint(api_function, aurora, params: dict = None) -> str:
+    facility = api_function.get_facility(aurora)
+    region = api_function.PresentRegion(params or {})
+    return api_function.get_present_fingerprint(aurora, facility, region)
+
+
+def test_unchanged_presents_keep_fingerprint(api_function, aurora):
+    insert_present(aurora, "a", 38.25, 140.85)
+    insert_present(aurora, "b", 38.27, 140.90)
+
+    assert fingerprint(api_function, aurora) == fingerprint(api_function, aurora)
+
+
+def test_added_present_changes_fingerprint(api_function, aurora):
+    insert_present(aurora, "a", 38.25, 140.85)
+    before = fingerprint(api_function, aurora)
+
+    insert_present(aurora, "b", 38.27, 140.90)
+
+    assert fingerprint(api_function, aurora) != before
+
+
+def test_moved_present_changes_fingerprint(api_function, aurora):
+    insert_present(aurora, "a", 38.25, 140.85)
+    insert_present(aurora, "b", 38.27, 140.90)
+    before = fingerprint(api_function, aurora)
+
+    # 件数も最大のpresent_idも変わらない
+    aurora.update_commit(
+        "UPDATE present SET point = ST_MakePoint(%s, %s) WHERE present_name = %s",
+        (38.30, 140.95, "a"),
+    )
+
+    assert fingerprint(api_function, aurora) != before
+
+
+def test_moved_facility_changes_fingerprint(api_function, aurora):
+    insert_present(aurora, "a", 38.25, 140.85)
+    before = fingerprint(api_function, aurora)
+
+    aurora.update_commit(
+        "UPDATE facility SET point = ST_MakePoint(%s, %s)", (38.0, 140.0)
+    )
+
+    assert fingerprint(api_function, aurora) != before
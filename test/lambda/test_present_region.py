@@ -0,0 +1,58 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        # 4つの数値でない
+        {"bbox": "38.1,140.7,38.4"},
+        {"bbox": "38.1,140.7,38.4,east"},
+        # 南端が北端より北
+        {"bbox": "38.4,140.7,38.1,141.0"},
+        # 緯度の範囲外
+        {"bbox": "-91,140.7,38.4,141.0"},
+        {"bbox": "38.1,140.7,91,141.0"},
+        # centerとradiusの片方だけ
+        {"center": "38.26,140.88"},
+        {"radius": "1000"},
+        # centerが2つの数値でない、緯度の範囲外
+        {"center": "38.26", "radius": "1000"},
+        {"center": "91,140.88", "radius": "1000"},
+        # radiusが正の数値でない
+        {"center": "38.26,140.88", "radius": "0"},
+        {"center": "38.26,140.88", "radius": "nan"},
+    ],
+)
+def test_invalid_region_is_bad_request(api_function, params):
+    with pytest.raises(ValueError):
+        api_function.PresentRegion(params)
+
+    event = {"queryStringParameters": {"apiKey": "key", **params}}
+    response = api_function.lambda_handler(event, None)
+    assert response["statusCode"] == 400
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        {},
+        {"queryStringParameters": None},
+        {"queryStringParameters": {}},
+        {"queryStringParameters": {"apiKey": "key", "engine": "unknown"}},
+        {"queryStringParameters": {"apiKey": "key", "zoom": "far"}},
+    ],
+)
+def test_invalid_event_is_bad_request(api_function, event):
+    response = api_function.lambda_handler(event, None)
+    assert response["statusCode"] == 400
+
+
+def test_valid_region(api_function):
+    region = api_function.PresentRegion(
+        {"bbox": "38.1,140.7,38.4,141.0", "center": "38.26,140.88", "radius": "1000"}
+    )
+
+    assert region.bbox == [38.1, 140.7, 38.4, 141.0]
+    assert region.center == [38.26, 140.88]
+    assert region.radius == 1000
+    assert api_function.PresentRegion({}).key() == "all"
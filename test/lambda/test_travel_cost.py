@@ -0,0 +1,103 @@
+import numpy as np
+from local_tour import haversine_matrix
+import travel_cost
+from travel_cost import TravelCostStore
+
+LATITUDES = np.array([38.26, 38.27, 38.30])
+LONGITUDES = np.array([140.88, 140.90, 140.95])
+
+
+class MemoryAurora:
+    """
+    travel_costテーブルの代わりに辞書に保存する。有効期間は無視する
+    """
+
+    def __init__(self):
+        self.rows: dict[tuple[str, str], float] = {}
+
+    def select_stream(self, query, param, itersize=2000):
+        assert query == travel_cost.SELECT_QUERY
+        keys = set(param[0])
+        yield [
+            (origin, destination, cost)
+            for (origin, destination), cost in self.rows.items()
+            if origin in keys and destination in keys
+        ]
+
+    def update_commit(self, query, param, prepare=False):
+        assert query == travel_cost.UPSERT_QUERY
+        for origin, destination, cost in zip(*param):
+            self.rows[(origin, destination)] = cost
+
+
+class CostFunction:
+    """
+    大円距離の2倍を返す。地点0から地点2への経路は見つからないものとする
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, origins, destinations):
+        self.calls += 1
+        costs = 2 * haversine_matrix(
+            np.array([p.latitude for p in origins]),
+            np.array([p.longitude for p in origins]),
+            np.array([p.latitude for p in destinations]),
+            np.array([p.longitude for p in destinations]),
+        )
+        for i, origin in enumerate(origins):
+            for j, destination in enumerate(destinations):
+                if (origin.latitude, destination.latitude) == (
+                    LATITUDES[0],
+                    LATITUDES[2],
+                ):
+                    costs[i, j] = np.nan
+        return costs
+
+
+def assert_matrix(matrix: np.ndarray):
+    haversine = haversine_matrix(LATITUDES, LONGITUDES, LATITUDES, LONGITUDES)
+    expected = 2 * haversine
+    # 経路が見つからない組は大円距離で代用する
+    expected[0, 2] = haversine[0, 2]
+    np.testing.assert_allclose(matrix, expected, rtol=1e-6)
+
+
+def test_unreachable_pair_is_not_requested_again():
+    aurora = MemoryAurora()
+    cost_function = CostFunction()
+    store = TravelCostStore(aurora, cost_function)
+
+    assert_matrix(store.matrix(LATITUDES, LONGITUDES))
+    assert cost_function.calls > 0
+    # 見つからなかったことを保存する
+    assert len(aurora.rows) == 6
+    assert (
+        aurora.rows[
+            tuple(travel_cost.point_keys(LATITUDES[[0, 2]], LONGITUDES[[0, 2]]))
+        ]
+        is None
+    )
+
+    cost_function.calls = 0
+    assert_matrix(store.matrix(LATITUDES, LONGITUDES))
+    assert cost_function.calls == 0
+
+
+def test_unreachable_pair_expires_earlier(aurora):
+    cost_function = CostFunction()
+    store = TravelCostStore(aurora, cost_function)
+    assert_matrix(store.matrix(LATITUDES, LONGITUDES))
+
+    cost_function.calls = 0
+    assert_matrix(store.matrix(LATITUDES, LONGITUDES))
+    assert cost_function.calls == 0
+
+    # 経路が見つからなかった組だけが有効期間切れになる
+    aurora.update_commit(
+        "UPDATE travel_cost SET updated_at = now() - make_interval(days => %s)",
+        (travel_cost.TRAVEL_COST_UNREACHABLE_TTL_DAYS + 1,),
+    )
+    assert_matrix(store.matrix(LATITUDES, LONGITUDES))
+    assert cost_function.calls > 0